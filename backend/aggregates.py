@@ -0,0 +1,82 @@
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from models import Transaction, Investment, PortfolioSelection, UserArchiveTotals
+
+def is_roundup_payment(payment_id) -> bool:
+    """Investments funded from the round-up pool (vs. wallet / Razorpay)"""
+    return bool(payment_id) and (payment_id.startswith('ROUNDUP_') or payment_id.startswith('PAY'))
+
+def roundup_payment_clause():
+    """SQL form of is_roundup_payment"""
+    # substr() rather than LIKE: SQLite's LIKE is case-insensitive, startswith() is not
+    return or_(
+        func.substr(Investment.payment_id, 1, 8) == 'ROUNDUP_',
+        func.substr(Investment.payment_id, 1, 3) == 'PAY'
+    )
+
+def transaction_totals(db: Session, user_id: int) -> tuple:
+    """
+    Count and round-up sum of a user's transactions
+
+    Includes rows moved to the history archive, whose totals are kept in
+    `user_archive_totals`.
+
+    Returns:
+        (transaction_count, total_roundups)
+    """
+    count, total = db.query(
+        func.count(Transaction.id), func.coalesce(func.sum(Transaction.roundup_amount), 0.0)
+    ).filter(Transaction.user_id == user_id).one()
+
+    archived = db.query(UserArchiveTotals).filter(UserArchiveTotals.user_id == user_id).first()
+    if archived:
+        count += archived.transaction_count
+        total += archived.roundup_total
+
+    return count, total
+
+def invested_by_source(db: Session, user_id: int) -> tuple:
+    """
+    Returns:
+        (invested_from_roundups, invested_from_wallet)
+    """
+    from_roundups, total = db.query(
+        func.coalesce(func.sum(Investment.amount).filter(roundup_payment_clause()), 0.0),
+        func.coalesce(func.sum(Investment.amount), 0.0)
+    ).filter(Investment.user_id == user_id).one()
+
+    return from_roundups, total - from_roundups
+
+def available_roundups(db: Session, user_id: int) -> float:
+    """Round-ups generated but not yet invested"""
+    _, total_roundups = transaction_totals(db, user_id)
+    from_roundups, _ = invested_by_source(db, user_id)
+    return total_roundups - from_roundups
+
+def holdings_by_user(db, user_ids=None) -> dict:
+    """{user_id: {option_id: (units, cost)}} from one grouped query"""
+    query = db.query(
+        Investment.user_id, Investment.portfolio_option_id,
+        func.sum(Investment.units), func.sum(Investment.amount)
+    )
+    if user_ids is not None:
+        query = query.filter(Investment.user_id.in_(user_ids))
+    holdings = defaultdict(dict)
+    for user_id, option_id, units, cost in query.group_by(Investment.user_id, Investment.portfolio_option_id):
+        if units and units > 1e-9:
+            holdings[user_id][option_id] = (units, cost)
+    return holdings
+
+def targets_by_user(db, user_ids=None) -> dict:
+    """{user_id: {option_id: target_weight or NaN}}"""
+    query = db.query(PortfolioSelection.user_id, PortfolioSelection.portfolio_option_id, PortfolioSelection.target_weight)
+    if user_ids is not None:
+        query = query.filter(PortfolioSelection.user_id.in_(user_ids))
+    targets = defaultdict(dict)
+    for user_id, option_id, weight in query:
+        targets[user_id][option_id] = np.nan if weight is None else weight
+    return targets
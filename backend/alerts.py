@@ -0,0 +1,318 @@
+"""
+Price alert engine
+
+The scheduler leader keeps every active alert in memory, grouped by
+(option, direction) into arrays sorted by threshold. On each price tick only
+the alerts whose threshold lies between the previous and the new price can
+fire, and that is one contiguous slice found with two binary searches:
+
+    price fell  p0 -> p1:  BELOW alerts with p1 <= threshold < p0
+    price rose  p0 -> p1:  ABOVE alerts with p0 < threshold <= p1
+
+Fired alerts are delivered per shard in one batch: a single UPDATE ...
+RETURNING switches one-shot alerts off (re-arming ones stay active and fire
+again on the next crossing) and confirms which alerts are still active,
+followed by one bulk insert into `alert_notifications`. Alerts cancelled by
+the user stay in the book until they would fire; the UPDATE then filters
+them out and they are dropped.
+
+New alerts are picked up incrementally (id > last seen, per shard) at the
+start of each tick.
+
+    python alerts.py bench --alerts 5000000 --symbols 2000
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import insert, update
+
+from database import SessionLocal, SHARD_COUNT, for_each_shard
+from models import PriceAlert, AlertNotification, AlertDirection
+from price_feed import price_array
+
+ALERTS_MAX_PER_USER = int(os.getenv("ALERTS_MAX_PER_USER", "100"))
+# A tick this long after the previous one compares against stale prices
+# (e.g. leadership moved away and back); it only re-bases instead of firing.
+ALERTS_STALE_SECONDS = float(os.getenv("ALERTS_STALE_SECONDS", "120"))
+ALERTS_DELIVERY_CHUNK = 10_000
+
+ABOVE, BELOW = 0, 1
+_DIRECTIONS = {AlertDirection.ABOVE: ABOVE, AlertDirection.BELOW: BELOW}
+
+class _Side:
+    """Alerts of one option and direction, sorted by threshold"""
+    __slots__ = ("thresholds", "alert_ids", "shards", "users", "repeat")
+
+    def __init__(self):
+        self.thresholds = np.empty(0, dtype=np.float64)
+        self.alert_ids = np.empty(0, dtype=np.int64)
+        self.shards = np.empty(0, dtype=np.int16)
+        self.users = np.empty(0, dtype=np.int64)
+        self.repeat = np.empty(0, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.thresholds)
+
+    def add(self, thresholds, alert_ids, shards, users, repeat):
+        order = np.argsort(thresholds, kind="stable")
+        at = np.searchsorted(self.thresholds, thresholds[order], side="right")
+        self.thresholds = np.insert(self.thresholds, at, thresholds[order])
+        self.alert_ids = np.insert(self.alert_ids, at, alert_ids[order])
+        self.shards = np.insert(self.shards, at, shards[order])
+        self.users = np.insert(self.users, at, users[order])
+        self.repeat = np.insert(self.repeat, at, repeat[order])
+
+    def keep(self, mask: np.ndarray):
+        self.thresholds = self.thresholds[mask]
+        self.alert_ids = self.alert_ids[mask]
+        self.shards = self.shards[mask]
+        self.users = self.users[mask]
+        self.repeat = self.repeat[mask]
+
+class AlertBook:
+    def __init__(self):
+        self.sides = {}
+        self.last_prices = None
+        self.last_tick = 0.0
+
+    def __len__(self) -> int:
+        return sum(len(side) for side in self.sides.values())
+
+    def add(self, option_ids, directions, thresholds, alert_ids, shards, users, repeat):
+        """Add alerts given as parallel arrays (any order)"""
+        option_ids = np.asarray(option_ids, dtype=np.int64)
+        directions = np.asarray(directions, dtype=np.int8)
+        if not len(option_ids):
+            return
+        columns = [
+            np.asarray(thresholds, dtype=np.float64), np.asarray(alert_ids, dtype=np.int64),
+            np.asarray(shards, dtype=np.int16), np.asarray(users, dtype=np.int64), np.asarray(repeat, dtype=bool)
+        ]
+        order = np.lexsort((directions, option_ids))
+        keys = option_ids[order] * 2 + directions[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        ends = np.append(starts[1:], len(keys))
+        for start, end in zip(starts, ends):
+            key = (int(option_ids[order[start]]), int(directions[order[start]]))
+            rows = order[start:end]
+            self.sides.setdefault(key, _Side()).add(*(column[rows] for column in columns))
+
+    def detect(self, prices: np.ndarray) -> list:
+        """
+        Alerts crossed since the previous tick
+
+        Args:
+            prices: Price array indexed by option id (NaN = no price)
+
+        Returns:
+            [(key, lo, hi, price), ...]: slices of the side arrays that fired
+        """
+        now = time.monotonic()
+        previous, self.last_prices = self.last_prices, np.array(prices, dtype=np.float64)
+        stale = now - self.last_tick > ALERTS_STALE_SECONDS
+        self.last_tick = now
+        if previous is None or stale:
+            return []
+
+        fired = []
+        for key, side in self.sides.items():
+            option_id, direction = key
+            if option_id >= len(prices) or option_id >= len(previous) or not len(side):
+                continue
+            p0, p1 = previous[option_id], prices[option_id]
+            if not (p0 == p0 and p1 == p1) or p0 == p1:  # NaN or unchanged
+                continue
+            if direction == BELOW and p1 < p0:
+                lo = np.searchsorted(side.thresholds, p1, side="left")
+                hi = np.searchsorted(side.thresholds, p0, side="left")
+            elif direction == ABOVE and p1 > p0:
+                lo = np.searchsorted(side.thresholds, p0, side="right")
+                hi = np.searchsorted(side.thresholds, p1, side="right")
+            else:
+                continue
+            if hi > lo:
+                fired.append((key, int(lo), int(hi), float(p1)))
+        return fired
+
+    def settle(self, fired: list, confirmed=None):
+        """
+        Drop fired one-shot alerts, and any alert delivery found inactive
+
+        Args:
+            confirmed: {(shard, alert_id)} still active when delivered; None = all
+        """
+        for key, lo, hi, _ in fired:
+            side = self.sides[key]
+            stays = side.repeat[lo:hi].copy()
+            if confirmed is not None:
+                stays &= np.array([
+                    (int(s), int(a)) in confirmed for s, a in zip(side.shards[lo:hi], side.alert_ids[lo:hi])
+                ], dtype=bool)
+            if stays.all():
+                continue
+            mask = np.ones(len(side), dtype=bool)
+            mask[lo:hi] = stays
+            side.keep(mask)
+            if not len(side):
+                del self.sides[key]
+
+    def triggered(self, fired: list) -> dict:
+        """Fired alerts grouped by shard: {shard: [{alert fields}, ...]}"""
+        by_shard = {}
+        for (option_id, direction), lo, hi, price in fired:
+            side = self.sides[(option_id, direction)]
+            for i in range(lo, hi):
+                by_shard.setdefault(int(side.shards[i]), []).append({
+                    "alert_id": int(side.alert_ids[i]),
+                    "user_id": int(side.users[i]),
+                    "portfolio_option_id": option_id,
+                    "direction": AlertDirection.ABOVE if direction == ABOVE else AlertDirection.BELOW,
+                    "threshold": float(side.thresholds[i]),
+                    "price": price,
+                })
+        return by_shard
+
+def _deliver_shard(db, alerts: list, now: datetime) -> set:
+    """Switch off / re-arm fired alerts and write their notifications; returns the confirmed ids"""
+    table = PriceAlert.__table__
+    confirmed = set()
+    for i in range(0, len(alerts), ALERTS_DELIVERY_CHUNK):
+        chunk = alerts[i:i + ALERTS_DELIVERY_CHUNK]
+        result = db.execute(
+            update(table)
+            .where(table.c.id.in_([a["alert_id"] for a in chunk]), table.c.active.is_(True))
+            .values(active=table.c.repeat, last_triggered_at=now)
+            .returning(table.c.id)
+        )
+        confirmed.update(alert_id for (alert_id,) in result)
+    rows = [{**a, "created_at": now} for a in alerts if a["alert_id"] in confirmed]
+    for i in range(0, len(rows), ALERTS_DELIVERY_CHUNK):
+        db.execute(insert(AlertNotification), rows[i:i + ALERTS_DELIVERY_CHUNK])
+    db.commit()
+    return confirmed
+
+class AlertEngine:
+    def __init__(self):
+        self.book = AlertBook()
+        self.max_ids = [0] * SHARD_COUNT
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """Load alerts created since the last sync (everything on the first call)"""
+        def load(db):
+            shard_id = db.info["shard_id"]
+            return shard_id, db.query(
+                PriceAlert.id, PriceAlert.user_id, PriceAlert.portfolio_option_id,
+                PriceAlert.direction, PriceAlert.threshold, PriceAlert.repeat
+            ).filter(PriceAlert.id > self.max_ids[shard_id], PriceAlert.active.is_(True)).all()
+
+        for shard_id, rows in for_each_shard(load):
+            if not rows:
+                continue
+            ids, users, options, directions, thresholds, repeat = zip(*rows)
+            self.book.add(
+                options, [_DIRECTIONS[d] for d in directions], thresholds,
+                ids, [shard_id] * len(ids), users, [bool(r) for r in repeat]
+            )
+            self.max_ids[shard_id] = max(self.max_ids[shard_id], max(ids))
+
+    def evaluate(self, prices: np.ndarray) -> dict:
+        with self._lock:
+            start = time.perf_counter()
+            self.sync()
+            fired = self.book.detect(prices)
+            by_shard = self.book.triggered(fired)
+            confirmed = set()
+            if by_shard:
+                now = datetime.utcnow()
+                for shard_id, ids in for_each_shard(
+                    lambda db: (db.info["shard_id"], _deliver_shard(db, by_shard.get(db.info["shard_id"], []), now))
+                ):
+                    confirmed.update((shard_id, alert_id) for alert_id in ids)
+            self.book.settle(fired, confirmed)
+            return {
+                "active": len(self.book),
+                "fired": sum(len(alerts) for alerts in by_shard.values()),
+                "delivered": len(confirmed),
+                "seconds": round(time.perf_counter() - start, 4),
+            }
+
+alert_engine = AlertEngine()
+
+def evaluate_alerts() -> dict:
+    """Evaluate alerts against the current prices (called by the price job on the leader)"""
+    db = SessionLocal()
+    try:
+        prices = price_array(db)
+    finally:
+        db.close()
+    return alert_engine.evaluate(prices)
+
+def bench(alerts: int, symbols: int, ticks: int, volatility: float) -> dict:
+    """Detection + book maintenance on synthetic alerts (no database)"""
+    rng = np.random.default_rng(42)
+    prices = np.concatenate([[np.nan], rng.lognormal(6, 1.5, symbols)])
+    option_ids = rng.integers(1, symbols + 1, alerts)
+    directions = rng.integers(0, 2, alerts).astype(np.int8)
+    # Thresholds within +-20% of the current price, on the side that has not fired yet
+    offsets = rng.uniform(0.001, 0.2, alerts)
+    thresholds = prices[option_ids] * np.where(directions == ABOVE, 1 + offsets, 1 - offsets)
+
+    book = AlertBook()
+    start = time.perf_counter()
+    book.add(option_ids, directions, thresholds, np.arange(alerts), np.zeros(alerts), np.arange(alerts) % 100_000,
+             rng.random(alerts) < 0.2)
+    build = time.perf_counter() - start
+
+    book.detect(prices)
+    detect_ms, settle_ms, fired_counts = [], [], []
+    for _ in range(ticks):
+        prices = prices * (1 + rng.uniform(-volatility, volatility, len(prices)))
+        start = time.perf_counter()
+        fired = book.detect(prices)
+        detected = time.perf_counter()
+        book.settle(fired)
+        detect_ms.append((detected - start) * 1000)
+        settle_ms.append((time.perf_counter() - detected) * 1000)
+        fired_counts.append(sum(hi - lo for _, lo, hi, _ in fired))
+
+    # Reference: a vectorized scan of every alert on each tick
+    start = time.perf_counter()
+    previous = prices
+    moved = prices * (1 + rng.uniform(-volatility, volatility, len(prices)))
+    old, new = previous[option_ids], moved[option_ids]
+    ((directions == BELOW) & (new <= thresholds) & (thresholds < old)) | ((directions == ABOVE) & (old < thresholds) & (thresholds <= new))
+    scan = (time.perf_counter() - start) * 1000
+
+    return {
+        "alerts": alerts,
+        "symbols": symbols,
+        "build_seconds": round(build, 2),
+        "detect_ms": {
+            "p50": round(float(np.percentile(detect_ms, 50)), 2),
+            "p99": round(float(np.percentile(detect_ms, 99)), 2),
+        },
+        "settle_ms": {
+            "p50": round(float(np.percentile(settle_ms, 50)), 2),
+            "p99": round(float(np.percentile(settle_ms, 99)), 2),
+        },
+        "fired_per_tick": int(np.mean(fired_counts)),
+        "active_after": len(book),
+        "full_scan_ms": round(scan, 2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="time per-tick evaluation on synthetic alerts")
+    bench_parser.add_argument("--alerts", type=int, default=5_000_000)
+    bench_parser.add_argument("--symbols", type=int, default=2000)
+    bench_parser.add_argument("--ticks", type=int, default=50)
+    bench_parser.add_argument("--volatility", type=float, default=0.03, help="max relative price move per tick")
+    args = parser.parse_args()
+    print(json.dumps(bench(args.alerts, args.symbols, args.ticks, args.volatility), indent=2))
@@ -0,0 +1,268 @@
+"""
+Spending analytics from monthly rollups
+
+`spending_rollups` keeps one row per (user, month, category) with the
+transaction count, spend and round-ups. POST/DELETE /transaction update it
+in the same transaction as the row itself, so /analytics/spending never
+touches `transactions`. Archiving doesn't touch it either: rollups keep
+covering history that moved to cold storage.
+
+Categories come from keyword/prefix rules over the description: a rule
+keyword matches a word it equals or starts. Rules default to
+DEFAULT_CATEGORIES, or a JSON {category: [keywords]} file in
+ANALYTICS_CATEGORIES_FILE. Descriptions repeat a lot (merchant names), so
+matches are memoized.
+
+The backfill rebuilds a shard's rollups from its hot rows, streamed in id
+order in chunks, plus its users' archive files. Its progress is kept in
+`spending_backfills`: a row deleted while the backfill runs is subtracted
+only if it was already counted (streamed, or newer than the watermark).
+Archived copies of rows that are still hot (an archive run interrupted
+between writing the file and deleting the rows) are skipped.
+
+    python analytics.py backfill
+"""
+import argparse
+import bisect
+import json
+import os
+import re
+import time
+from datetime import datetime
+from functools import lru_cache
+
+from sqlalchemy import func, delete, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import for_each_shard, shard_for_user
+from models import Transaction, SpendingRollup, SpendingBackfill
+from archive import ARCHIVE_DIR, read_month
+
+ANALYTICS_CATEGORIES_FILE = os.getenv("ANALYTICS_CATEGORIES_FILE", "")
+ANALYTICS_BACKFILL_CHUNK = int(os.getenv("ANALYTICS_BACKFILL_CHUNK", "20000"))
+
+UNCATEGORIZED = "other"
+GROUPS = ("month", "category", "month_category")
+
+DEFAULT_CATEGORIES = {
+    "food": ["swiggy", "zomato", "restaurant", "cafe", "coffee", "pizza", "burger", "dominos", "starbucks", "lunch", "dinner", "food"],
+    "groceries": ["grocery", "groceries", "bigbasket", "blinkit", "zepto", "dmart", "supermarket", "kirana", "milk", "vegetable"],
+    "transport": ["uber", "ola", "rapido", "metro", "fuel", "petrol", "diesel", "parking", "toll", "irctc", "train", "bus", "cab", "taxi"],
+    "shopping": ["amazon", "flipkart", "myntra", "ajio", "nykaa", "meesho", "mall", "store", "shop"],
+    "bills": ["electricity", "recharge", "airtel", "jio", "vodafone", "broadband", "wifi", "gas", "water", "rent", "bill", "insurance"],
+    "entertainment": ["netflix", "spotify", "hotstar", "prime", "movie", "cinema", "pvr", "bookmyshow", "game", "concert"],
+    "health": ["pharmacy", "apollo", "medplus", "hospital", "clinic", "doctor", "medicine", "gym", "fitness"],
+    "travel": ["makemytrip", "goibibo", "hotel", "airbnb", "flight", "indigo", "airline", "trip", "oyo"],
+    "education": ["course", "udemy", "coursera", "book", "school", "college", "tuition", "fees"],
+}
+
+class CategoryMatcher:
+    """First matching rule wins, in rule order; a keyword matches a word it equals or prefixes"""
+
+    _words = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, rules: dict):
+        self.categories = list(rules)
+        # (keyword, rule index), sorted so prefix candidates are one bisect away
+        self._keywords = sorted(
+            (keyword.lower(), i) for i, keywords in enumerate(rules.values()) for keyword in keywords
+        )
+        self._sorted = [keyword for keyword, _ in self._keywords]
+        self.match = lru_cache(maxsize=65536)(self._match)
+
+    def _rule_for(self, word: str) -> int:
+        """Lowest rule index with a keyword that is a prefix of `word` (or len(categories))"""
+        best = len(self.categories)
+        # Prefixes of `word` sort at or before it; walk back while they still share its first letter
+        i = bisect.bisect_right(self._sorted, word) - 1
+        while i >= 0 and self._sorted[i][:1] == word[:1]:
+            keyword, rule = self._keywords[i]
+            if word.startswith(keyword):
+                best = min(best, rule)
+            i -= 1
+        return best
+
+    def _match(self, description: str) -> str:
+        if not description:
+            return UNCATEGORIZED
+        rule = min((self._rule_for(w) for w in self._words.findall(description.lower())), default=len(self.categories))
+        return self.categories[rule] if rule < len(self.categories) else UNCATEGORIZED
+
+def _load_rules() -> dict:
+    if ANALYTICS_CATEGORIES_FILE:
+        with open(ANALYTICS_CATEGORIES_FILE) as f:
+            return json.load(f)
+    return DEFAULT_CATEGORIES
+
+matcher = CategoryMatcher(_load_rules())
+
+def categorize(description: str) -> str:
+    return matcher.match(description or "")
+
+# Incremental maintenance
+
+def _accumulate(totals: dict, user_id: int, created_at, amount: float, roundup: float, description: str, sign: int = 1):
+    key = (user_id, created_at.strftime("%Y-%m"), categorize(description))
+    count, spent, roundups = totals.get(key, (0, 0.0, 0.0))
+    totals[key] = (count + sign, spent + sign * amount, roundups + sign * roundup)
+
+def _upsert(db, totals: dict):
+    """Add the (count, amount, roundups) deltas to their rollup rows, creating missing ones"""
+    if not totals:
+        return
+    table = SpendingRollup.__table__
+    dialect = db.get_bind(clause=table.insert()).dialect.name
+    statement = (postgresql_insert if dialect == "postgresql" else sqlite_insert)(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.month, table.c.category],
+        set_={
+            "transaction_count": table.c.transaction_count + statement.excluded.transaction_count,
+            "amount_total": table.c.amount_total + statement.excluded.amount_total,
+            "roundup_total": table.c.roundup_total + statement.excluded.roundup_total,
+        }
+    )
+    db.execute(statement, [
+        {
+            "user_id": user_id, "month": month, "category": category,
+            "transaction_count": count, "amount_total": amount, "roundup_total": roundups,
+        }
+        for (user_id, month, category), (count, amount, roundups) in totals.items()
+    ])
+
+def record_transactions(db, transactions: list, sign: int = 1):
+    """
+    Apply inserted (sign=1) or deleted (sign=-1) transactions to the rollups
+
+    Call before committing the change itself; rows must be flushed (created_at set).
+    """
+    if sign < 0:
+        transactions = _counted(db, transactions)
+    totals = {}
+    for t in transactions:
+        _accumulate(totals, t.user_id, t.created_at, t.amount, t.roundup_amount, t.description, sign)
+    _upsert(db, totals)
+
+def _counted(db, transactions: list) -> list:
+    """The transactions already in the rollups: all of them, unless a backfill hasn't streamed them yet"""
+    progress = db.query(SpendingBackfill.watermark, SpendingBackfill.streamed_through).filter(
+        SpendingBackfill.id == 1, SpendingBackfill.finished_at.is_(None)
+    ).with_for_update().first()
+    if progress is None:
+        return transactions
+    watermark, streamed_through = progress
+    return [t for t in transactions if not streamed_through < t.id <= watermark]
+
+# Reading
+
+def spending(db, user_id: int, from_month: str = None, to_month: str = None, group: str = "month") -> list:
+    """Rollup totals for months in [from_month, to_month] (YYYY-MM), grouped by month, category or both"""
+    columns = {
+        "month": [SpendingRollup.month],
+        "category": [SpendingRollup.category],
+        "month_category": [SpendingRollup.month, SpendingRollup.category],
+    }[group]
+    query = db.query(
+        *columns,
+        func.sum(SpendingRollup.transaction_count),
+        func.sum(SpendingRollup.amount_total),
+        func.sum(SpendingRollup.roundup_total)
+    ).filter(SpendingRollup.user_id == user_id)
+    if from_month:
+        query = query.filter(SpendingRollup.month >= from_month)
+    if to_month:
+        query = query.filter(SpendingRollup.month <= to_month)
+    rows = query.group_by(*columns).order_by(*columns).all()
+
+    result = []
+    for row in rows:
+        keys, (count, amount, roundups) = row[:len(columns)], row[len(columns):]
+        if not count:
+            continue
+        entry = dict(zip([c.key for c in columns], keys))
+        entry.update({"transaction_count": int(count), "amount": round(amount, 2), "roundups": round(roundups, 2)})
+        result.append(entry)
+    return result
+
+# Backfill
+
+def _archived_totals(db, shard_id: int, archive_dir: str) -> dict:
+    totals = {}
+    directory = os.path.join(archive_dir, Transaction.__tablename__)
+    if not os.path.isdir(directory):
+        return totals
+    for user_dir in os.listdir(directory):
+        if not user_dir.isdigit() or shard_for_user(int(user_dir)) != shard_id:
+            continue
+        rows = []
+        for name in os.listdir(os.path.join(directory, user_dir)):
+            if name.endswith(".ndjson.gz"):
+                rows += read_month(os.path.join(directory, user_dir, name))
+        # Still hot (the archive run stopped before deleting them): counted by the stream
+        hot = {i for (i,) in db.query(Transaction.id).filter(
+            Transaction.user_id == int(user_dir), Transaction.id.in_([row["id"] for row in rows])
+        )} if rows else set()
+        for row in rows:
+            if row["id"] not in hot:
+                _accumulate(totals, row["user_id"], row["created_at"], row["amount"], row["roundup_amount"], row["description"])
+    return totals
+
+def backfill_shard(db, archive_dir: str = ARCHIVE_DIR) -> dict:
+    """
+    Rebuild this shard's rollups
+
+    Clearing the rollups, reading the id watermark and resetting the
+    progress row commit together; transactions written after that are
+    counted by the live path, older ones by this stream.
+    """
+    start = time.perf_counter()
+    shard_id = db.info.get("shard_id", 0)
+    progress = SpendingBackfill.__table__
+    db.execute(delete(SpendingRollup.__table__))
+    watermark = db.query(func.coalesce(func.max(Transaction.id), 0)).scalar()
+    db.merge(SpendingBackfill(id=1, watermark=watermark, streamed_through=0, started_at=datetime.utcnow(), finished_at=None))
+    db.commit()
+
+    rows, last_id = 0, 0
+    while last_id < watermark:
+        # Write the progress row first: a concurrent delete either commits
+        # before this chunk is read or runs after it and sees the new progress
+        db.execute(update(progress).where(progress.c.id == 1).values(streamed_through=last_id))
+        chunk = db.query(
+            Transaction.id, Transaction.user_id, Transaction.created_at,
+            Transaction.amount, Transaction.roundup_amount, Transaction.description
+        ).filter(Transaction.id > last_id, Transaction.id <= watermark).order_by(Transaction.id).limit(ANALYTICS_BACKFILL_CHUNK).all()
+        if not chunk:
+            break
+        totals = {}
+        for _, user_id, created_at, amount, roundup, description in chunk:
+            _accumulate(totals, user_id, created_at, amount, roundup, description)
+        _upsert(db, totals)
+        last_id = chunk[-1][0]
+        db.execute(update(progress).where(progress.c.id == 1).values(streamed_through=last_id))
+        db.commit()
+        rows += len(chunk)
+
+    archived = _archived_totals(db, shard_id, archive_dir)
+    _upsert(db, archived)
+    db.execute(update(progress).where(progress.c.id == 1).values(finished_at=datetime.utcnow()))
+    db.commit()
+    return {
+        "shard": shard_id,
+        "transactions": rows,
+        "archived_rollups": len(archived),
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+
+def run_backfill(archive_dir: str = ARCHIVE_DIR) -> list:
+    return for_each_shard(lambda db: backfill_shard(db, archive_dir))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backfill", help="rebuild every shard's rollups from hot and archived transactions")
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+    print(json.dumps(run_backfill(), indent=2))
@@ -0,0 +1,368 @@
+"""
+Hot/cold tiering for per-user history
+
+Rows of `transactions`, `investments` and `money_transfers` older than the
+archive horizon are moved out of the hot tables into gzip-compressed NDJSON
+files, one append-only file per (table, user, month):
+
+    {ARCHIVE_DIR}/{table}/{user_id}/{YYYY-MM}.ndjson.gz
+
+Per-user aggregates stay intact:
+- transaction count and round-up totals are carried in `user_archive_totals`
+- archived investment lots are folded into one consolidated lot per
+  (user, option, funding source), so holdings, cost basis and the
+  round-up/wallet split are unchanged
+
+History endpoints page past the hot window into the archive via `page_history`.
+
+    python archive.py run --horizon-days 365
+    python archive.py bench --rows 1000000
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, insert, create_engine, text
+from sqlalchemy.orm import Session
+
+from database import Base, for_each_shard
+from models import Transaction, Investment, MoneyTransfer, UserArchiveTotals
+from aggregates import is_roundup_payment, transaction_totals
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_HORIZON_DAYS = int(os.getenv("ARCHIVE_HORIZON_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = 5000
+
+# Suffix of the consolidated lots that replace archived investments
+ARCHIVED_SUFFIX = "_ARCHIVED"
+
+ARCHIVED_MODELS = [Transaction, Investment, MoneyTransfer]
+
+def _archive_path(archive_dir: str, table: str, user_id: int, month: str) -> str:
+    return os.path.join(archive_dir, table, str(user_id), f"{month}.ndjson.gz")
+
+def _serialize(row) -> dict:
+    data = {}
+    for column in row.__table__.columns:
+        value = getattr(row, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif hasattr(value, "value"):
+            value = value.value
+        data[column.key] = value
+    return data
+
+def _append(path: str, rows: list) -> list:
+    """Append rows as a new gzip member and fsync the file; returns directories whose entries changed"""
+    directory = os.path.dirname(path)
+    changed = [directory]
+    # Directories created here must reach disk in their parents too
+    missing = directory
+    while not os.path.isdir(missing):
+        missing = os.path.dirname(missing) or "."
+        changed.append(missing)
+    os.makedirs(directory, exist_ok=True)
+    # Appending starts a new gzip member; readers see one concatenated stream
+    data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+    with open(path, "ab") as f:
+        f.write(gzip.compress(data.encode("utf-8")))
+        f.flush()
+        os.fsync(f.fileno())
+    return changed
+
+def _fsync_directory(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def not_consolidated():
+    """Filter excluding the consolidated lots that replace archived investments"""
+    return or_(
+        Investment.payment_id.is_(None),
+        ~Investment.payment_id.endswith(ARCHIVED_SUFFIX, autoescape=True)
+    )
+
+def _old_rows(db: Session, model, cutoff: datetime, after_id: int) -> list:
+    query = db.query(model).filter(model.id > after_id, model.created_at < cutoff)
+    if model is Investment:
+        query = query.filter(not_consolidated())
+    return query.order_by(model.id).limit(ARCHIVE_BATCH_SIZE).all()
+
+def _fold_transactions(db: Session, by_user: dict, cutoff: datetime):
+    existing = {
+        t.user_id: t for t in
+        db.query(UserArchiveTotals).filter(UserArchiveTotals.user_id.in_(list(by_user)))
+    }
+    for user_id, rows in by_user.items():
+        totals = existing.get(user_id)
+        if not totals:
+            totals = UserArchiveTotals(user_id=user_id, transaction_count=0, roundup_total=0.0)
+            db.add(totals)
+        totals.transaction_count += len(rows)
+        totals.roundup_total += sum(r.roundup_amount for r in rows)
+        totals.archived_through = cutoff
+
+def _fold_investments(db: Session, by_user: dict):
+    payment_ids = [f"ROUNDUP{ARCHIVED_SUFFIX}", f"WALLET{ARCHIVED_SUFFIX}"]
+    existing = {
+        (inv.user_id, inv.portfolio_option_id, inv.payment_id): inv for inv in
+        db.query(Investment).filter(
+            Investment.user_id.in_(list(by_user)),
+            Investment.payment_id.in_(payment_ids)
+        )
+    }
+    for user_id, rows in by_user.items():
+        for inv in rows:
+            source = "ROUNDUP" if is_roundup_payment(inv.payment_id) else "WALLET"
+            key = (user_id, inv.portfolio_option_id, f"{source}{ARCHIVED_SUFFIX}")
+            consolidated = existing.get(key)
+            if not consolidated:
+                consolidated = Investment(
+                    user_id=user_id,
+                    portfolio_option_id=inv.portfolio_option_id,
+                    amount=0.0,
+                    units=0.0,
+                    is_auto_recommended=False,
+                    payment_id=key[2],
+                    created_at=inv.created_at
+                )
+                db.add(consolidated)
+                existing[key] = consolidated
+            consolidated.amount += inv.amount
+            consolidated.units += inv.units
+            consolidated.created_at = min(consolidated.created_at, inv.created_at)
+
+def _archive_batch(db: Session, model, rows: list, cutoff: datetime, archive_dir: str):
+    table = model.__tablename__
+    by_user = defaultdict(list)
+    for row in rows:
+        by_user[row.user_id].append(row)
+
+    # Files are written before the delete commits; a crash in between
+    # leaves duplicates that the reader drops by id.
+    directories = set()
+    for user_id, user_rows in by_user.items():
+        by_month = defaultdict(list)
+        for row in user_rows:
+            by_month[row.created_at.strftime("%Y-%m")].append(_serialize(row))
+        for month, records in by_month.items():
+            directories.update(_append(_archive_path(archive_dir, table, user_id, month), records))
+    # Files are synced as they're written; their directory entries before the hot rows are deleted
+    for directory in directories:
+        _fsync_directory(directory)
+
+    if model is Transaction:
+        _fold_transactions(db, by_user, cutoff)
+    elif model is Investment:
+        _fold_investments(db, by_user)
+
+    db.flush()
+    db.query(model).filter(model.id.in_([r.id for r in rows])).delete(synchronize_session=False)
+    db.commit()
+    db.expunge_all()
+    return by_user.keys()
+
+def archive_history(db: Session, horizon_days: int = ARCHIVE_HORIZON_DAYS, archive_dir: str = ARCHIVE_DIR) -> dict:
+    """
+    Archive every row older than the horizon in this session's shard
+
+    Walks each table in primary-key order in batches, committing per batch,
+    so it is safe to re-run after a crash.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=horizon_days)
+    moved = {}
+    users = set()
+    for model in ARCHIVED_MODELS:
+        moved[model.__tablename__] = 0
+        last_id = 0
+        while True:
+            rows = _old_rows(db, model, cutoff, last_id)
+            if not rows:
+                break
+            last_id = rows[-1].id
+            users.update(_archive_batch(db, model, rows, cutoff, archive_dir))
+            moved[model.__tablename__] += len(rows)
+    return dict(moved, users=len(users))
+
+def run_archive(horizon_days: int = ARCHIVE_HORIZON_DAYS) -> list:
+    """Archive all shards in parallel"""
+    return for_each_shard(lambda db: archive_history(db, horizon_days))
+
+# Reading
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(created_at), int(row_id)
+
+def has_archive(user_id: int, table: str, archive_dir: str = ARCHIVE_DIR) -> bool:
+    return os.path.isdir(os.path.join(archive_dir, table, str(user_id)))
+
+def read_month(path: str) -> list:
+    rows = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+            rows[row["id"]] = row
+    return list(rows.values())
+
+def read_archive(user_id: int, table: str, before: tuple = None, limit: int = 50, archive_dir: str = ARCHIVE_DIR) -> list:
+    """
+    Archived rows for a user, newest first
+
+    Args:
+        before: (created_at, id) position; only older rows are returned
+        limit: Maximum number of rows
+    """
+    directory = os.path.join(archive_dir, table, str(user_id))
+    if not os.path.isdir(directory):
+        return []
+
+    months = sorted((f[:7] for f in os.listdir(directory) if f.endswith(".ndjson.gz")), reverse=True)
+    result = []
+    for month in months:
+        if before and month > before[0].strftime("%Y-%m"):
+            continue
+        rows = read_month(os.path.join(directory, f"{month}.ndjson.gz"))
+        if before:
+            rows = [r for r in rows if (r["created_at"], r["id"]) < before]
+        rows.sort(key=lambda r: (r["created_at"], r["id"]), reverse=True)
+        result.extend(rows)
+        # Months are disjoint, so once a month fills the page we can stop
+        if len(result) >= limit:
+            break
+    return result[:limit]
+
+def page_history(db: Session, model, user_id: int, limit: int, cursor: str = None, extra_filter=None, columns=None) -> tuple:
+    """
+    One page of a user's history, newest first, continuing into the archive
+    once the hot rows are exhausted
+
+    Args:
+        columns: Select these columns (must include id and created_at) instead of whole objects
+
+    Returns:
+        (rows, next_cursor) - rows are ORM objects or column rows (hot) or dicts (archive)
+    """
+    query = (db.query(*columns) if columns else db.query(model)).filter(model.user_id == user_id)
+    if extra_filter is not None:
+        query = query.filter(extra_filter)
+    before = decode_cursor(cursor) if cursor else None
+    if before:
+        query = query.filter(or_(
+            model.created_at < before[0],
+            and_(model.created_at == before[0], model.id < before[1])
+        ))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit).all()
+
+    if len(rows) < limit:
+        if rows:
+            before = (rows[-1].created_at, rows[-1].id)
+        rows = rows + read_archive(user_id, model.__tablename__, before, limit - len(rows))
+
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        if isinstance(last, dict):
+            next_cursor = encode_cursor(last["created_at"], last["id"])
+        else:
+            next_cursor = encode_cursor(last.created_at, last.id)
+    return rows, next_cursor
+
+# Benchmark
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def _measure(engine, users: int, probes: int) -> dict:
+    with engine.connect() as conn:
+        hot_rows = conn.execute(text("SELECT COUNT(*) FROM transactions")).scalar()
+        conn.execute(text("VACUUM"))
+    size = os.path.getsize(engine.url.database)
+
+    latencies = []
+    db = Session(bind=engine)
+    for _ in range(probes):
+        user_id = random.randint(1, users)
+        start = time.perf_counter()
+        transaction_totals(db, user_id)
+        page_history(db, Transaction, user_id, limit=50)
+        latencies.append((time.perf_counter() - start) * 1000)
+    db.close()
+    return {
+        "hot_transactions": hot_rows,
+        "db_bytes": size,
+        "p50_ms": round(_percentile(latencies, 0.50), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+    }
+
+def bench(rows: int, users: int, horizon_days: int, probes: int) -> dict:
+    random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        tables = [m.__table__ for m in ARCHIVED_MODELS] + [UserArchiveTotals.__table__]
+        Base.metadata.create_all(bind=engine, tables=tables)
+
+        now = datetime.utcnow()
+        batch = 100_000
+        with engine.begin() as conn:
+            for start in range(0, rows, batch):
+                conn.execute(insert(Transaction.__table__), [
+                    {
+                        "user_id": random.randint(1, users),
+                        "amount": 100.0,
+                        "roundup_amount": 0.5,
+                        "description": "bench",
+                        "created_at": now - timedelta(days=random.random() * 5 * 365),
+                    }
+                    for _ in range(min(batch, rows - start))
+                ])
+
+        before = _measure(engine, users, probes)
+        start = time.perf_counter()
+        db = Session(bind=engine)
+        moved = archive_history(db, horizon_days, os.path.join(directory, "archive"))
+        db.close()
+        archive_seconds = time.perf_counter() - start
+        after = _measure(engine, users, probes)
+        engine.dispose()
+
+    return {
+        "rows": rows,
+        "horizon_days": horizon_days,
+        "archived": moved,
+        "archive_seconds": round(archive_seconds, 2),
+        "before": before,
+        "after": after,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="archive all shards")
+    run_parser.add_argument("--horizon-days", type=int, default=ARCHIVE_HORIZON_DAYS)
+    bench_parser = sub.add_parser("bench", help="hot-table size and latency before/after archiving")
+    bench_parser.add_argument("--rows", type=int, default=1_000_000)
+    bench_parser.add_argument("--users", type=int, default=10_000)
+    bench_parser.add_argument("--horizon-days", type=int, default=90)
+    bench_parser.add_argument("--probes", type=int, default=500)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        print(json.dumps(run_archive(args.horizon_days)))
+    else:
+        print(json.dumps(bench(args.rows, args.users, args.horizon_days, args.probes), indent=2))
@@ -0,0 +1,324 @@
+"""
+Round-up strategy backtests
+
+Replays a contribution stream against daily closes from `price_history`.
+The stream is either the user's own round-ups (hot and archived
+transactions) or a synthetic fixed amount per day. Each strategy is a set
+of target weights over portfolio options, and every contribution is split
+by those weights at that day's close.
+
+The replay has no per-day Python loop. A strategy's units in an option are
+its weight times one cumsum of contribution / close over the day axis,
+shared by all strategies, so daily values for every strategy are a single
+(multithreaded BLAS) matrix product. Results are cached per (user,
+strategy, date range, stream) for BACKTEST_CACHE_SECONDS.
+
+    python backtest.py load prices.csv      # symbol,day,close
+    python backtest.py bench [--days 1250] [--options 50] [--strategies 256]
+"""
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+
+import numpy as np
+from sqlalchemy import func, insert, delete, tuple_
+
+from models import Transaction, PortfolioOption, PriceHistory
+from archive import read_archive, has_archive
+
+BACKTEST_MAX_STRATEGIES = int(os.getenv("BACKTEST_MAX_STRATEGIES", "50"))
+BACKTEST_DEFAULT_DAYS = int(os.getenv("BACKTEST_DEFAULT_DAYS", "365"))
+BACKTEST_CACHE_SECONDS = float(os.getenv("BACKTEST_CACHE_SECONDS", "600"))
+BACKTEST_CACHE_SIZE = int(os.getenv("BACKTEST_CACHE_SIZE", "10000"))
+BACKTEST_MAX_POINTS = 120
+
+class BacktestError(ValueError):
+    pass
+
+# Replay
+
+def simulate(contributions: np.ndarray, prices: np.ndarray, weights: np.ndarray) -> tuple:
+    """
+    Replay contributions for every strategy at once
+
+    Args:
+        contributions: (days,) amount invested at each day's close
+        prices: (days, options) closes, no NaN
+        weights: (strategies, options), rows summing to 1
+
+    Returns:
+        (values, drawdowns): (strategies, days) portfolio value, and the
+        max drawdown of each strategy's time-weighted return
+    """
+    # Units of option o held by strategy s on day d are w[s, o] * unit_paths[d, o]
+    unit_paths = np.cumsum(contributions[:, None] / prices, axis=0)
+    values = weights @ (unit_paths * prices).T
+
+    # Day-over-day return excluding that day's contribution
+    held = weights @ (unit_paths[:-1] * prices[1:]).T
+    previous = values[:, :-1]
+    returns = np.divide(held, previous, out=np.ones_like(held), where=previous > 0)
+    nav = np.concatenate([np.ones((len(weights), 1)), np.cumprod(returns, axis=1)], axis=1)
+    drawdowns = (1 - nav / np.maximum.accumulate(nav, axis=1)).max(axis=1)
+    return values, drawdowns
+
+# Inputs
+
+def history_bounds(db) -> tuple:
+    return db.query(func.min(PriceHistory.day), func.max(PriceHistory.day)).one()
+
+def forward_fill(prices: np.ndarray) -> np.ndarray:
+    """Each NaN takes the last close above it in its column (leading NaNs stay)"""
+    filled = np.where(np.isnan(prices), 0, np.arange(len(prices))[:, None])
+    return prices[np.maximum.accumulate(filled, axis=0), np.arange(prices.shape[1])]
+
+def _price_matrix(db, option_ids: list, start: date, end: date) -> tuple:
+    """(days, prices) over the range, forward-filled, starting once every option has a close"""
+    rows = db.query(PriceHistory.day, PriceHistory.portfolio_option_id, PriceHistory.close).filter(
+        PriceHistory.portfolio_option_id.in_(option_ids),
+        PriceHistory.day >= start,
+        PriceHistory.day <= end
+    ).all()
+    if not rows:
+        raise BacktestError("No price history for this range")
+    days = sorted({day for day, _, _ in rows})
+    day_index = {day: i for i, day in enumerate(days)}
+    column = {option_id: i for i, option_id in enumerate(option_ids)}
+    prices = np.full((len(days), len(option_ids)), np.nan)
+    for day, option_id, close in rows:
+        prices[day_index[day], column[option_id]] = close
+
+    prices = forward_fill(prices)
+    complete = np.flatnonzero(~np.isnan(prices).any(axis=1))
+    if not len(complete):
+        raise BacktestError("Price history does not cover all options in this range")
+    return days[complete[0]:], prices[complete[0]:]
+
+def _roundups(db, user_id: int, start: date, end: date) -> list:
+    """(created_at, roundup_amount) of the user's transactions in the range, hot and archived"""
+    lo = datetime.combine(start, datetime.min.time())
+    hi = datetime.combine(end + timedelta(days=1), datetime.min.time())
+    stream = db.query(Transaction.created_at, Transaction.roundup_amount).filter(
+        Transaction.user_id == user_id,
+        Transaction.created_at >= lo,
+        Transaction.created_at < hi
+    ).all()
+    if has_archive(user_id, "transactions"):
+        seen = {row_id for (row_id,) in db.query(Transaction.id).filter(Transaction.user_id == user_id)}
+        for row in read_archive(user_id, "transactions", before=(hi, 0), limit=10 ** 9):
+            if row["created_at"] >= lo and row["id"] not in seen:
+                stream.append((row["created_at"], row["roundup_amount"]))
+    return stream
+
+def _contributions(days: list, stream: list) -> np.ndarray:
+    """Amounts per price day; a contribution made on a non-trading day buys at the next close"""
+    contributions = np.zeros(len(days))
+    if stream:
+        ordinals = np.array([d.toordinal() for d in days])
+        at = np.searchsorted(ordinals, [created_at.date().toordinal() for created_at, _ in stream])
+        in_range = at < len(days)
+        np.add.at(contributions, at[in_range], np.array([amount for _, amount in stream])[in_range])
+    return contributions
+
+def _downsample(n: int) -> np.ndarray:
+    if n <= BACKTEST_MAX_POINTS:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, BACKTEST_MAX_POINTS).round().astype(int))
+
+# Cache
+
+class _ResultCache:
+    """LRU of strategy results with a TTL"""
+
+    def __init__(self, size: int = BACKTEST_CACHE_SIZE, ttl: float = BACKTEST_CACHE_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+_cache = _ResultCache()
+
+def _strategy_key(weights: dict) -> tuple:
+    total = sum(weights.values())
+    return tuple(sorted((int(o), round(w / total, 6)) for o, w in weights.items()))
+
+# Entry point
+
+def run_backtest(db, user_id: int, strategies: list, start: date = None, end: date = None, daily_amount: float = None) -> dict:
+    """
+    Backtest strategies over [start, end]
+
+    Args:
+        strategies: [{"name": str | None, "weights": {option_id: weight}}]
+        start, end: Defaults to the BACKTEST_DEFAULT_DAYS ending at the last close
+        daily_amount: Synthetic stream of this amount per price day instead of the user's round-ups
+    """
+    if not strategies or len(strategies) > BACKTEST_MAX_STRATEGIES:
+        raise BacktestError(f"Between 1 and {BACKTEST_MAX_STRATEGIES} strategies are allowed")
+    for strategy in strategies:
+        weights = strategy["weights"]
+        if not weights or any(w < 0 for w in weights.values()) or sum(weights.values()) <= 0:
+            raise BacktestError("Each strategy needs non-negative weights with a positive sum")
+    option_ids = sorted({int(o) for s in strategies for o, w in s["weights"].items() if w > 0})
+    known = {option_id for (option_id,) in db.query(PortfolioOption.id).filter(PortfolioOption.id.in_(option_ids))}
+    if len(known) != len(option_ids):
+        raise BacktestError(f"Unknown portfolio options: {sorted(set(option_ids) - known)}")
+
+    first, last = history_bounds(db)
+    if last is None:
+        raise BacktestError("No price history recorded yet")
+    end = min(end or last, last)
+    start = start or end - timedelta(days=BACKTEST_DEFAULT_DAYS)
+    if start >= end:
+        raise BacktestError("start must be before end")
+
+    stream_key = ("synthetic", daily_amount) if daily_amount is not None else ("roundups", user_id)
+    keys = [(stream_key, _strategy_key(s["weights"]), start, end) for s in strategies]
+    results = [_cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    if missing:
+        days, prices = _price_matrix(db, option_ids, start, end)
+        if daily_amount is not None:
+            contributions = np.full(len(days), float(daily_amount))
+        else:
+            contributions = _contributions(days, _roundups(db, user_id, days[0], days[-1]))
+        column = {option_id: i for i, option_id in enumerate(option_ids)}
+        weights = np.zeros((len(missing), len(option_ids)))
+        for row, i in enumerate(missing):
+            for option_id, weight in strategies[i]["weights"].items():
+                if weight > 0:
+                    weights[row, column[int(option_id)]] = weight
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        values, drawdowns = simulate(contributions, prices, weights)
+        invested = np.cumsum(contributions)
+        points = _downsample(len(days))
+        for row, i in enumerate(missing):
+            final_value, total = float(values[row, -1]), float(invested[-1])
+            results[i] = {
+                "weights": {option_id: round(float(w), 6) for option_id, w in zip(option_ids, weights[row]) if w > 0},
+                "start": days[0],
+                "end": days[-1],
+                "invested": round(total, 2),
+                "final_value": round(final_value, 2),
+                "profit_loss": round(final_value - total, 2),
+                "return_percentage": round((final_value / total - 1) * 100, 2) if total > 0 else 0.0,
+                "max_drawdown_percentage": round(float(drawdowns[row]) * 100, 2),
+                "points": [
+                    {"day": days[p], "invested": round(float(invested[p]), 2), "value": round(float(values[row, p]), 2)}
+                    for p in points
+                ],
+            }
+            _cache.put(keys[i], results[i])
+
+    return {
+        "results": [dict(result, name=s.get("name") or f"Strategy {n + 1}") for n, (s, result) in enumerate(zip(strategies, results))],
+        "cached": len(strategies) - len(missing),
+    }
+
+# Price history loading
+
+def load_price_history(db, path: str) -> int:
+    """Upsert closes from a symbol,day,close CSV; returns rows written"""
+    symbols = dict(db.query(PortfolioOption.symbol, PortfolioOption.id))
+    rows, unknown = {}, set()
+    with open(path, newline="") as f:
+        for record in csv.DictReader(f):
+            option_id = symbols.get(record["symbol"])
+            if option_id is None:
+                unknown.add(record["symbol"])
+                continue
+            day = date.fromisoformat(record["day"])
+            rows[(option_id, day)] = {"portfolio_option_id": option_id, "day": day, "close": float(record["close"])}
+    if unknown:
+        print(f"Skipped {len(unknown)} unknown symbols: {', '.join(sorted(unknown)[:10])}")
+
+    table = PriceHistory.__table__
+    rows = list(rows.values())
+    for i in range(0, len(rows), 5000):
+        chunk = rows[i:i + 5000]
+        db.execute(delete(table).where(tuple_(table.c.portfolio_option_id, table.c.day).in_(
+            [(r["portfolio_option_id"], r["day"]) for r in chunk]
+        )))
+        db.execute(insert(table), chunk)
+    db.commit()
+    return len(rows)
+
+# Benchmark
+
+def _loop_simulate(contributions: np.ndarray, prices: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Per-day Python replay, for comparison"""
+    values = np.zeros((len(weights), len(contributions)))
+    for s, w in enumerate(weights):
+        units = np.zeros(prices.shape[1])
+        for d in range(len(contributions)):
+            for o in range(prices.shape[1]):
+                units[o] += contributions[d] * w[o] / prices[d, o]
+            values[s, d] = float(units @ prices[d])
+    return values
+
+def bench(days: int, options: int, strategies: int) -> dict:
+    rng = np.random.default_rng(0)
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, (days, options)), axis=0))
+    contributions = rng.uniform(0, 5, days)
+    weights = rng.dirichlet(np.ones(options) * 0.3, strategies)
+
+    def timed(fn):
+        start = time.perf_counter()
+        result = fn()
+        return result, round((time.perf_counter() - start) * 1000, 2)
+
+    (values, _), vectorized_ms = timed(lambda: simulate(contributions, prices, weights))
+    loop_strategies = max(1, strategies // 32)
+    looped, loop_ms = timed(lambda: _loop_simulate(contributions, prices, weights[:loop_strategies]))
+    return {
+        "days": days,
+        "options": options,
+        "strategies": strategies,
+        "vectorized_ms": vectorized_ms,
+        "python_loop_ms_extrapolated": round(loop_ms * strategies / loop_strategies, 1),
+        "max_abs_error": float(np.abs(values[:loop_strategies] - looped).max()),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("load", help="upsert daily closes from a symbol,day,close CSV")
+    load.add_argument("path")
+    bench_args = commands.add_parser("bench", help="time the replay on synthetic prices")
+    bench_args.add_argument("--days", type=int, default=1250)
+    bench_args.add_argument("--options", type=int, default=50)
+    bench_args.add_argument("--strategies", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.command == "load":
+        from database import SessionLocal, init_db
+        init_db()
+        db = SessionLocal()
+        try:
+            print(f"Loaded {load_price_history(db, args.path)} closes")
+        finally:
+            db.close()
+    else:
+        print(json.dumps(bench(args.days, args.options, args.strategies), indent=2))
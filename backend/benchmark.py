@@ -0,0 +1,317 @@
+"""
+End-to-end API benchmark
+
+Drives the API through a set of scenarios at a fixed concurrency and
+reports per-endpoint latency percentiles, throughput and (in-process) DB
+statements per request as JSON.
+
+Scenarios:
+- signup_login: POST /signup, POST /login
+- transactions: POST /transaction
+- dashboard: GET /dashboard, /wallet, /transactions?limit=50
+- portfolio: GET /investments/detailed, /portfolio
+- transfers: POST /transfer
+- invest_roundups: POST /invest-roundups
+
+By default the app runs in-process (ASGI transport) against a throwaway
+database seeded directly with --users users and --transactions each.
+SQLAlchemy cursor events count the statements behind every request. With
+--url it runs against a live server instead, seeding through the API.
+Statement counts aren't available there, and transfers are skipped
+because wallets can only be funded through the payment gateway.
+
+    python benchmark.py --requests 500 --concurrency 8 --out run.json
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.2
+    python benchmark.py --url http://localhost:8000 --scenarios dashboard,portfolio
+
+With --baseline, an endpoint regresses when its p95 grows by more than
+--tolerance (and by at least --min-delta-ms), or when it issues more
+statements per request. A scenario regresses when its throughput drops by
+more than --tolerance. Any regression makes the exit status 1.
+
+In-process runs go through the app's startup and shutdown handlers but
+stop the scheduler, so background jobs don't skew the measurements.
+
+Keep in-process --concurrency at or below the connection pool size (8):
+the endpoints check out connections on the event loop.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+MERCHANTS = ["Swiggy order", "Uber ride", "Amazon.in", "BigBasket", "Netflix", "HP petrol", "Cafe Coffee Day", "Airtel recharge"]
+SCENARIOS = ["signup_login", "transactions", "dashboard", "portfolio", "transfers", "invest_roundups"]
+STARTING_BALANCE = 1_000_000.0
+PASSWORD = "benchmark"
+
+# Statement counter of the request in flight (a list, so worker threads
+# running sync dependencies share it through their copied context)
+_statements = contextvars.ContextVar("benchmark_statements", default=None)
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _statements.get()
+    if counter is not None:
+        counter[0] += 1
+
+def _operations(scenario: str, n: int, user: dict, run_id: str) -> list:
+    """(endpoint label, method, path, request kwargs) for operation n of a scenario"""
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    if scenario == "signup_login":
+        credentials = {"email": f"signup_{run_id}_{n}@example.com", "password": PASSWORD}
+        return [
+            ("POST /signup", "POST", "/signup", {"json": credentials}),
+            ("POST /login", "POST", "/login", {"json": credentials}),
+        ]
+    if scenario == "transactions":
+        return [("POST /transaction", "POST", "/transaction", {"headers": headers, "json": {
+            "amount": round(random.uniform(10, 2000), 2), "description": random.choice(MERCHANTS)
+        }})]
+    if scenario == "dashboard":
+        return [
+            ("GET /dashboard", "GET", "/dashboard", {"headers": headers}),
+            ("GET /wallet", "GET", "/wallet", {"headers": headers}),
+            ("GET /transactions", "GET", "/transactions?limit=50", {"headers": headers}),
+        ]
+    if scenario == "portfolio":
+        return [
+            ("GET /investments/detailed", "GET", "/investments/detailed", {"headers": headers}),
+            ("GET /portfolio", "GET", "/portfolio", {"headers": headers}),
+        ]
+    if scenario == "transfers":
+        return [("POST /transfer", "POST", "/transfer", {"headers": headers, "json": {
+            "recipient_upi": f"payee{n}@upi", "recipient_name": "Benchmark", "amount": round(random.uniform(10, 100), 2)
+        }})]
+    if scenario == "invest_roundups":
+        return [("POST /invest-roundups", "POST", "/invest-roundups?amount=1", {"headers": headers})]
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+async def _run_scenario(client, scenario: str, requests: int, concurrency: int, users: list, run_id: str, samples: dict) -> dict:
+    queue = asyncio.Queue()
+    for n in range(requests):
+        queue.put_nowait(n)
+
+    async def worker():
+        while not queue.empty():
+            n = queue.get_nowait()
+            for label, method, path, kwargs in _operations(scenario, n, users[n % len(users)], run_id):
+                counter = [0]
+                token = _statements.set(counter)
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **kwargs)
+                    ok = response.status_code < 400
+                except Exception:
+                    ok = False
+                finally:
+                    _statements.reset(token)
+                samples[label].append((time.perf_counter() - start, ok, counter[0]))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+    return {"operations": requests, "seconds": round(seconds, 3), "operations_per_second": round(requests / seconds, 1)}
+
+def _summarize(samples: list, count_statements: bool) -> dict:
+    import numpy as np
+    latencies = np.array([s[0] for s in samples]) * 1000
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if not s[1]),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "max_ms": round(float(latencies.max()), 2),
+        "db_statements_per_request": round(sum(s[2] for s in samples) / len(samples), 2) if count_statements else None,
+    }
+
+# Seeding
+
+def _seed_in_process(users: int, transactions: int) -> list:
+    from datetime import datetime, timedelta
+    from sqlalchemy import insert
+    from auth import create_access_token, get_password_hash
+    from database import SessionLocal, shard_session, shard_for_user
+    from models import User, Transaction
+    from utils import calculate_roundup
+
+    db = SessionLocal()
+    try:
+        hashed = get_password_hash(PASSWORD)
+        db.execute(insert(User), [
+            {"email": f"bench{i}@example.com", "hashed_password": hashed, "wallet_balance": STARTING_BALANCE}
+            for i in range(users)
+        ])
+        db.commit()
+        rows = db.query(User.id, User.email).order_by(User.id).all()
+    finally:
+        db.close()
+
+    now = datetime.utcnow()
+    by_shard = defaultdict(list)
+    for user_id, _ in rows:
+        for _ in range(transactions):
+            amount = round(random.uniform(10, 2000), 2)
+            by_shard[shard_for_user(user_id)].append({
+                "user_id": user_id, "amount": amount, "roundup_amount": calculate_roundup(amount),
+                "description": random.choice(MERCHANTS), "created_at": now - timedelta(minutes=random.randint(0, 60 * 24 * 90)),
+            })
+    for shard_id, shard_rows in by_shard.items():
+        db = shard_session(shard_id)
+        try:
+            for i in range(0, len(shard_rows), 10_000):
+                db.execute(insert(Transaction), shard_rows[i:i + 10_000])
+            db.commit()
+        finally:
+            db.close()
+    return [{"email": email, "token": create_access_token({"sub": email})} for _, email in rows]
+
+async def _seed_live(client, users: int, transactions: int, run_id: str, concurrency: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def seed_user(i):
+        async with semaphore:
+            credentials = {"email": f"bench_{run_id}_{i}@example.com", "password": PASSWORD}
+            (await client.post("/signup", json=credentials)).raise_for_status()
+            token = (await client.post("/login", json=credentials)).json()["access_token"]
+            for _ in range(transactions):
+                await client.post("/transaction", headers={"Authorization": f"Bearer {token}"}, json={
+                    "amount": round(random.uniform(10, 2000), 2), "description": random.choice(MERCHANTS)
+                })
+            return {"email": credentials["email"], "token": token}
+
+    return await asyncio.gather(*[seed_user(i) for i in range(users)])
+
+# Runs
+
+async def _drive(args, scenarios: list, client, run_id: str, samples: dict, results: dict):
+    start = time.perf_counter()
+    if args.url:
+        users = await _seed_live(client, args.users, args.transactions, run_id, args.concurrency)
+    else:
+        users = _seed_in_process(args.users, args.transactions)
+    results["_seed_seconds"] = round(time.perf_counter() - start, 2)
+
+    for scenario in scenarios:
+        if scenario == "transfers" and args.url:
+            results[scenario] = {"skipped": "wallets can't be funded without the payment gateway"}
+            continue
+        results[scenario] = await _run_scenario(client, scenario, args.requests, args.concurrency, users, run_id, samples)
+
+async def _run(args, scenarios: list) -> dict:
+    import httpx
+
+    run_id = uuid.uuid4().hex[:8]
+    samples = defaultdict(list)
+    results = {}
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        import main
+        from database import engine, shard_engines
+        from sqlalchemy import event
+        for bound in {id(e): e for e in [engine, *shard_engines]}.values():
+            event.listen(bound, "before_cursor_execute", _count_statement)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark", timeout=60)
+        # Startup seeds the catalog; the scheduled jobs would only add noise
+        await main.app.router.startup()
+        await main.scheduler.stop()
+
+    try:
+        await _drive(args, scenarios, client, run_id, samples, results)
+    finally:
+        await client.aclose()
+        if not args.url:
+            await main.app.router.shutdown()
+
+    return {
+        "config": {
+            "target": args.url or "in-process",
+            "users": args.users,
+            "transactions_per_user": args.transactions,
+            "requests_per_scenario": args.requests,
+            "concurrency": args.concurrency,
+            "seed_seconds": results.pop("_seed_seconds"),
+        },
+        "scenarios": results,
+        "endpoints": {label: _summarize(s, not args.url) for label, s in samples.items()},
+    }
+
+def compare(report: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> dict:
+    regressions, improvements = [], []
+    for label, current in report["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(label)
+        if not base:
+            continue
+        delta = current["p95_ms"] - base["p95_ms"]
+        if delta > min_delta_ms and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append({"endpoint": label, "metric": "p95_ms", "baseline": base["p95_ms"], "current": current["p95_ms"]})
+        elif -delta > min_delta_ms and current["p95_ms"] < base["p95_ms"] * (1 - tolerance):
+            improvements.append({"endpoint": label, "metric": "p95_ms", "baseline": base["p95_ms"], "current": current["p95_ms"]})
+        if current["db_statements_per_request"] is not None and base.get("db_statements_per_request") is not None \
+                and current["db_statements_per_request"] > base["db_statements_per_request"] + 0.5:
+            regressions.append({
+                "endpoint": label, "metric": "db_statements_per_request",
+                "baseline": base["db_statements_per_request"], "current": current["db_statements_per_request"],
+            })
+    for scenario, current in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if not base or "operations_per_second" not in current or "operations_per_second" not in base:
+            continue
+        if current["operations_per_second"] < base["operations_per_second"] * (1 - tolerance):
+            regressions.append({
+                "scenario": scenario, "metric": "operations_per_second",
+                "baseline": base["operations_per_second"], "current": current["operations_per_second"],
+            })
+    return {"tolerance": tolerance, "regressions": regressions, "improvements": improvements}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a live server instead of the in-process app")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=50, help="seeded transactions per user")
+    parser.add_argument("--requests", type=int, default=500, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="write the report here as well as to stdout")
+    parser.add_argument("--baseline", help="compare against a stored report")
+    parser.add_argument("--save-baseline", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--min-delta-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    random.seed(args.seed)
+
+    if not args.url:
+        # The app reads its database settings at import time
+        directory = tempfile.mkdtemp(prefix="api_benchmark_")
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'directory.db')}"
+        os.environ["SHARD_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'shard_{shard}.db')}"
+        os.environ.setdefault("PRICE_SHM_NAME", f"api_benchmark_{os.getpid()}")
+
+    report = asyncio.run(_run(args, scenarios))
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f), args.tolerance, args.min_delta_ms)
+        status = 1 if report["comparison"]["regressions"] else 0
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    sys.exit(status)
@@ -0,0 +1,161 @@
+"""
+Page-load payload: dashboard, wallet, portfolio, holdings, milestones and
+investment sources in one response
+
+Each part matches its standalone endpoint. They're derived from one pass
+over the user's rows:
+
+- transaction_totals once (count and round-ups, archive included)
+- the investment lots once, which give the source split, the allocation
+  and the per-instrument P&L (instead of a sum per endpoint and a lazy
+  load per lot)
+- selections once, which also give the selected/auto-recommended counts
+- recent deposits and achieved milestones
+
+Instrument and milestone metadata come from the per-worker catalogs, and
+all holdings are valued against one price snapshot.
+"""
+from sqlalchemy import select
+
+from models import Investment, PortfolioOption, PortfolioSelection, UserMilestone, WalletDeposit
+from schemas import PortfolioOptionResponse, WalletDepositResponse
+from aggregates import transaction_totals, is_roundup_payment
+from catalog import catalog, milestone_catalog
+from price_feed import price_snapshot
+from serialization import columns, schema_fields
+
+def _options(db, option_ids, prices) -> dict:
+    """PortfolioOptionResponse per id, from the catalog index (DB for ids it doesn't know yet)"""
+    index = catalog.get(db)
+    options = {
+        i: index.options[index.position[i]].model_copy(
+            update={"current_price": prices.get(i, float(index.db_prices[index.position[i]]))}
+        )
+        for i in option_ids if i in index.position
+    }
+    missing = [i for i in option_ids if i not in options]
+    if missing:
+        for option in db.query(PortfolioOption).filter(PortfolioOption.id.in_(missing)):
+            options[option.id] = PortfolioOptionResponse.model_validate(option).model_copy(
+                update={"current_price": prices.get(option.id, option.current_price)}
+            )
+    return options
+
+def _selections(db, user) -> list:
+    query = select(
+        PortfolioSelection.id, PortfolioSelection.portfolio_option_id, PortfolioSelection.is_auto_recommended,
+        PortfolioSelection.target_weight, PortfolioSelection.created_at
+    ).where(PortfolioSelection.user_id == user.id).order_by(PortfolioSelection.id)
+    selections = db.execute(query).all()
+    if not selections:
+        # Same as GET /portfolio: a user without selections gets the recommended ones
+        for option in catalog.recommend(db, user.risk_profile.value):
+            db.add(PortfolioSelection(user_id=user.id, portfolio_option_id=option.id, is_auto_recommended=True))
+        db.commit()
+        selections = db.execute(query).all()
+    return selections
+
+def compose(db, user) -> dict:
+    """Payload of GET /bootstrap (see BootstrapResponse)"""
+    selections = _selections(db, user)
+    total_transactions, total_roundups = transaction_totals(db, user.id)
+    lots = db.execute(select(
+        Investment.portfolio_option_id, Investment.amount, Investment.units, Investment.payment_id, Investment.created_at
+    ).where(Investment.user_id == user.id).order_by(Investment.id)).all()
+    deposits = db.execute(select(*columns(WalletDeposit, WalletDepositResponse)).where(
+        WalletDeposit.user_id == user.id
+    ).order_by(WalletDeposit.created_at.desc()).limit(10)).all()
+    achieved = dict(db.execute(select(UserMilestone.milestone_id, UserMilestone.achieved_at).where(
+        UserMilestone.user_id == user.id
+    )).all())
+
+    prices = price_snapshot()
+    options = _options(db, {s.portfolio_option_id for s in selections} | {lot.portfolio_option_id for lot in lots}, prices)
+
+    # Investment sources
+    from_roundups = sum(lot.amount for lot in lots if is_roundup_payment(lot.payment_id))
+    total_invested = sum(lot.amount for lot in lots)
+    from_wallet = total_invested - from_roundups
+
+    # Holdings grouped by instrument, and the allocation by asset type
+    grouped, allocation = {}, {}
+    for lot in lots:
+        holding = grouped.setdefault(lot.portfolio_option_id, {"amount": 0, "units": 0, "first": lot.created_at})
+        holding["amount"] += lot.amount
+        holding["units"] += lot.units
+        asset_type = options[lot.portfolio_option_id].asset_type.value
+        allocation[asset_type] = allocation.get(asset_type, 0) + lot.amount
+
+    investments_detailed = []
+    for option_id, holding in grouped.items():
+        option = options[option_id]
+        current_price = option.current_price
+        current_value = holding["units"] * current_price
+        profit_loss = current_value - holding["amount"]
+        profit_loss_pct = (profit_loss / holding["amount"] * 100) if holding["amount"] > 0 else 0
+        investments_detailed.append({
+            "id": option_id,
+            "portfolio_option_id": option_id,
+            "portfolio_name": option.name,
+            "portfolio_symbol": option.symbol,
+            "asset_type": option.asset_type.value,
+            "amount_invested": round(holding["amount"], 2),
+            "units": round(holding["units"], 4),
+            "current_price": round(current_price, 2),
+            "current_value": round(current_value, 2),
+            "profit_loss": round(profit_loss, 2),
+            "profit_loss_percentage": round(profit_loss_pct, 2),
+            "created_at": holding["first"],
+        })
+
+    auto_recommended = sum(1 for s in selections if s.is_auto_recommended)
+    deposit_fields = schema_fields(WalletDepositResponse)
+
+    return {
+        "dashboard": {
+            "total_transactions": total_transactions,
+            "total_roundups": round(total_roundups, 2),
+            "total_invested": round(total_invested, 2),
+            "portfolio_allocation": [
+                {"type": k, "amount": v, "percentage": (v / total_invested * 100) if total_invested > 0 else 0}
+                for k, v in allocation.items()
+            ],
+            "user_selected_count": len(selections) - auto_recommended,
+            "auto_recommended_count": auto_recommended,
+        },
+        "wallet": {
+            "wallet_balance": user.wallet_balance,
+            "roundup_savings": round(total_roundups, 2),
+            "total_available": round(user.wallet_balance + total_roundups, 2),
+            "recent_deposits": [dict(zip(deposit_fields, row)) for row in deposits],
+        },
+        "portfolio": [
+            {
+                "id": s.id,
+                "portfolio_option": options[s.portfolio_option_id],
+                "is_auto_recommended": s.is_auto_recommended,
+                "target_weight": s.target_weight,
+                "created_at": s.created_at,
+            }
+            for s in selections
+        ],
+        "investments_detailed": investments_detailed,
+        "milestones": [
+            {
+                "id": m.id,
+                "name": m.name,
+                "description": m.description,
+                "threshold": m.threshold,
+                "badge_icon": m.badge_icon,
+                "achieved": m.id in achieved,
+                "achieved_at": achieved.get(m.id),
+            }
+            for m in milestone_catalog.get(db)
+        ],
+        "investment_sources": {
+            "from_roundups": round(from_roundups, 2),
+            "from_wallet": round(from_wallet, 2),
+            "total_invested": round(total_invested, 2),
+            "roundup_pool_available": round(max(0, total_roundups - from_roundups), 2),
+        },
+    }
@@ -0,0 +1,442 @@
+"""
+In-memory instrument catalog index
+
+Each worker keeps an immutable `CatalogIndex` of `portfolio_options`:
+
+- a prefix trie over the lower-cased symbol, full name and name words; trie
+  nodes (down to CATALOG_TRIE_DEPTH characters) hold a [lo, hi) range into
+  the sorted token list, and longer prefixes are narrowed with bisect
+- inverted lists (position arrays) per AssetType and RiskProfile
+- sorted views (permutation + rank arrays) by id, symbol, name and price;
+  the price view follows the published price snapshot
+
+The index is rebuilt when `catalog.invalidate()` is called in-process, or
+when the periodic check (every CATALOG_REFRESH_SECONDS) sees the row count,
+max id or latest `metadata_updated_at` change. The loader stamps the rows
+it edits; price updates don't, prices reach the index through the snapshot.
+
+Milestone definitions are kept the same way (`milestone_catalog`), reloaded
+whole on invalidate() or every CATALOG_REFRESH_SECONDS.
+
+    python catalog.py load instruments.csv
+    python catalog.py bench --instruments 50000
+"""
+import argparse
+import base64
+import bisect
+import csv
+import json
+import os
+import random
+import re
+import string
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func, insert, select, update, bindparam
+from sqlalchemy.exc import IntegrityError
+
+from models import PortfolioOption, Milestone, AssetType, RiskProfile
+from schemas import PortfolioOptionResponse
+from price_feed import PriceSnapshot, price_snapshot
+
+CATALOG_FILE = os.getenv("CATALOG_FILE", "")
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "30"))
+CATALOG_TRIE_DEPTH = 4
+CATALOG_LOAD_CHUNK = 10_000
+
+SORTS = ("id", "symbol", "name", "price", "-price")
+
+_WORD = re.compile(r"[a-z0-9&]+")
+
+def _tokens(name: str, symbol: str) -> set:
+    name, symbol = name.lower(), symbol.lower()
+    return {symbol, name, *_WORD.findall(name)}
+
+def encode_catalog_cursor(sort: str, option_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{sort}|{option_id}".encode()).decode()
+
+def decode_catalog_cursor(cursor: str) -> tuple:
+    sort, option_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return sort, int(option_id)
+
+class _TrieNode:
+    __slots__ = ("children", "lo", "hi")
+
+    def __init__(self, lo: int):
+        self.children = {}
+        self.lo = lo
+        self.hi = lo
+
+class CatalogIndex:
+    def __init__(self, rows: list, stamp: tuple):
+        """
+        Args:
+            rows: portfolio_options rows in id order
+            stamp: (row count, max id, latest metadata_updated_at) the rows were read at
+        """
+        self.stamp = stamp
+        self.options = [PortfolioOptionResponse.model_validate(row) for row in rows]
+        self.ids = np.array([o.id for o in self.options], dtype=np.int64)
+        self.position = {option_id: pos for pos, option_id in enumerate(self.ids.tolist())}
+        self.db_prices = np.array([o.current_price for o in self.options], dtype=np.float64)
+
+        # Prefix index: sorted (token, position) pairs plus a shallow trie over them
+        pairs = sorted(
+            (token, pos) for pos, o in enumerate(self.options) for token in _tokens(o.name, o.symbol)
+        )
+        self.tokens = [token for token, _ in pairs]
+        self.postings = np.array([pos for _, pos in pairs], dtype=np.int64)
+        self.root = _TrieNode(0)
+        self.root.hi = len(pairs)
+        for i, token in enumerate(self.tokens):
+            node = self.root
+            for ch in token[:CATALOG_TRIE_DEPTH]:
+                child = node.children.get(ch)
+                if child is None:
+                    child = node.children[ch] = _TrieNode(i)
+                child.hi = i + 1
+                node = child
+
+        # Inverted lists, plus per-position codes to filter a candidate set by mask
+        self.asset_codes = np.array([list(AssetType).index(o.asset_type) for o in self.options], dtype=np.int8)
+        self.risk_codes = np.array([list(RiskProfile).index(o.risk_level) for o in self.options], dtype=np.int8)
+        self.by_asset_type = {t: np.flatnonzero(self.asset_codes == i) for i, t in enumerate(AssetType)}
+        self.by_risk = {r: np.flatnonzero(self.risk_codes == i) for i, r in enumerate(RiskProfile)}
+
+        # Sorted views: order[sort] lists positions, rank[sort][position] is the index in that list
+        self.order, self.rank = {}, {}
+        self._set_view("id", np.arange(len(self.options), dtype=np.int64))
+        self._set_view("symbol", np.array(sorted(range(len(self.options)), key=lambda p: (self.options[p].symbol, self.ids[p]))))
+        self._set_view("name", np.array(sorted(range(len(self.options)), key=lambda p: (self.options[p].name.lower(), self.ids[p]))))
+        self._price_version = None
+        self._price_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.options)
+
+    def _set_view(self, sort: str, order: np.ndarray):
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        self.order[sort], self.rank[sort] = order, rank
+
+    def prices(self, snapshot: PriceSnapshot) -> np.ndarray:
+        """Price per position: published price where there is one, else the DB price"""
+        prices = self.db_prices.copy()
+        if snapshot.values is not None and len(self.ids):
+            in_range = self.ids < len(snapshot.values)
+            published = np.full(len(self.ids), np.nan)
+            published[in_range] = snapshot.values[self.ids[in_range]]
+            mask = ~np.isnan(published)
+            prices[mask] = published[mask]
+        return prices
+
+    def _price_views(self, snapshot: PriceSnapshot):
+        # Re-sorted at most once per published price version
+        if self._price_version == snapshot.version and "price" in self.order:
+            return
+        with self._price_lock:
+            if self._price_version == snapshot.version and "price" in self.order:
+                return
+            prices = self.prices(snapshot)
+            ascending = np.lexsort((self.ids, prices))
+            self._set_view("price", ascending)
+            self._set_view("-price", np.lexsort((self.ids, -prices)))
+            self._price_version = snapshot.version
+
+    def prefix(self, prefix: str) -> np.ndarray:
+        """Positions with a token starting with `prefix` (may repeat a position)"""
+        node = self.root
+        for ch in prefix[:CATALOG_TRIE_DEPTH]:
+            node = node.children.get(ch)
+            if node is None:
+                return np.empty(0, dtype=np.int64)
+        lo, hi = node.lo, node.hi
+        if len(prefix) > CATALOG_TRIE_DEPTH:
+            lo = bisect.bisect_left(self.tokens, prefix, lo, hi)
+            hi = bisect.bisect_left(self.tokens, prefix + "￿", lo, hi)
+        return self.postings[lo:hi]
+
+    def search(self, q: str = None, asset_type: AssetType = None, risk: RiskProfile = None,
+               sort: str = "id", limit: int = None, cursor: str = None, snapshot: PriceSnapshot = None) -> tuple:
+        """
+        Filtered, sorted page of the catalog
+
+        Every word of `q` must prefix-match the symbol, the name or a word of
+        the name. Filters start from the inverted lists, or narrow an existing
+        candidate set by mask.
+
+        Returns:
+            (positions, next_cursor); next_cursor is None on the last page
+
+        Raises:
+            ValueError: unknown sort or invalid cursor
+        """
+        if sort not in SORTS:
+            raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+        if sort in ("price", "-price"):
+            self._price_views(snapshot or PriceSnapshot())
+
+        positions = None
+        for word in (q or "").lower().split():
+            matches = self.prefix(word)
+            positions = matches if positions is None else np.intersect1d(positions, matches)
+        filters = [
+            (self.by_asset_type, self.asset_codes, asset_type, list(AssetType)),
+            (self.by_risk, self.risk_codes, risk, list(RiskProfile)),
+        ]
+        for lists, codes, key, members in filters:
+            if key is None:
+                continue
+            if positions is None:
+                positions = lists[key]
+            else:
+                positions = positions[codes[positions] == members.index(key)]
+
+        order, rank = self.order[sort], self.rank[sort]
+        after = -1
+        if cursor:
+            cursor_sort, option_id = decode_catalog_cursor(cursor)
+            if cursor_sort != sort or option_id not in self.position:
+                raise ValueError("Invalid cursor")
+            after = rank[self.position[option_id]]
+
+        remaining = order[after + 1:]
+        if positions is None:
+            # Unfiltered: the precomputed view is the answer
+            ordered = remaining
+        elif len(positions) * 64 < len(self.options):
+            # Small candidate set: sort its ranks (dropping repeats)
+            ranks = np.sort(rank[positions])
+            ranks = ranks[np.concatenate(([True], ranks[1:] != ranks[:-1]))] if len(ranks) else ranks
+            ordered = order[ranks[ranks > after]]
+        else:
+            # Large candidate set: walk the view with a membership mask (no sort)
+            selected = np.zeros(len(self.options), dtype=bool)
+            selected[positions] = True
+            ordered = remaining[selected[remaining]]
+
+        if limit is None or len(ordered) <= limit:
+            return ordered, None
+        page = ordered[:limit]
+        return page, encode_catalog_cursor(sort, int(self.ids[page[-1]]))
+
+    def responses(self, positions, snapshot: PriceSnapshot) -> list:
+        """PortfolioOptionResponse per position, priced from the snapshot"""
+        return [
+            self.options[p].model_copy(update={"current_price": snapshot.get(int(self.ids[p]), self.options[p].current_price)})
+            for p in positions
+        ]
+
+    def recommend(self, risk_profile: str, count: int = 3) -> list:
+        """Same picks as utils.get_auto_recommended_portfolios, from the inverted lists"""
+        matching = self.by_risk[RiskProfile(risk_profile)][:count].tolist()
+        if len(matching) < count:
+            chosen = set(matching)
+            for p in range(len(self.options)):
+                if len(matching) == count:
+                    break
+                if p not in chosen:
+                    matching.append(p)
+        return [self.options[p] for p in matching]
+
+class Catalog:
+    """Per-worker holder of the current CatalogIndex"""
+
+    def __init__(self):
+        self._index = None
+        self._dirty = True
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _stamp(self, db) -> tuple:
+        return tuple(db.query(
+            func.count(PortfolioOption.id), func.max(PortfolioOption.id), func.max(PortfolioOption.metadata_updated_at)
+        ).one())
+
+    def get(self, db) -> CatalogIndex:
+        """The current index, rebuilt if it was invalidated or the table changed"""
+        now = time.monotonic()
+        if self._index is not None and not self._dirty and now - self._checked_at < CATALOG_REFRESH_SECONDS:
+            return self._index
+        with self._lock:
+            if self._index is None or self._dirty or now - self._checked_at >= CATALOG_REFRESH_SECONDS:
+                stamp = self._stamp(db)
+                if self._index is None or self._dirty or stamp != self._index.stamp:
+                    self._dirty = False
+                    rows = db.execute(select(PortfolioOption.__table__).order_by(PortfolioOption.id)).all()
+                    self._index = CatalogIndex(rows, stamp)
+                elif price_snapshot().values is None:
+                    # No shared price vector: pick up DB price changes on the same cadence
+                    prices = dict(db.query(PortfolioOption.id, PortfolioOption.current_price).all())
+                    self._index.db_prices = np.array(
+                        [prices.get(i, np.nan) for i in self._index.ids.tolist()], dtype=np.float64
+                    )
+                    self._index._price_version = None
+                self._checked_at = now
+        return self._index
+
+    def recommend(self, db, risk_profile: str, count: int = 3) -> list:
+        return self.get(db).recommend(risk_profile, count)
+
+catalog = Catalog()
+
+class MilestoneCatalog:
+    """Per-worker copy of the milestone definitions (id order), reloaded every CATALOG_REFRESH_SECONDS"""
+
+    def __init__(self):
+        self._milestones = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._milestones = None
+
+    def get(self, db) -> tuple:
+        milestones = self._milestones
+        if milestones is not None and time.monotonic() - self._loaded_at < CATALOG_REFRESH_SECONDS:
+            return milestones
+        with self._lock:
+            if self._milestones is None or time.monotonic() - self._loaded_at >= CATALOG_REFRESH_SECONDS:
+                # A handful of rows: reloading them is cheaper than checking for edits
+                self._milestones = tuple(db.execute(select(
+                    Milestone.id, Milestone.name, Milestone.description, Milestone.threshold, Milestone.badge_icon
+                ).order_by(Milestone.id)).all())
+                self._loaded_at = time.monotonic()
+            return self._milestones
+
+milestone_catalog = MilestoneCatalog()
+
+def _read_catalog_file(path: str) -> list:
+    """CSV with a header row: symbol,name,asset_type,risk_level,description,current_price"""
+    with open(path, newline="", encoding="utf-8") as f:
+        return [
+            {
+                "symbol": row["symbol"].strip(),
+                "name": row["name"].strip(),
+                "asset_type": AssetType(row["asset_type"].strip().lower()),
+                "risk_level": RiskProfile(row["risk_level"].strip().lower()),
+                "description": (row.get("description") or "").strip() or None,
+                "current_price": float(row.get("current_price") or 0.0),
+            }
+            for row in csv.DictReader(f)
+        ]
+
+def load_catalog_file(db, path: str) -> dict:
+    """
+    Bulk upsert instruments by symbol
+
+    New symbols are inserted with their file price; existing ones whose
+    name, type, risk level or description differ get them refreshed and
+    `metadata_updated_at` set, which other workers' indexes pick up (prices
+    are left to the price job). Concurrent loaders are safe: the unique
+    symbol index turns a lost race into an IntegrityError, which is skipped.
+    """
+    start = time.perf_counter()
+    now = datetime.utcnow()
+    fields = ("name", "asset_type", "risk_level", "description")
+    rows = {row["symbol"]: row for row in _read_catalog_file(path)}
+    existing = {
+        symbol: tuple(values) for symbol, *values in db.query(
+            PortfolioOption.symbol, PortfolioOption.name, PortfolioOption.asset_type,
+            PortfolioOption.risk_level, PortfolioOption.description
+        )
+    }
+    new_rows = [{**row, "metadata_updated_at": now} for symbol, row in rows.items() if symbol not in existing]
+    changed = [
+        {"match_symbol": symbol, **{k: row[k] for k in fields}}
+        for symbol, row in rows.items()
+        if symbol in existing and existing[symbol] != tuple(row[k] for k in fields)
+    ]
+    table = PortfolioOption.__table__
+    try:
+        for i in range(0, len(new_rows), CATALOG_LOAD_CHUNK):
+            db.execute(insert(PortfolioOption), new_rows[i:i + CATALOG_LOAD_CHUNK])
+        if changed:
+            db.execute(
+                update(table).where(table.c.symbol == bindparam("match_symbol")).values(
+                    name=bindparam("name"), asset_type=bindparam("asset_type"),
+                    risk_level=bindparam("risk_level"), description=bindparam("description"),
+                    metadata_updated_at=now
+                ),
+                changed
+            )
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        print(f"Catalog file {path} is being loaded by another worker; skipped")
+        return {"inserted": 0, "updated": 0, "seconds": round(time.perf_counter() - start, 2)}
+    catalog.invalidate()
+    return {"inserted": len(new_rows), "updated": len(changed), "seconds": round(time.perf_counter() - start, 2)}
+
+def _synthetic_rows(count: int) -> list:
+    rng = random.Random(42)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))).title() for _ in range(4000)]
+    rows = []
+    for i in range(count):
+        rows.append({
+            "id": i + 1,
+            "symbol": f"{''.join(rng.choices(string.ascii_uppercase, k=rng.randint(2, 7)))}{i}",
+            "name": " ".join(rng.choices(words, k=rng.randint(1, 4))),
+            "asset_type": rng.choice(list(AssetType)),
+            "risk_level": rng.choice(list(RiskProfile)),
+            "description": None,
+            "current_price": round(rng.lognormvariate(6, 1.5), 2),
+        })
+    return rows
+
+def bench(instruments: int, queries: int) -> dict:
+    """Build an index over synthetic instruments and time typical lookups"""
+    rows = _synthetic_rows(instruments)
+    start = time.perf_counter()
+    index = CatalogIndex(rows, (len(rows), len(rows), None))
+    build = time.perf_counter() - start
+
+    rng = random.Random(7)
+    snapshot = PriceSnapshot(1, np.concatenate([[np.nan], index.db_prices * 1.01]))
+    cases = {
+        "prefix_1": lambda: index.search(q=rng.choice(string.ascii_lowercase), limit=50),
+        "prefix_3": lambda: index.search(q=rng.choice(rows)["name"][:3], limit=50),
+        "symbol_exact": lambda: index.search(q=rng.choice(rows)["symbol"], limit=50),
+        "filter_type_risk": lambda: index.search(asset_type=rng.choice(list(AssetType)), risk=rng.choice(list(RiskProfile)), limit=50),
+        "prefix_filter_price": lambda: index.search(q=rng.choice(rows)["name"][:2], asset_type=AssetType.STOCK, sort="price", limit=50, snapshot=snapshot),
+        "page_all_by_name": lambda: index.search(sort="name", limit=50),
+    }
+    results = {"instruments": instruments, "build_seconds": round(build, 2)}
+    for name, case in cases.items():
+        case()
+        timings = []
+        for _ in range(queries):
+            t = time.perf_counter()
+            case()
+            timings.append((time.perf_counter() - t) * 1000)
+        results[name] = {
+            "p50_ms": round(float(np.percentile(timings, 50)), 3),
+            "p99_ms": round(float(np.percentile(timings, 99)), 3),
+        }
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    load = sub.add_parser("load", help="bulk load a catalog CSV into the database")
+    load.add_argument("path")
+    bench_parser = sub.add_parser("bench", help="time index build and lookups on synthetic data")
+    bench_parser.add_argument("--instruments", type=int, default=50_000)
+    bench_parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.command == "load":
+        from database import SessionLocal
+        db = SessionLocal()
+        try:
+            print(json.dumps(load_catalog_file(db, args.path), indent=2))
+        finally:
+            db.close()
+    else:
+        print(json.dumps(bench(args.instruments, args.queries), indent=2))
@@ -0,0 +1,152 @@
+"""
+Per-user change log and delta sync
+
+Every insert, update and delete of a user's history rows (ENTITIES) is
+recorded in `change_log` on the user's shard, in the same transaction as
+the write. Each entry's id is its sequence number. Ids are per-shard
+autoincrement, and a user lives on one shard, so a user's entries are
+monotonic. Writes are logged in two ways:
+
+- ORM writes (session.add / delete / attribute changes) by a flush hook on
+  ShardedSession, so endpoints need no extra calls
+- Core and bulk statements (sweep, SIP and rebalance lots, settlement
+  status changes, bulk deletes) by explicit `insert_logged` /
+  `log_changes` calls next to the statement
+
+Moving rows to the history archive is not a change as far as clients are
+concerned and is not logged.
+
+GET /sync?since=<cursor> reads the user's entries after the cursor through
+the (user_id, id) index, collapses them to the last operation per row, and
+returns the current rows for inserts and updates and ids (tombstones) for
+deletes. The cost follows the number of changes, not the size of the
+history. Without `since` it returns only the current cursor. A client
+takes that first, then downloads the full history, then syncs from the
+cursor; replayed upserts are harmless.
+
+Entries are served once they are SYNC_SETTLE_SECONDS old. A transaction
+that flushed an entry but commits after an entry with a higher id would
+otherwise be skipped by a client that synced in between.
+"""
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, insert, select
+
+from database import ShardedSession
+from models import ChangeLog, Transaction, Investment, PortfolioSelection, MoneyTransfer, WalletDeposit, UserMilestone
+from schemas import TransactionResponse, InvestmentResponse, MoneyTransferResponse, WalletDepositResponse
+from archive import not_consolidated
+from serialization import schema_fields
+
+SYNC_LIMIT = int(os.getenv("SYNC_LIMIT", "1000"))
+SYNC_SETTLE_SECONDS = float(os.getenv("SYNC_SETTLE_SECONDS", "5"))
+SYNC_CHUNK = 500
+
+class _Entity:
+    def __init__(self, model, fields: tuple, extra_filter=None):
+        self.model = model
+        self.fields = fields
+        self.columns = [getattr(model, field) for field in fields]
+        self.extra_filter = extra_filter
+
+# Synced tables: fields sent for upserted rows (the list endpoints' schemas where there is one)
+ENTITIES = {
+    "transactions": _Entity(Transaction, schema_fields(TransactionResponse)),
+    # Consolidated stand-ins for archived lots are not part of the client's history
+    "investments": _Entity(Investment, schema_fields(InvestmentResponse), not_consolidated()),
+    "portfolio_selections": _Entity(
+        PortfolioSelection, ("id", "portfolio_option_id", "is_auto_recommended", "target_weight", "created_at")
+    ),
+    "money_transfers": _Entity(MoneyTransfer, schema_fields(MoneyTransferResponse)),
+    "wallet_deposits": _Entity(WalletDeposit, schema_fields(WalletDepositResponse)),
+    "user_milestones": _Entity(UserMilestone, ("id", "milestone_id", "achieved_at")),
+}
+
+_TRACKED = {entity.model: name for name, entity in ENTITIES.items()}
+
+def log_changes(db, entity: str, op: str, rows):
+    """Log `op` for (user_id, entity_id) pairs written outside the ORM unit of work"""
+    entries = [{"user_id": user_id, "entity": entity, "entity_id": entity_id, "op": op} for user_id, entity_id in rows]
+    for i in range(0, len(entries), 10_000):
+        db.execute(insert(ChangeLog.__table__), entries[i:i + 10_000])
+
+def insert_logged(db, model, rows: list):
+    """Bulk insert of a tracked model (one executemany) with an insert entry per row"""
+    if rows:
+        inserted = db.execute(insert(model).returning(model.user_id, model.id), rows).all()
+        log_changes(db, _TRACKED[model], "insert", inserted)
+
+# ORM writes
+
+def _before_flush(session, flush_context, instances):
+    # Updates and deletes are taken before the flush, while deleted rows can still be loaded
+    pending = [(obj, "insert") for obj in session.new if type(obj) in _TRACKED]
+    pending += [
+        (obj, "update") for obj in session.dirty
+        if type(obj) in _TRACKED and session.is_modified(obj, include_collections=False)
+    ]
+    pending += [(obj, "delete", obj.user_id, obj.id) for obj in session.deleted if type(obj) in _TRACKED]
+    if pending:
+        session.info.setdefault("changes", []).extend(pending)
+
+def _after_flush(session, flush_context):
+    pending = session.info.pop("changes", None)
+    if not pending:
+        return
+    entries = []
+    for change in pending:
+        obj, op = change[0], change[1]
+        user_id, entity_id = change[2:] if op == "delete" else (obj.user_id, obj.id)
+        entries.append({"user_id": user_id, "entity": _TRACKED[type(obj)], "entity_id": entity_id, "op": op})
+    session.execute(insert(ChangeLog.__table__), entries)
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop("changes", None)
+
+event.listen(ShardedSession, "before_flush", _before_flush)
+event.listen(ShardedSession, "after_flush", _after_flush)
+event.listen(ShardedSession, "after_soft_rollback", _after_soft_rollback)
+
+# Sync
+
+def _settled():
+    return ChangeLog.created_at <= datetime.utcnow() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+
+def head(db, user_id: int) -> int:
+    """The user's current cursor (0 before their first change)"""
+    return db.query(func.coalesce(func.max(ChangeLog.id), 0)).filter(ChangeLog.user_id == user_id, _settled()).scalar()
+
+def delta(db, user_id: int, since: int, limit: int = SYNC_LIMIT) -> dict:
+    """Rows upserted and ids deleted per entity after cursor `since`, up to `limit` log entries"""
+    entries = db.execute(
+        select(ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op)
+        .where(ChangeLog.user_id == user_id, ChangeLog.id > since, _settled())
+        .order_by(ChangeLog.id)
+        .limit(limit + 1)
+    ).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # Last operation per row wins: insert + update is an upsert, anything + delete a tombstone
+    latest = {}
+    for entry in entries:
+        latest.setdefault(entry.entity, {})[entry.entity_id] = entry.op
+
+    changes = {}
+    for name, entity in ENTITIES.items():
+        ops = latest.get(name, {})
+        deletes = sorted(i for i, op in ops.items() if op == "delete")
+        upsert_ids = sorted(i for i, op in ops.items() if op != "delete")
+        upserts = []
+        for i in range(0, len(upsert_ids), SYNC_CHUNK):
+            query = select(*entity.columns).where(
+                entity.model.user_id == user_id, entity.model.id.in_(upsert_ids[i:i + SYNC_CHUNK])
+            )
+            if entity.extra_filter is not None:
+                query = query.where(entity.extra_filter)
+            # Rows gone from the table since (archived, or deleted after this page) are skipped
+            upserts += [dict(zip(entity.fields, row)) for row in db.execute(query.order_by(entity.model.id))]
+        changes[name] = {"upserts": upserts, "deletes": deletes}
+
+    return {"cursor": entries[-1].id if entries else since, "has_more": has_more, "changes": changes}
@@ -0,0 +1,160 @@
+"""
+Single-flight for per-user read endpoints
+
+The dashboard pages fire the same GETs from several components (and tabs)
+at once. Endpoints decorated with `@coalesced(schema)` compute once per
+(user, route, query parameters): a request arriving while the same
+computation is in flight waits for it, and the encoded response is reused
+for COALESCE_TTL_SECONDS afterwards. Set COALESCE_TTL_SECONDS=0 to share
+in-flight computations only.
+
+Reuse must not outlive the user's own writes: CoalesceMiddleware bumps the
+user's `cache_generation` column before any authenticated non-GET request
+starts its response, and the generation (read with the user at
+authentication) is part of the key. The counter lives in the directory
+database, so the next read after a write recomputes on whichever worker
+serves it. Changes made by scheduled jobs (sweeps, settlement) can be
+seen up to COALESCE_TTL_SECONDS late.
+
+Results are encoded with the endpoint's response schema while its session
+is open, and every request gets the same bytes. Each worker keeps its own
+entries, dropped once expired; hits, joins and misses per endpoint are
+exported on /metrics.
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+
+from fastapi import HTTPException, Response
+from pydantic import TypeAdapter
+from sqlalchemy import func, update
+
+from auth import decode_token
+from database import engine
+from models import User
+from metrics import labels
+from serialization import dumps
+
+COALESCE_TTL_SECONDS = float(os.getenv("COALESCE_TTL_SECONDS", "2"))
+
+_entries = {}  # key -> (expires, body)
+_inflight = {}  # key -> Future of the body (None when the computation failed)
+_counts = defaultdict(int)  # (endpoint, result)
+_lock = threading.Lock()
+
+def _purge(now: float):
+    for key in [key for key, (expires, _) in _entries.items() if expires <= now]:
+        del _entries[key]
+
+def _count(endpoint: str, result: str):
+    with _lock:
+        _counts[(endpoint, result)] += 1
+
+def coalesced(schema):
+    """Share the endpoint's encoded result between concurrent (and, for a short window, later) identical calls"""
+    adapter = TypeAdapter(schema)
+
+    def decorator(endpoint):
+        name = endpoint.__name__
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            user = kwargs["current_user"]
+            query = tuple(sorted((k, repr(v)) for k, v in kwargs.items() if k not in ("current_user", "db")))
+            key = (user.email, user.cache_generation or 0, name, query)
+            while True:
+                now = time.monotonic()
+                entry = _entries.get(key)
+                if entry is not None and entry[0] > now:
+                    _count(name, "hit")
+                    return Response(entry[1], media_type="application/json")
+                future = _inflight.get(key)
+                if future is None:
+                    break
+                body = await asyncio.shield(future)
+                if body is not None:
+                    _count(name, "joined")
+                    return Response(body, media_type="application/json")
+                # The computation failed or its request went away: take over
+
+            _count(name, "miss")
+            future = _inflight[key] = asyncio.get_running_loop().create_future()
+            try:
+                result = await endpoint(*args, **kwargs)
+                body = dumps(adapter.dump_python(adapter.validate_python(result), mode="json"))
+            except BaseException:
+                # Waiters compute for themselves (and most likely get the same error)
+                future.set_result(None)
+                raise
+            finally:
+                _inflight.pop(key, None)
+            if COALESCE_TTL_SECONDS > 0:
+                _purge(now)
+                _entries[key] = (time.monotonic() + COALESCE_TTL_SECONDS, body)
+            future.set_result(body)
+            return Response(body, media_type="application/json")
+
+        return wrapper
+
+    return decorator
+
+def invalidate(email: str):
+    """Stop reusing results computed for this user so far, on every worker"""
+    users = User.__table__
+    with engine.begin() as conn:
+        conn.execute(
+            update(users).where(users.c.email == email)
+            .values(cache_generation=func.coalesce(users.c.cache_generation, 0) + 1)
+        )
+
+def render() -> str:
+    """Prometheus text for the hit/joined/miss counters"""
+    with _lock:
+        counts = sorted(_counts.items())
+    lines = [
+        "# HELP coalesce_requests_total Coalesced endpoint calls by result (hit: reused, joined: shared in flight, miss: computed)",
+        "# TYPE coalesce_requests_total counter",
+    ]
+    lines += [f"coalesce_requests_total{labels(endpoint=endpoint, result=result)} {n}" for (endpoint, result), n in counts]
+    lines += ["# HELP coalesce_entries Results held for reuse", "# TYPE coalesce_entries gauge", f"coalesce_entries {len(_entries)}"]
+    return "\n".join(lines) + "\n"
+
+# Middleware
+
+class CoalesceMiddleware:
+    """Invalidates the caller's reusable results after each of their writes"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        email = None
+        if scope["type"] == "http" and scope["method"] not in ("GET", "HEAD", "OPTIONS"):
+            scheme, _, token = dict(scope["headers"]).get(b"authorization", b"").decode().partition(" ")
+            if scheme.lower() == "bearer" and token:
+                try:
+                    email = decode_token(token).email
+                except HTTPException:
+                    pass
+        if email is None:
+            await self.app(scope, receive, send)
+            return
+
+        started = False
+
+        async def send_invalidating(message):
+            nonlocal started
+            # Endpoints commit before responding: reads the client sends after this see the write
+            if message["type"] == "http.response.start":
+                started = True
+                await asyncio.to_thread(invalidate, email)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_invalidating)
+        finally:
+            if not started:
+                await asyncio.to_thread(invalidate, email)
@@ -1,23 +1,198 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import os
+import zlib
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./micro_investment.db")
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Number of user shards. With 1 shard every table lives in DATABASE_URL,
+# which is the original single-file layout.
+SHARD_COUNT = max(1, int(os.getenv("SHARD_COUNT", "1")))
+SHARD_DATABASE_URL = os.getenv("SHARD_DATABASE_URL", "sqlite:///./micro_investment_shard_{shard}.db")
+
+# Per-user tables that are partitioned by user_id. Everything else
+# (users, portfolio_options, milestones, ...) stays in the directory database.
+SHARDED_TABLES = {
+    "transactions",
+    "investments",
+    "money_transfers",
+    "wallet_outbox",
+    "wallet_deposits",
+    "portfolio_selections",
+    "user_milestones",
+    "user_archive_totals",
+    "price_alerts",
+    "alert_notifications",
+    "investment_plans",
+    "holding_resets",
+    "portfolio_snapshots",
+    "snapshot_days",
+    "risk_scores",
+    "risk_score_days",
+    "spending_rollups",
+    "spending_backfills",
+    "change_log",
+}
+
+def _create_engine(url: str):
+    return create_engine(
+        url, connect_args={"check_same_thread": False} if "sqlite" in url else {}
+    )
+
+engine = _create_engine(DATABASE_URL)
+
+if SHARD_COUNT == 1:
+    shard_engines = [engine]
+else:
+    shard_engines = [_create_engine(SHARD_DATABASE_URL.format(shard=i)) for i in range(SHARD_COUNT)]
+
+def shard_for_user(user_id: int, shard_count: int = SHARD_COUNT) -> int:
+    """Stable shard index for a user id (among `shard_count` shards, the configured count by default)"""
+    if shard_count == 1:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+class ShardedSession(Session):
+    """Session that routes per-user tables to the shard stored in `info["shard_id"]`"""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if SHARD_COUNT > 1:
+            # ORM statements carry their mapper; Core DML carries its table
+            table = getattr(mapper, "persist_selectable", None) if mapper is not None else getattr(clause, "table", None)
+            if table is not None and getattr(table, "name", None) in SHARDED_TABLES:
+                shard_id = self.info.get("shard_id")
+                if shard_id is None:
+                    raise RuntimeError(f"No shard bound to session for table '{table.name}'")
+                return shard_engines[shard_id]
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+    def bind_user(self, user_id: int):
+        """Route this session's per-user tables to the shard owning `user_id`"""
+        self.info["shard_id"] = shard_for_user(user_id)
+
+SessionLocal = sessionmaker(class_=ShardedSession, autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+def _add_missing_columns(bind, tables):
+    """create_all() never alters existing tables; add nullable columns introduced since"""
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def _add_missing_indexes(bind, tables):
+    """Indexes declared since a table was created (e.g. a new unique constraint)"""
+    inspector = inspect(bind)
+    for table in tables:
+        existing = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                try:
+                    index.create(bind=bind)
+                except Exception as e:
+                    # e.g. duplicate values left over from before a unique index
+                    print(f"Could not create index {index.name}: {e}")
+
+# Ids handed out before a table became AUTOINCREMENT that must still not be reused
+_SEQUENCE_FLOORS = {"investments": "SELECT max(investment_watermark) FROM snapshot_days"}
+
+def _add_autoincrement(bind, tables):
+    """
+    Rebuild SQLite tables created before they were declared sqlite_autoincrement
+
+    SQLite can't add AUTOINCREMENT to an existing table, so the rows are copied
+    into a freshly created one; sqlite_sequence starts above every id kept
+    (or above its _SEQUENCE_FLOORS query, for ids that were already deleted).
+    """
+    if bind.dialect.name != "sqlite":
+        return
+    with bind.begin() as conn:
+        for table in tables:
+            if not table.dialect_options["sqlite"]["autoincrement"]:
+                continue
+            ddl = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+            ).scalar()
+            if ddl is None or "AUTOINCREMENT" in ddl.upper():
+                continue
+            legacy = f"{table.name}_legacy"
+            for index in inspect(conn).get_indexes(table.name):
+                conn.execute(text(f"DROP INDEX {index['name']}"))
+            # Legacy rename: references to the table elsewhere keep pointing at its name
+            conn.execute(text("PRAGMA legacy_alter_table = ON"))
+            conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {legacy}"))
+            conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+            table.create(bind=conn)
+            existing = {c["name"] for c in inspect(conn).get_columns(legacy)}
+            columns = ", ".join(c.name for c in table.columns if c.name in existing)
+            conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {legacy}"))
+            conn.execute(text(f"DROP TABLE {legacy}"))
+            (key,) = table.primary_key.columns
+            floor = _SEQUENCE_FLOORS.get(table.name, "SELECT 0")
+            conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": table.name})
+            conn.execute(
+                text(
+                    f"INSERT INTO sqlite_sequence (name, seq) SELECT :name, "
+                    f"max(coalesce((SELECT max({key.name}) FROM {table.name}), 0), coalesce(({floor}), 0))"
+                ),
+                {"name": table.name}
+            )
+
+def init_db():
+    """Create directory tables in the main database and per-user tables in every shard"""
+    directory_tables = [t for t in Base.metadata.sorted_tables if t.name not in SHARDED_TABLES]
+    sharded_tables = [t for t in Base.metadata.sorted_tables if t.name in SHARDED_TABLES]
+    Base.metadata.create_all(bind=engine, tables=directory_tables)
+    _add_missing_columns(engine, directory_tables)
+    _add_autoincrement(engine, directory_tables)
+    _add_missing_indexes(engine, directory_tables)
+    for shard_engine in shard_engines:
+        Base.metadata.create_all(bind=shard_engine, tables=sharded_tables)
+        _add_missing_columns(shard_engine, sharded_tables)
+        _add_autoincrement(shard_engine, sharded_tables)
+        _add_missing_indexes(shard_engine, sharded_tables)
+
 def get_db():
+    # The shard is resolved once the request is authenticated:
+    # get_current_user calls db.bind_user() on this same (per-request cached) session.
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+def shard_session(shard_id: int) -> ShardedSession:
+    """Open a session whose per-user tables point at a specific shard"""
+    return SessionLocal(info={"shard_id": shard_id})
+
+def for_each_shard(fn, parallel: bool = True) -> list:
+    """
+    Run `fn(db)` once per shard and return the results in shard order
+
+    Each call gets its own session; with `parallel` the shards are queried
+    concurrently on a thread pool (used by admin reports and batch jobs).
+    """
+    def run(shard_id):
+        db = shard_session(shard_id)
+        try:
+            return fn(db)
+        finally:
+            db.close()
+
+    if not parallel or SHARD_COUNT == 1:
+        return [run(i) for i in range(SHARD_COUNT)]
+    with ThreadPoolExecutor(max_workers=SHARD_COUNT) as pool:
+        # Each shard runs in a copy of the caller's context (e.g. a scheduler job's lease)
+        futures = [pool.submit(contextvars.copy_context().run, run, i) for i in range(SHARD_COUNT)]
+        return [future.result() for future in futures]
@@ -0,0 +1,377 @@
+"""
+Synthetic data generator for scale testing
+
+Creates --users users with heavy-tailed activity. Transaction counts per
+user are lognormal around --transactions (scaled by how long the user has
+existed), amounts are lognormal and merchants follow a Zipf law. Every user
+also gets portfolio selections, round-up sweep and wallet investment lots,
+wallet deposits, UPI transfers and the milestones their cumulative
+round-ups crossed, dated between signup and now and consistent with each
+other: round-up investments never exceed the round-ups saved, deposits
+cover transfers and wallet investments, and the rest is the wallet balance.
+
+Users are synthesized in chunks of DATAGEN_CHUNK_USERS on a process pool.
+Chunk i is seeded from (--seed, i) and history ends at --as-of (default:
+today, 00:00 UTC), so the output doesn't depend on --workers or the clock. Chunks are written in order with Core executemany inserts, one
+transaction per database per chunk, which keeps the generated ids
+deterministic as well. The new users' spending rollups are aggregated
+during synthesis and written with their transactions.
+
+The catalog and milestones must already exist (start the API once). Every
+generated user's password is `datagen`.
+
+    python datagen.py --users 100000 --transactions 100
+    python datagen.py --users 1000 --seed 7 --workers 4
+"""
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from multiprocessing import Pool
+
+import numpy as np
+from sqlalchemy import func, insert, text
+
+from database import engine, shard_engines, shard_for_user, SessionLocal, init_db
+from models import (
+    User, Transaction, PortfolioOption, PortfolioSelection, Investment, Milestone, UserMilestone,
+    MoneyTransfer, WalletDeposit, SpendingRollup, RiskProfile, TransferStatus, DepositMethod
+)
+from analytics import categorize
+
+DATAGEN_CHUNK_USERS = 2000
+PASSWORD = "datagen"
+
+PROFILES = [RiskProfile.LOW, RiskProfile.MEDIUM, RiskProfile.HIGH]
+PROFILE_WEIGHTS = [0.3, 0.5, 0.2]
+# Spread of per-user activity (lognormal sigma); higher means a heavier tail of power users
+ACTIVITY_SIGMA = 1.0
+SELECTIONS_PER_USER = 3
+
+# Ordered by popularity (Zipf weights)
+MERCHANTS = [
+    "Swiggy order", "UPI payment", "Zomato order", "Amazon.in", "Uber ride", "BigBasket", "Flipkart",
+    "HP petrol", "Blinkit", "Airtel recharge", "Cafe Coffee Day", "Ola cab", "Netflix", "Zepto",
+    "Myntra", "Starbucks", "Jio recharge", "Apollo Pharmacy", "DMart", "Rapido", "Electricity bill",
+    "BookMyShow", "Spotify", "Dominos pizza", "IRCTC train", "Metro card", "Nykaa", "PVR cinema",
+    "MakeMyTrip", "Broadband bill", "Gym membership", "Udemy course", "Parking", "Local kirana",
+    "ATM withdrawal", "OYO hotel", "Insurance premium", "Tuition fees", "Cult fitness", "Rent",
+]
+MERCHANT_WEIGHTS = 1 / np.arange(1, len(MERCHANTS) + 1) ** 1.1
+MERCHANT_WEIGHTS /= MERCHANT_WEIGHTS.sum()
+CATEGORIES = sorted({categorize(m) for m in MERCHANTS})
+MERCHANT_CATEGORIES = np.array([CATEGORIES.index(categorize(m)) for m in MERCHANTS])
+
+RECIPIENTS = [
+    "Rahul Sharma", "Priya Patel", "Amit Kumar", "Sneha Iyer", "Vikram Singh", "Ananya Rao",
+    "Arjun Mehta", "Kavya Nair", "Rohan Gupta", "Ishita Das", "Karan Malhotra", "Meera Joshi",
+]
+FAILURE_REASONS = ["Recipient bank unavailable", "Invalid UPI ID", "Transaction limit exceeded"]
+
+DEPOSIT_AMOUNTS = np.array([500.0, 1000.0, 2000.0, 5000.0, 10000.0, 25000.0])
+DEPOSIT_AMOUNT_WEIGHTS = [0.2, 0.3, 0.2, 0.18, 0.1, 0.02]
+DEPOSIT_METHODS = list(DepositMethod)
+DEPOSIT_METHOD_WEIGHTS = [0.7, 0.15, 0.1, 0.05]
+
+# Sharded tables in insert order
+TABLES = [Transaction, SpendingRollup, PortfolioSelection, Investment, MoneyTransfer, WalletDeposit, UserMilestone]
+
+_context = None
+
+def _init_worker(context: dict):
+    global _context
+    _context = context
+
+def _times(rng, starts: np.ndarray, counts: np.ndarray, now: float) -> np.ndarray:
+    """Epoch seconds, uniform between each user's signup and now, `counts[i]` for user i"""
+    begin = np.repeat(starts, counts)
+    return begin + rng.random(len(begin)) * (now - begin)
+
+def _datetimes(seconds) -> list:
+    return (np.asarray(seconds, dtype=np.float64) * 1e6).astype(np.int64).astype("datetime64[us]").tolist()
+
+def _codes(rng, n: int, prefix: str) -> list:
+    return [f"{prefix}{value:010X}" for value in rng.integers(0, 16 ** 10, n).tolist()]
+
+def _milestones(owners: np.ndarray, times: np.ndarray, roundups: np.ndarray, milestones: list) -> list:
+    """user_milestones rows: when each user's cumulative round-ups crossed each threshold"""
+    order = np.lexsort((times, owners))
+    owners, times, roundups = owners[order], times[order], roundups[order]
+    first = np.concatenate(([True], owners[1:] != owners[:-1])) if len(owners) else np.zeros(0, dtype=bool)
+    cumulative = np.cumsum(roundups)
+    # Subtract everything before the user's first transaction
+    offset = np.concatenate(([0.0], cumulative))[np.flatnonzero(first)]
+    cumulative -= np.repeat(offset, np.diff(np.append(np.flatnonzero(first), len(owners))))
+
+    rows = []
+    for milestone_id, threshold in milestones:
+        reached = cumulative >= threshold - 1e-9
+        crossed = np.flatnonzero(reached & (first | ~np.concatenate(([False], reached[:-1]))))
+        rows.extend(
+            {"user_id": u, "milestone_id": milestone_id, "achieved_at": t}
+            for u, t in zip(owners[crossed].tolist(), _datetimes(times[crossed]))
+        )
+    return rows
+
+def _rollups(owners: np.ndarray, times: np.ndarray, amounts: np.ndarray, roundups: np.ndarray, merchants: np.ndarray) -> list:
+    """spending_rollups rows for the chunk's transactions"""
+    months = (times * 1e6).astype(np.int64).astype("datetime64[us]").astype("datetime64[M]").astype(np.int64)
+    first_month = months.min() if len(months) else 0
+    span = (months.max() - first_month + 1 if len(months) else 1) * len(CATEGORIES)
+    keys = (owners - owners.min(initial=0)) * span + (months - first_month) * len(CATEGORIES) + MERCHANT_CATEGORIES[merchants]
+    unique, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+    spent = np.bincount(inverse, weights=amounts)
+    saved = np.bincount(inverse, weights=roundups)
+    user_ids = unique // span + owners.min(initial=0)
+    month_labels = (unique % span // len(CATEGORIES) + first_month).astype("datetime64[M]").astype(str)
+    return [
+        {
+            "user_id": u, "month": m, "category": CATEGORIES[c], "transaction_count": n,
+            "amount_total": round(a, 2), "roundup_total": round(r, 2),
+        }
+        for u, m, c, n, a, r in zip(
+            user_ids.tolist(), month_labels.tolist(), (unique % len(CATEGORIES)).tolist(),
+            counts.tolist(), spent.tolist(), saved.tolist()
+        )
+    ]
+
+def _synthesize(task: tuple) -> dict:
+    """Rows for one chunk of users: {"users": [...], "shards": {shard: {table: [...]}}}"""
+    seed, index, first_id, count = task
+    c = _context
+    rng = np.random.default_rng([seed, index])
+    now, window = c["now"], c["days"] * 86400
+    user_ids = np.arange(first_id, first_id + count)
+    signup = now - rng.random(count) * window
+    profiles = rng.choice(len(PROFILES), count, p=PROFILE_WEIGHTS)
+    # Mean-one lognormal activity, times 2 * tenure (uniform, mean 1/2)
+    activity = rng.lognormal(-0.5 * ACTIVITY_SIGMA ** 2, ACTIVITY_SIGMA, count)
+    tx_counts = rng.poisson(c["transactions"] * activity * 2 * (now - signup) / window)
+    shard_of = {u: shard_for_user(u) for u in user_ids.tolist()}
+    tables = defaultdict(lambda: defaultdict(list))
+
+    # Transactions, in time order
+    owners = np.repeat(user_ids, tx_counts)
+    times = _times(rng, signup, tx_counts, now)
+    amounts = np.round(np.clip(rng.lognormal(5.3, 1.1, len(owners)), 1, 200_000), 2)
+    whole = rng.random(len(owners)) < 0.2
+    amounts[whole] = np.ceil(amounts[whole])
+    roundups = np.round(np.floor(amounts) + 1 - amounts, 2)
+    merchants = rng.choice(len(MERCHANTS), len(owners), p=MERCHANT_WEIGHTS)
+    order = np.argsort(times, kind="stable")
+    for u, a, r, m, t in zip(
+        owners[order].tolist(), amounts[order].tolist(), roundups[order].tolist(),
+        merchants[order].tolist(), _datetimes(times[order])
+    ):
+        tables[shard_of[u]][Transaction].append({
+            "user_id": u, "amount": a, "roundup_amount": r, "description": MERCHANTS[m], "created_at": t
+        })
+    saved = np.bincount(owners - first_id, weights=roundups, minlength=count)
+    for row in _rollups(owners, times, amounts, roundups, merchants):
+        tables[shard_of[row["user_id"]]][SpendingRollup].append(row)
+
+    for t in _milestones(owners, times, roundups, c["milestones"]):
+        tables[shard_of[t["user_id"]]][UserMilestone].append(t)
+
+    option_ids, option_prices = c["option_ids"], c["option_prices"]
+    spent, balances = np.zeros(count), np.zeros(count)
+    for i, user_id in enumerate(user_ids.tolist()):
+        shard = tables[shard_of[user_id]]
+        start = float(signup[i])
+        pool = c["pools"][profiles[i]]
+        picks = rng.choice(pool, min(SELECTIONS_PER_USER, len(pool)), replace=False)
+        auto = bool(rng.random() < 0.7)
+        selected_at = _datetimes([start + rng.uniform(60, 3600)])[0]
+        for option in picks.tolist():
+            shard[PortfolioSelection].append({
+                "user_id": user_id, "portfolio_option_id": int(option_ids[option]),
+                "is_auto_recommended": auto, "created_at": selected_at,
+            })
+
+        # Round-up sweeps invest a share of what was saved; wallet top-ups come on top
+        sweeps = min(1 + rng.poisson(tx_counts[i] / 15), 100) if saved[i] >= 10 else 0
+        lots = [("ROUNDUP_", saved[i] * rng.uniform(0.4, 0.95) / sweeps)] * sweeps if sweeps else []
+        if rng.random() < 0.25:
+            lots += [("WALLET_", float(w)) for w in np.round(rng.lognormal(6.5, 0.8, 1 + rng.poisson(1)), 2)]
+        for (prefix, amount), at, payment_id in zip(
+            lots, _datetimes(np.sort(start + rng.random(len(lots)) * (now - start))), _codes(rng, len(lots), "")
+        ):
+            per_option = round(amount / len(picks), 2)
+            if per_option < 0.01:
+                continue
+            for option in picks.tolist():
+                price = option_prices[option] * float(np.exp(rng.normal(0, 0.25)))
+                shard[Investment].append({
+                    "user_id": user_id, "portfolio_option_id": int(option_ids[option]), "amount": per_option,
+                    "units": round(per_option / price, 6), "is_auto_recommended": auto,
+                    "payment_id": prefix + payment_id, "created_at": at,
+                })
+            if prefix == "WALLET_":
+                spent[i] += per_option * len(picks)
+
+        transfers = rng.poisson(tx_counts[i] / 20 * rng.lognormal(-0.5, 1.0))
+        if transfers:
+            at = start + rng.random(transfers) * (now - start)
+            amounts_out = np.round(np.clip(rng.lognormal(6.2, 1.0, transfers), 1, 100_000), 2)
+            failed = rng.random(transfers) < 0.04
+            settle = rng.uniform(2, 120, transfers)
+            for k, (created, claimed, settled, transaction_id) in enumerate(zip(
+                _datetimes(at), _datetimes(at + 1), _datetimes(at + settle), _codes(rng, transfers, "TXN")
+            )):
+                recipient = RECIPIENTS[int(rng.integers(len(RECIPIENTS)))]
+                shard[MoneyTransfer].append({
+                    "user_id": user_id,
+                    "recipient_upi": f"{recipient.split()[0].lower()}{int(rng.integers(100, 999))}@upi",
+                    "recipient_mobile": None, "recipient_name": recipient,
+                    "amount": float(amounts_out[k]),
+                    "status": TransferStatus.FAILED if failed[k] else TransferStatus.SUCCESS,
+                    "transaction_id": transaction_id, "description": "UPI transfer",
+                    "created_at": created, "claimed_at": claimed, "settled_at": settled,
+                    "failure_reason": FAILURE_REASONS[k % len(FAILURE_REASONS)] if failed[k] else None,
+                })
+                if not failed[k]:
+                    spent[i] += amounts_out[k]
+
+        # Deposits fund everything that left the wallet; a signup top-up covers any shortfall
+        deposit_amounts = rng.choice(DEPOSIT_AMOUNTS, 1 + rng.poisson(tx_counts[i] / 30), p=DEPOSIT_AMOUNT_WEIGHTS)
+        deposit_times = start + rng.random(len(deposit_amounts)) * (now - start)
+        shortfall = spent[i] - deposit_amounts.sum()
+        if shortfall > 0:
+            deposit_amounts = np.append(deposit_amounts, np.ceil(shortfall / 1000) * 1000)
+            deposit_times = np.append(deposit_times, start + 60)
+        balances[i] = deposit_amounts.sum() - spent[i]
+        methods = rng.choice(len(DEPOSIT_METHODS), len(deposit_amounts), p=DEPOSIT_METHOD_WEIGHTS)
+        for amount, method, at, payment_id, order_id in zip(
+            deposit_amounts.tolist(), methods.tolist(), _datetimes(deposit_times),
+            _codes(rng, len(deposit_amounts), "pay_"), _codes(rng, len(deposit_amounts), "order_")
+        ):
+            shard[WalletDeposit].append({
+                "user_id": user_id, "amount": amount, "method": DEPOSIT_METHODS[method], "payment_id": payment_id,
+                "razorpay_order_id": order_id, "status": TransferStatus.SUCCESS, "description": "Wallet top-up",
+                "created_at": at,
+            })
+
+    users = [
+        {
+            "id": u, "email": f"user{u}@datagen.example", "hashed_password": c["hashed_password"],
+            "risk_profile": PROFILES[p], "wallet_balance": round(b, 2), "created_at": t,
+        }
+        for u, p, b, t in zip(user_ids.tolist(), profiles.tolist(), balances.tolist(), _datetimes(signup))
+    ]
+    return {"users": users, "shards": {shard: dict(rows) for shard, rows in tables.items()}}
+
+def _context_from(db, transactions: int, days: int, as_of: datetime) -> dict:
+    from auth import get_password_hash
+    options = db.query(PortfolioOption.id, PortfolioOption.risk_level, PortfolioOption.current_price).order_by(PortfolioOption.id).all()
+    milestones = db.query(Milestone.id, Milestone.threshold).order_by(Milestone.threshold).all()
+    if not options or not milestones:
+        raise SystemExit("No portfolio options or milestones yet: start the API once to seed them")
+    levels = [level for _, level, _ in options]
+    # Positions into the option arrays per risk profile (every option if a profile has too few)
+    pools = []
+    for profile in PROFILES:
+        pool = [i for i, level in enumerate(levels) if level == profile]
+        pools.append(np.array(pool if len(pool) >= SELECTIONS_PER_USER else range(len(options))))
+    return {
+        "now": (as_of - datetime(1970, 1, 1)).total_seconds(),
+        "days": days,
+        "transactions": transactions,
+        "hashed_password": get_password_hash(PASSWORD),
+        "option_ids": np.array([option_id for option_id, _, _ in options]),
+        "option_prices": np.array([price or 1.0 for _, _, price in options], dtype=np.float64),
+        "pools": pools,
+        "milestones": [(milestone_id, threshold) for milestone_id, threshold in milestones],
+    }
+
+def _connect(bound):
+    connection = bound.connect()
+    if bound.dialect.name == "sqlite":
+        # A bulk load can be rerun; skip the per-commit fsync
+        connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        connection.commit()
+    return connection
+
+def generate(users: int, transactions: int, days: int, seed: int, workers: int, as_of: datetime) -> dict:
+    start = time.perf_counter()
+    db = SessionLocal()
+    try:
+        context = _context_from(db, transactions, days, as_of)
+        first_id = (db.query(func.max(User.id)).scalar() or 0) + 1
+    finally:
+        db.close()
+
+    tasks = [
+        (seed, i, first_id + offset, min(DATAGEN_CHUNK_USERS, users - offset))
+        for i, offset in enumerate(range(0, users, DATAGEN_CHUNK_USERS))
+    ]
+    connections = {id(bound): _connect(bound) for bound in [engine, *shard_engines]}
+    directory = connections[id(engine)]
+    shards = [connections[id(bound)] for bound in shard_engines]
+    counts = defaultdict(int)
+
+    def write(chunk):
+        with directory.begin():
+            directory.execute(insert(User.__table__), chunk["users"])
+        counts[User.__tablename__] += len(chunk["users"])
+        for shard_id, tables in chunk["shards"].items():
+            with shards[shard_id].begin():
+                for model in TABLES:
+                    rows = tables.get(model)
+                    if rows:
+                        shards[shard_id].execute(insert(model.__table__), rows)
+                        counts[model.__tablename__] += len(rows)
+
+    try:
+        if workers > 1:
+            with Pool(workers, initializer=_init_worker, initargs=(context,)) as pool:
+                # imap keeps chunk order (and so the ids) while later chunks are synthesized
+                for n, chunk in enumerate(pool.imap(_synthesize, tasks), 1):
+                    write(chunk)
+                    _progress(n, len(tasks), counts, start)
+        else:
+            _init_worker(context)
+            for n, task in enumerate(tasks, 1):
+                write(_synthesize(task))
+                _progress(n, len(tasks), counts, start)
+        if engine.dialect.name == "postgresql":
+            # Ids were assigned here, not by the sequence
+            with directory.begin():
+                directory.execute(text("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT max(id) FROM users))"))
+    finally:
+        for connection in connections.values():
+            connection.close()
+
+    seconds = time.perf_counter() - start
+    return {
+        "seed": seed,
+        "as_of": as_of.isoformat(),
+        "first_user_id": first_id,
+        "rows": dict(counts),
+        "seconds": round(seconds, 1),
+        "rows_per_second": round(sum(counts.values()) / seconds),
+    }
+
+def _progress(done: int, total: int, counts: dict, start: float):
+    if done % 10 == 0 or done == total:
+        print(
+            f"[{datetime.now().strftime('%H:%M:%S')}] 🧪 Chunk {done}/{total}: "
+            f"{counts[User.__tablename__]} users, {counts[Transaction.__tablename__]} transactions "
+            f"({time.perf_counter() - start:.1f}s)"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, required=True)
+    parser.add_argument("--transactions", type=int, default=100, help="mean transactions per user")
+    parser.add_argument("--days", type=int, default=730, help="history window")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--as-of", type=lambda d: datetime.strptime(d, "%Y-%m-%d"), help="end of the history, YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    init_db()
+    as_of = args.as_of or datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    print(json.dumps(generate(args.users, args.transactions, args.days, args.seed, args.workers, as_of), indent=2))
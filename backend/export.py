@@ -0,0 +1,401 @@
+"""
+Streaming statement exports
+
+A statement is every transaction (with its round-up), investment lot,
+transfer and deposit, one record per row in a common set of columns
+(STATEMENT_COLUMNS), oldest first per record type. Rows already moved to the
+archive are read back from their month files, so statements cover the
+full history; consolidated lots (stand-ins for archived ones) are skipped.
+
+Rows are read in EXPORT_BATCH_ROWS partitions (yield_per, server-side
+cursors where the driver has them) and each partition is encoded and
+yielded before the next is fetched, so memory stays flat however long the
+history is. Formats are csv, ndjson and parquet (needs pyarrow; one row
+group per partition). With gzip, the stream is compressed as it goes.
+
+The admin export covers every user: one worker per (shard, record type)
+reads partitions into a bounded queue (EXPORT_WORKERS threads,
+EXPORT_QUEUE_BATCHES partitions in flight) and the response encodes them
+in arrival order.
+
+    python export.py bench --rows 500000
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+from sqlalchemy import Enum as SAEnum, select
+
+from database import SHARD_COUNT, shard_session, shard_for_user
+from models import Transaction, Investment, MoneyTransfer, WalletDeposit
+from archive import ARCHIVE_DIR, ARCHIVED_MODELS, not_consolidated, read_month
+from serialization import dumps
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Optional: parquet exports are unavailable without it
+    pyarrow = None
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "5000"))
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "4"))
+EXPORT_QUEUE_BATCHES = int(os.getenv("EXPORT_QUEUE_BATCHES", "8"))
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+STATEMENT_COLUMNS = (
+    "type", "id", "user_id", "created_at", "amount", "roundup_amount", "description",
+    "portfolio_option_id", "units", "payment_id", "status", "counterparty", "reference",
+)
+
+class ExportError(ValueError):
+    pass
+
+class _Source:
+    """One record type: statement column -> model attribute"""
+
+    def __init__(self, kind: str, model, mapping: dict, extra_filter=None):
+        self.kind = kind
+        self.model = model
+        self.attributes = list(mapping.values())
+        self.columns = [getattr(model, attribute) for attribute in self.attributes]
+        self.extra_filter = extra_filter
+        self.archived = model in ARCHIVED_MODELS
+        # Picks a record out of (kind, *row, None): unmapped columns read the trailing None
+        picks = [mapping.get(column) for column in STATEMENT_COLUMNS[1:]]
+        self._record = itemgetter(0, *[1 + self.attributes.index(a) if a is not None else len(self.attributes) + 1 for a in picks])
+        self._enums = [
+            STATEMENT_COLUMNS.index(column) for column, attribute in mapping.items()
+            if isinstance(getattr(model, attribute).type, SAEnum)
+        ]
+
+    def records(self, rows) -> list:
+        """Statement records (tuples in STATEMENT_COLUMNS order) from rows in `attributes` order"""
+        kind, record = self.kind, self._record
+        records = [record((kind, *row, None)) for row in rows]
+        for position in self._enums:
+            records = [
+                r if r[position] is None else r[:position] + (getattr(r[position], "value", r[position]),) + r[position + 1:]
+                for r in records
+            ]
+        return records
+
+_COMMON = {"id": "id", "user_id": "user_id", "created_at": "created_at", "amount": "amount"}
+
+SOURCES = [
+    _Source("transaction", Transaction, {**_COMMON, "roundup_amount": "roundup_amount", "description": "description"}),
+    _Source("investment", Investment, {
+        **_COMMON, "portfolio_option_id": "portfolio_option_id", "units": "units", "payment_id": "payment_id",
+    }, not_consolidated()),
+    _Source("transfer", MoneyTransfer, {
+        **_COMMON, "description": "description", "status": "status",
+        "counterparty": "recipient_name", "reference": "transaction_id",
+    }),
+    _Source("deposit", WalletDeposit, {
+        **_COMMON, "description": "description", "payment_id": "payment_id", "status": "status",
+        "counterparty": "method", "reference": "razorpay_order_id",
+    }),
+]
+
+def parse_range(from_date: str = None, to_date: str = None) -> tuple:
+    """[start, end) datetimes from inclusive YYYY-MM-DD bounds (open when missing)"""
+    try:
+        start = datetime.strptime(from_date, "%Y-%m-%d") if from_date else datetime.min
+        end = datetime.strptime(to_date, "%Y-%m-%d") + timedelta(days=1) if to_date else datetime.max
+    except ValueError:
+        raise ExportError("from and to must be YYYY-MM-DD")
+    if start >= end:
+        raise ExportError("from must not be after to")
+    return start, end
+
+# Reading
+
+def _hot_batches(db, source: _Source, start: datetime, end: datetime, user_id: int = None):
+    model = source.model
+    query = select(*source.columns).where(model.created_at >= start, model.created_at < end)
+    if user_id is not None:
+        query = query.where(model.user_id == user_id).order_by(model.created_at, model.id)
+    else:
+        query = query.order_by(model.id)
+    if source.extra_filter is not None:
+        query = query.where(source.extra_filter)
+    # Core rows on the shard's connection: no ORM row processing per record
+    connection = db.connection(bind_arguments={"mapper": model.__mapper__})
+    result = connection.execute(query, execution_options={"yield_per": EXPORT_BATCH_ROWS})
+    try:
+        for partition in result.partitions():
+            yield source.records(partition)
+    finally:
+        result.close()
+
+def _archived_batches(source: _Source, user_ids, start: datetime, end: datetime, archive_dir: str):
+    """Archived rows of the given users (an iterable of ids, or a predicate on ids), month by month"""
+    if not source.archived:
+        return
+    table_dir = os.path.join(archive_dir, source.model.__tablename__)
+    if callable(user_ids):
+        if not os.path.isdir(table_dir):
+            return
+        user_ids = sorted(int(d) for d in os.listdir(table_dir) if d.isdigit() and user_ids(int(d)))
+    first, last = start.strftime("%Y-%m") if start > datetime.min else "", end.strftime("%Y-%m")
+    for user_id in user_ids:
+        directory = os.path.join(table_dir, str(user_id))
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            month = name[:7]
+            if not name.endswith(".ndjson.gz") or month < first or month > last:
+                continue
+            rows = sorted(
+                (r for r in read_month(os.path.join(directory, name)) if start <= r["created_at"] < end),
+                key=lambda r: (r["created_at"], r["id"])
+            )
+            for i in range(0, len(rows), EXPORT_BATCH_ROWS):
+                yield source.records([tuple(r.get(a) for a in source.attributes) for r in rows[i:i + EXPORT_BATCH_ROWS]])
+
+# Encoding
+
+class _CsvEncoder:
+    def start(self) -> bytes:
+        return (",".join(STATEMENT_COLUMNS) + "\r\n").encode()
+
+    def encode(self, records: list) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            r[:3] + (r[3].isoformat() if r[3] is not None else None,) + r[4:] for r in records
+        )
+        return buffer.getvalue().encode("utf-8")
+
+    def finish(self) -> bytes:
+        return b""
+
+class _NdjsonEncoder:
+    def start(self) -> bytes:
+        return b""
+
+    def encode(self, records: list) -> bytes:
+        return b"".join(dumps(dict(zip(STATEMENT_COLUMNS, record))) + b"\n" for record in records)
+
+    def finish(self) -> bytes:
+        return b""
+
+class _Chunks:
+    """Write-only file object collecting what the parquet writer emits"""
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+class _ParquetEncoder:
+    def __init__(self):
+        self.schema = pyarrow.schema([
+            ("type", pyarrow.string()), ("id", pyarrow.int64()), ("user_id", pyarrow.int64()),
+            ("created_at", pyarrow.timestamp("us")), ("amount", pyarrow.float64()),
+            ("roundup_amount", pyarrow.float64()), ("description", pyarrow.string()),
+            ("portfolio_option_id", pyarrow.int64()), ("units", pyarrow.float64()),
+            ("payment_id", pyarrow.string()), ("status", pyarrow.string()),
+            ("counterparty", pyarrow.string()), ("reference", pyarrow.string()),
+        ])
+        self.sink = _Chunks()
+        self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema, compression="snappy")
+
+    def start(self) -> bytes:
+        return self.sink.drain()
+
+    def encode(self, records: list) -> bytes:
+        columns = list(zip(*records)) if records else [[] for _ in STATEMENT_COLUMNS]
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema
+        ))
+        return self.sink.drain()
+
+    def finish(self) -> bytes:
+        self.writer.close()
+        return self.sink.drain()
+
+def _encoder(format: str):
+    if format not in FORMATS:
+        raise ExportError(f"format must be one of: {', '.join(FORMATS)}")
+    if format == "parquet":
+        if pyarrow is None:
+            raise ExportError("parquet exports need pyarrow installed on the server")
+        return _ParquetEncoder()
+    return _CsvEncoder() if format == "csv" else _NdjsonEncoder()
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _encoded(encoder, batches):
+    yield encoder.start()
+    for records in batches:
+        data = encoder.encode(records)
+        if data:
+            yield data
+    yield encoder.finish()
+
+# Streams
+
+def user_export(user_id: int, format: str, start: datetime, end: datetime, compress: bool = False, archive_dir: str = ARCHIVE_DIR):
+    """Byte chunks of one user's statement; raises ExportError before streaming starts"""
+    encoder = _encoder(format)
+
+    def batches():
+        db = shard_session(shard_for_user(user_id))
+        try:
+            for source in SOURCES:
+                # Archived months are older than anything still hot
+                yield from _archived_batches(source, [user_id], start, end, archive_dir)
+                yield from _hot_batches(db, source, start, end, user_id)
+        finally:
+            db.close()
+
+    chunks = _encoded(encoder, batches())
+    return _gzipped(chunks) if compress else chunks
+
+def _shard_worker(shard_id: int, source: _Source, start: datetime, end: datetime, archive_dir: str, out: queue.Queue, stop: threading.Event):
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    db = shard_session(shard_id)
+    try:
+        owned = lambda user_id: shard_for_user(user_id) == shard_id
+        for batches in (_archived_batches(source, owned, start, end, archive_dir), _hot_batches(db, source, start, end)):
+            for records in batches:
+                if not put(records):
+                    return
+    except Exception as e:
+        put(e)
+    finally:
+        db.close()
+        put(None)
+
+def all_users_export(format: str, start: datetime, end: datetime, compress: bool = False, archive_dir: str = ARCHIVE_DIR):
+    """Byte chunks of every user's statement rows, read by parallel (shard, record type) workers"""
+    encoder = _encoder(format)
+
+    def batches():
+        out = queue.Queue(maxsize=EXPORT_QUEUE_BATCHES)
+        stop = threading.Event()
+        tasks = [(shard_id, source) for shard_id in range(SHARD_COUNT) for source in SOURCES]
+        pool = ThreadPoolExecutor(max_workers=min(EXPORT_WORKERS, len(tasks)))
+        for shard_id, source in tasks:
+            pool.submit(_shard_worker, shard_id, source, start, end, archive_dir, out, stop)
+        try:
+            running = len(tasks)
+            while running:
+                item = out.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # Also reached when the client goes away mid-stream
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    chunks = _encoded(encoder, batches())
+    return _gzipped(chunks) if compress else chunks
+
+def filename(prefix: str, format: str, start: datetime, end: datetime, compress: bool) -> str:
+    first = start.strftime("%Y%m%d") if start > datetime.min else "start"
+    last = (end - timedelta(days=1)).strftime("%Y%m%d") if end < datetime.max else "now"
+    return f"{prefix}-{first}-{last}.{FORMATS[format][1]}" + (".gz" if compress else "")
+
+# Benchmark
+
+def bench(rows: int) -> dict:
+    import random
+    import tracemalloc
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import Session
+    from database import Base
+
+    random.seed(42)
+    results = {"rows": rows}
+    with tempfile.TemporaryDirectory() as directory:
+        bound = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        Base.metadata.create_all(bind=bound, tables=[s.model.__table__ for s in SOURCES])
+        now = datetime.utcnow()
+        with bound.begin() as conn:
+            for offset in range(0, rows, 100_000):
+                conn.execute(insert(Transaction.__table__), [
+                    {
+                        "user_id": 1, "amount": round(random.uniform(10, 2000), 2), "roundup_amount": round(random.random(), 2),
+                        "description": random.choice(["Swiggy order", "Uber ride", "Amazon.in, Bengaluru"]),
+                        "created_at": now - timedelta(seconds=(rows - offset - i) * 30),
+                    }
+                    for i in range(min(100_000, rows - offset))
+                ])
+
+        def run(format: str, compress: bool) -> int:
+            db = Session(bound)
+            try:
+                chunks = _encoded(_encoder(format), _hot_batches(db, SOURCES[0], datetime.min, datetime.max, 1))
+                return sum(len(chunk) for chunk in (_gzipped(chunks) if compress else chunks))
+            finally:
+                db.close()
+
+        for format in [f for f in FORMATS if f != "parquet" or pyarrow is not None]:
+            for compress in (False, True):
+                start = time.perf_counter()
+                size = run(format, compress)
+                seconds = time.perf_counter() - start
+                tracemalloc.start()
+                run(format, compress)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                results[format + ("+gzip" if compress else "")] = {
+                    "seconds": round(seconds, 2), "rows_per_second": round(rows / seconds),
+                    "bytes": size, "peak_mb": round(peak / 1e6, 1),
+                }
+        bound.dispose()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_args = commands.add_parser("bench", help="export throughput and memory per format")
+    bench_args.add_argument("--rows", type=int, default=500_000)
+    args = parser.parse_args()
+    print(json.dumps(bench(args.rows), indent=2))
@@ -0,0 +1,252 @@
+"""
+Conditional caching and response compression
+
+CacheMiddleware gives the GET routes in CACHE_POLICIES a strong ETag (a hash
+of the response body) and their Cache-Control header, and answers a
+matching If-None-Match with 304 Not Modified and no body. Public catalog
+routes may be cached by browsers and CDNs for HTTP_CACHE_MAX_AGE seconds;
+per-user routes are private and revalidated on every use, which still
+saves the download when nothing changed.
+
+CompressionMiddleware encodes responses of at least HTTP_COMPRESS_MIN_BYTES
+with brotli (when the package is installed and the client accepts it) or
+gzip. Streamed responses are compressed chunk by chunk, each chunk flushed
+so it reaches the client as soon as it's produced. Server-sent events and
+payloads that are already compressed (gzip downloads, parquet) are left as
+they are. An encoded response's ETag gets the coding as a suffix
+(`"<hash>-br"`), so each representation keeps its own strong validator;
+CacheMiddleware ignores the suffix when matching. A 304 gets the suffix and
+`Vary` the 200 would have had, so a client's stored validator stays the
+same.
+
+CompressionMiddleware wraps CacheMiddleware, so tags are computed over the
+unencoded body.
+"""
+import hashlib
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip only
+    brotli = None
+
+HTTP_COMPRESS_MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "1024"))
+HTTP_GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+HTTP_BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "4"))
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "30"))
+
+# Cache-Control per route template; only these GETs get ETags
+CACHE_POLICIES = {
+    "/": f"public, max-age={HTTP_CACHE_MAX_AGE}",
+    "/portfolio-options": f"public, max-age={HTTP_CACHE_MAX_AGE}",
+    "/milestones": "private, no-cache",
+}
+
+# Content types never compressed: already compressed, or must not be buffered by proxies
+UNCOMPRESSED_TYPES = ("application/gzip", "application/vnd.apache.parquet", "text/event-stream", "image/")
+
+CODINGS = ("br", "gzip")
+
+# ETag
+
+def etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def _opaque(tag: str) -> str:
+    """Entity tag without weakness prefix, quotes or a coding suffix"""
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    for coding in CODINGS:
+        if tag.endswith("-" + coding):
+            return tag[:-len(coding) - 1]
+    return tag
+
+def not_modified(if_none_match: str, tag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return _opaque(tag) in {_opaque(t) for t in if_none_match.split(",")}
+
+class CacheMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        policy = None
+        body = []
+
+        async def send_cached(message):
+            nonlocal start, policy
+            if message["type"] == "http.response.start":
+                # The router has resolved the route by the time the response starts
+                policy = CACHE_POLICIES.get(getattr(scope.get("route"), "path", None))
+                if policy is None or message["status"] != 200:
+                    policy = None
+                    await send(message)
+                else:
+                    start = message
+                return
+            if policy is None:
+                await send(message)
+                return
+            body.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            content = b"".join(body)
+            tag = etag(content)
+            headers = MutableHeaders(raw=list(start["headers"]))
+            headers["etag"] = tag
+            headers["cache-control"] = policy
+            if not_modified(Headers(scope=scope).get("if-none-match", ""), tag):
+                # Content-Type and Content-Length of the 200 stay for CompressionMiddleware,
+                # which tells from them whether the 200 would be encoded, then drops them
+                headers["content-length"] = str(len(content))
+                await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": content})
+
+        await self.app(scope, receive, send_cached)
+
+# Compression
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(HTTP_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=HTTP_BROTLI_QUALITY)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+def accepted_coding(accept_encoding: str):
+    """Preferred coding the client accepts (br, then gzip), or None"""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    for coding in CODINGS:
+        if coding == "br" and brotli is None:
+            continue
+        if weights.get(coding, weights.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+def _compressible(message) -> bool:
+    headers = Headers(raw=message["headers"])
+    if "content-encoding" in headers or message["status"] < 200 or message["status"] in (204, 304):
+        return False
+    return not headers.get("content-type", "").startswith(UNCOMPRESSED_TYPES)
+
+def _encoded_tag(tag: str, coding: str) -> str:
+    return tag[:-1] + f'-{coding}"' if tag.endswith('"') else tag
+
+def _not_modified_headers(message, coding) -> list:
+    """Headers of a 304 from CacheMiddleware: the ETag suffix and Vary of the 200 it stands for"""
+    headers = MutableHeaders(raw=list(message["headers"]))
+    length = int(headers.get("content-length") or 0)
+    encoded = (
+        coding is not None and length >= HTTP_COMPRESS_MIN_BYTES
+        and _compressible({"status": 200, "headers": message["headers"]})
+    )
+    if encoded:
+        headers.add_vary_header("Accept-Encoding")
+        if "etag" in headers:
+            headers["etag"] = _encoded_tag(headers["etag"], coding)
+    del headers["content-length"]
+    del headers["content-type"]
+    return headers.raw
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        coding = accepted_coding(Headers(scope=scope).get("accept-encoding", ""))
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        def encoded_headers(length: int = None) -> list:
+            headers = MutableHeaders(raw=list(start["headers"]))
+            headers["content-encoding"] = coding
+            headers.add_vary_header("Accept-Encoding")
+            if "etag" in headers:
+                headers["etag"] = _encoded_tag(headers["etag"], coding)
+            if length is None:
+                del headers["content-length"]
+            else:
+                headers["content-length"] = str(length)
+            return headers.raw
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                if message["status"] == 304:
+                    passthrough = True
+                    await send({**message, "headers": _not_modified_headers(message, coding)})
+                    return
+                start = message
+                passthrough = coding is None or not _compressible(message)
+                if passthrough:
+                    await send(message)
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            data = message.get("body", b"")
+            more = message.get("more_body", False)
+            if compressor is None:
+                if not more and len(data) < HTTP_COMPRESS_MIN_BYTES:
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = _Brotli() if coding == "br" else _Gzip()
+                if not more:
+                    data = compressor.finish(data)
+                    await send({**start, "headers": encoded_headers(len(data))})
+                    await send({"type": "http.response.body", "body": data})
+                    return
+                await send({**start, "headers": encoded_headers()})
+            data = compressor.chunk(data) if more else compressor.finish(data)
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,18 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, Query
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import razorpay
 import hmac
 import hashlib
 import os
 import random
 import asyncio
-from datetime import datetime
+import json
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
-from database import engine, get_db, Base
-from models import User, Transaction, PortfolioOption, PortfolioSelection, Investment, Milestone, UserMilestone, RiskProfile, AssetType, MoneyTransfer, TransferStatus, WalletDeposit, DepositMethod
+from sqlalchemy import func
+from database import get_db, init_db, for_each_shard, shard_session, shard_for_user, SHARD_COUNT
+from models import User, Transaction, PortfolioOption, PortfolioSelection, Investment, Milestone, UserMilestone, RiskProfile, AssetType, MoneyTransfer, TransferStatus, WalletOutbox, WalletDeposit, DepositMethod, PriceAlert, AlertNotification, AlertDirection, InvestmentPlan, PlanExecution, HoldingReset, RiskScore
 from schemas import (
     UserCreate, UserLogin, UserResponse, Token,
     TransactionCreate, TransactionResponse,
@@ -21,18 +24,54 @@ from schemas import (
     OrderCreate, OrderResponse, PaymentWebhook,
     MoneyTransferCreate, MoneyTransferResponse,
     WalletDepositCreate, WalletDepositVerify, WalletDepositResponse, WalletBalanceResponse,
-    InvestmentSourceResponse
+    InvestmentSourceResponse, RebalancePlan,
+    PriceAlertCreate, PriceAlertResponse, AlertNotificationResponse,
+    InvestmentPlanCreate, InvestmentPlanResponse, PlanExecutionResponse,
+    PortfolioHistory, BacktestRequest, BacktestResponse, PortfolioRiskResponse, RiskScoreResponse,
+    SpendingAnalytics, PercentileResponse, BootstrapResponse, SyncResponse
 )
-from auth import get_password_hash, verify_password, create_access_token, get_current_user
-from utils import calculate_roundup, get_auto_recommended_portfolios
+from auth import get_password_hash, verify_password, create_access_token, get_current_user, get_admin_user
+from utils import calculate_roundup
+from aggregates import transaction_totals, invested_by_source, available_roundups
+from archive import page_history, has_archive, encode_cursor, not_consolidated
+from scheduler import scheduler
+from price_feed import price_vector, publish_prices, price_snapshot
+from sweep import run_sweep, SWEEP_SCHEDULE_HOURS
+from rebalance import allocate_to_selections, plan_rebalance, plan_response, REBALANCE_TOLERANCE
+from price_feed import price_array
+from settlement import run_settlement, apply_wallet_outbox, SETTLEMENT_INTERVAL
+from catalog import catalog, milestone_catalog, load_catalog_file, CATALOG_FILE
+from alerts import evaluate_alerts, ALERTS_MAX_PER_USER
+from sip import run_plans, SIP_MIN_AMOUNT, SIP_MAX_PLANS_PER_USER, SIP_SCHEDULE_MINUTES
+from snapshots import end_of_day_snapshots, history, HISTORY_RANGES
+from backtest import run_backtest, BacktestError
+from risk import portfolio_risk, nightly_risk_scores
+from analytics import record_transactions, spending, GROUPS as SPENDING_GROUPS
+from stats import percentile, rebuild_sketches, METRICS as STATS_METRICS, STATS_REBUILD_MINUTES
+from metrics import MetricsMiddleware, instrument_engines, registry as metrics_registry, METRICS_TOKEN
+import profiler
+from http_cache import CacheMiddleware, CompressionMiddleware
+import coalesce
+from coalesce import coalesced, CoalesceMiddleware
+from bootstrap import compose as compose_bootstrap
+from changes import delta, head as sync_head, log_changes, SYNC_LIMIT
+from serialization import RowsResponse, columns
+import export
 
 load_dotenv()
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# Create tables (directory database + every user shard)
+init_db()
 
 app = FastAPI(title="Micro-Investment API")
 
+# ETag / Cache-Control on catalog GETs, then gzip/brotli (tags are taken before encoding)
+app.add_middleware(CacheMiddleware)
+app.add_middleware(CompressionMiddleware)
+
+# Single-flight for the dashboard reads; a user's writes end reuse of their results
+app.add_middleware(CoalesceMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -40,36 +79,66 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Profile-Id", "ETag"],
 )
 
+# Per-route latency, status and DB metrics (GET /metrics, Server-Timing header)
+app.add_middleware(MetricsMiddleware)
+instrument_engines()
+
+# Sampling profiler: admin X-Profile header, 1-in-N requests, /admin/profile
+app.add_middleware(profiler.ProfilerMiddleware)
+
 # Razorpay client
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID", "rzp_test_key")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET", "rzp_test_secret")
 razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
 
-# Background task to update stock prices
-async def update_stock_prices():
+# Scheduled job to update stock prices (runs on the scheduler leader only)
+@scheduler.job(interval=30, jitter=1)
+def update_stock_prices():
     """Update stock prices every 30 seconds to simulate market changes"""
-    while True:
-        await asyncio.sleep(30)  # 30 seconds
+    db = next(get_db())
+    try:
+        portfolio_options = db.query(PortfolioOption).all()
         
-        db = next(get_db())
-        try:
-            portfolio_options = db.query(PortfolioOption).all()
-            
-            for option in portfolio_options:
-                # Simulate price change: -3% to +3% random change for more visible P&L
-                change_percent = random.uniform(-0.03, 0.03)
-                new_price = option.current_price * (1 + change_percent)
-                option.current_price = round(new_price, 2)
-            
-            db.commit()
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 📈 Stock prices updated (30s interval)")
-        except Exception as e:
-            print(f"Error updating prices: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        for option in portfolio_options:
+            # Simulate price change: -3% to +3% random change for more visible P&L
+            change_percent = random.uniform(-0.03, 0.03)
+            new_price = option.current_price * (1 + change_percent)
+            option.current_price = round(new_price, 2)
+        
+        db.commit()
+        publish_prices(db)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 📈 Stock prices updated (30s interval)")
+        
+        # Fire price alerts crossed by this tick
+        result = evaluate_alerts()
+        if result["delivered"]:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔔 {result['delivered']} price alerts triggered")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# Round-up auto-invest sweep (resumes an interrupted run on the next tick)
+scheduler.register("roundup_sweep", run_sweep, interval=SWEEP_SCHEDULE_HOURS * 3600, jitter=60)
+
+# Settle PENDING transfers against the payout adapter
+scheduler.register("transfer_settlement", run_settlement, interval=SETTLEMENT_INTERVAL, jitter=0.5)
+
+# Execute due recurring investment plans
+scheduler.register("sip_plans", run_plans, interval=SIP_SCHEDULE_MINUTES * 60, jitter=30)
+
+# End-of-day portfolio snapshots (hourly check, runs once per day per shard)
+scheduler.register("portfolio_snapshots", end_of_day_snapshots, interval=3600, jitter=60)
+
+# Nightly risk scores against the latest close (hourly check)
+scheduler.register("risk_scores", nightly_risk_scores, interval=3600, jitter=60)
+
+# Cohort percentile sketches
+scheduler.register("stats_sketches", rebuild_sketches, interval=STATS_REBUILD_MINUTES * 60, jitter=30)
 
 # Initialize default data
 @app.on_event("startup")
@@ -129,6 +198,10 @@ async def startup_event():
         db.add_all(portfolio_options)
         db.commit()
     
+    # Bulk load the full instrument universe (upsert by symbol)
+    if CATALOG_FILE:
+        print(f"Catalog file loaded: {load_catalog_file(db, CATALOG_FILE)}")
+    
     # Create milestones if not exist
     if db.query(Milestone).count() == 0:
         milestones = [
@@ -140,11 +213,22 @@ async def startup_event():
         ]
         db.add_all(milestones)
         db.commit()
+        milestone_catalog.invalidate()
+    
+    # Map the shared price vector and (re)seed it from the DB: the block may
+    # be left over from before a restart
+    if price_vector.open():
+        publish_prices(db, reset=True)
     
     db.close()
     
-    # Start background price update task
-    asyncio.create_task(update_stock_prices())
+    # Start periodic jobs (leader election decides which worker runs them)
+    await scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    price_vector.close()
 
 # Authentication Endpoints
 @app.post("/signup", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
@@ -183,6 +267,39 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
     access_token = create_access_token(data={"sub": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
+def list_history(db: Session, model, schema, user_id: int, limit: Optional[int], cursor: Optional[str], extra_filter=None) -> RowsResponse:
+    """
+    Newest-first history for list endpoints
+
+    Without `limit` the whole hot window is returned (and X-Next-Cursor points
+    into the archive, if the user has one); with `limit` the results are
+    paged through hot rows and then archived rows.
+
+    Only the columns of `schema` are read, and rows are encoded without
+    per-row validation (see serialization.py).
+    """
+    selected = columns(model, schema)
+    headers = {}
+    if limit is None:
+        query = db.query(*selected).filter(model.user_id == user_id)
+        if extra_filter is not None:
+            query = query.filter(extra_filter)
+        rows = query.order_by(model.created_at.desc(), model.id.desc()).all()
+        if has_archive(user_id, model.__tablename__):
+            oldest = (rows[-1].created_at, rows[-1].id) if rows else (datetime.max, 0)
+            headers["X-Next-Cursor"] = encode_cursor(*oldest)
+        return RowsResponse(rows, schema, headers)
+    
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be greater than 0")
+    try:
+        rows, next_cursor = page_history(db, model, user_id, limit, cursor, extra_filter, selected)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return RowsResponse(rows, schema, headers)
+
 # Transaction Endpoints
 @app.post("/transaction", response_model=TransactionResponse)
 async def create_transaction(
@@ -201,27 +318,27 @@ async def create_transaction(
         description=transaction.description
     )
     db.add(new_transaction)
+    db.flush()
+    record_transactions(db, [new_transaction])
     db.commit()
     db.refresh(new_transaction)
     
     # Check and award milestones
-    total_roundups = db.query(Transaction).filter(
-        Transaction.user_id == current_user.id
-    ).with_entities(Transaction.roundup_amount).all()
-    total_saved = sum([t[0] for t in total_roundups])
+    _, total_saved = transaction_totals(db, current_user.id)
     
-    milestones = db.query(Milestone).filter(Milestone.threshold <= total_saved).all()
-    for milestone in milestones:
-        existing = db.query(UserMilestone).filter(
+    reached = [m.id for m in milestone_catalog.get(db) if m.threshold <= total_saved]
+    if reached:
+        awarded = {milestone_id for (milestone_id,) in db.query(UserMilestone.milestone_id).filter(
             UserMilestone.user_id == current_user.id,
-            UserMilestone.milestone_id == milestone.id
-        ).first()
-        if not existing:
-            user_milestone = UserMilestone(
-                user_id=current_user.id,
-                milestone_id=milestone.id
-            )
-            db.add(user_milestone)
+            UserMilestone.milestone_id.in_(reached)
+        )}
+        for milestone_id in reached:
+            if milestone_id not in awarded:
+                user_milestone = UserMilestone(
+                    user_id=current_user.id,
+                    milestone_id=milestone_id
+                )
+                db.add(user_milestone)
     
     db.commit()
     
@@ -229,13 +346,12 @@ async def create_transaction(
 
 @app.get("/transactions", response_model=List[TransactionResponse])
 async def get_transactions(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    transactions = db.query(Transaction).filter(
-        Transaction.user_id == current_user.id
-    ).order_by(Transaction.created_at.desc()).all()
-    return transactions
+    return list_history(db, Transaction, TransactionResponse, current_user.id, limit, cursor)
 
 @app.delete("/transaction/{transaction_id}")
 async def delete_transaction(
@@ -256,16 +372,78 @@ async def delete_transaction(
         )
     
     # Delete transaction
+    record_transactions(db, [transaction], sign=-1)
     db.delete(transaction)
     db.commit()
     
     return {"status": "success", "message": "Transaction deleted successfully"}
 
+@app.get("/analytics/spending", response_model=SpendingAnalytics)
+async def get_spending_analytics(
+    from_month: Optional[str] = Query(None, alias="from"),
+    to_month: Optional[str] = Query(None, alias="to"),
+    group: str = "month",
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Spending and round-ups by month and/or category (from/to are YYYY-MM, inclusive)"""
+    if group not in SPENDING_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group must be one of: {', '.join(SPENDING_GROUPS)}")
+    for month in (from_month, to_month):
+        if month is not None:
+            try:
+                datetime.strptime(month, "%Y-%m")
+            except ValueError:
+                raise HTTPException(status_code=400, detail="from and to must be YYYY-MM")
+    rows = spending(db, current_user.id, from_month, to_month, group)
+    return {
+        "group": group,
+        "rows": rows,
+        "transaction_count": sum(r["transaction_count"] for r in rows),
+        "amount": round(sum(r["amount"] for r in rows), 2),
+        "roundups": round(sum(r["roundups"] for r in rows), 2),
+    }
+
+@app.get("/stats/percentile", response_model=PercentileResponse)
+async def get_percentile(
+    metric: str = "roundups",
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Where the user stands among all users: round-ups saved, amount invested or daily streak"""
+    if metric not in STATS_METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of: {', '.join(STATS_METRICS)}")
+    return percentile(db, current_user.id, metric)
+
 # Portfolio Endpoints
 @app.get("/portfolio-options", response_model=List[PortfolioOptionResponse])
-async def get_portfolio_options(db: Session = Depends(get_db)):
-    options = db.query(PortfolioOption).all()
-    return options
+async def get_portfolio_options(
+    response: Response,
+    q: Optional[str] = None,
+    asset_type: Optional[AssetType] = None,
+    risk: Optional[RiskProfile] = None,
+    sort: str = "id",
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Search the instrument catalog
+
+    `q` matches prefixes of the symbol or of words in the name; `sort` is one
+    of id, symbol, name, price, -price. Without `limit` every match is returned.
+    """
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be greater than 0")
+    index = catalog.get(db)
+    prices = price_snapshot()
+    try:
+        positions, next_cursor = index.search(q, asset_type, risk, sort, limit, cursor, prices)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return index.responses(positions, prices)
 
 @app.post("/select-portfolio", response_model=List[PortfolioSelectionResponse])
 async def select_portfolio(
@@ -273,29 +451,39 @@ async def select_portfolio(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    weights = selection.target_weights
+    if weights is not None:
+        if len(weights) != len(selection.portfolio_option_ids) or any(w < 0 for w in weights) or sum(weights) <= 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="target_weights must be non-negative, one per portfolio option, and not all zero"
+            )
+        weights = [w / sum(weights) for w in weights]
+    
     # Clear ALL existing selections (both user and auto-recommended)
+    cleared = db.query(PortfolioSelection.id).filter(
+        PortfolioSelection.user_id == current_user.id
+    ).all()
     db.query(PortfolioSelection).filter(
         PortfolioSelection.user_id == current_user.id
     ).delete()
+    log_changes(db, "portfolio_selections", "delete", [(current_user.id, selection_id) for (selection_id,) in cleared])
     
     # Add new selections
     selections = []
-    for option_id in selection.portfolio_option_ids:
+    for i, option_id in enumerate(selection.portfolio_option_ids):
         new_selection = PortfolioSelection(
             user_id=current_user.id,
             portfolio_option_id=option_id,
-            is_auto_recommended=False
+            is_auto_recommended=False,
+            target_weight=weights[i] if weights is not None else None
         )
         db.add(new_selection)
         selections.append(new_selection)
     
     # Auto-recommend based on risk profile if no selections
     if not selection.portfolio_option_ids:
-        portfolio_options = db.query(PortfolioOption).all()
-        recommended = get_auto_recommended_portfolios(
-            current_user.risk_profile.value,
-            portfolio_options
-        )
+        recommended = catalog.recommend(db, current_user.risk_profile.value)
         for option in recommended:
             new_selection = PortfolioSelection(
                 user_id=current_user.id,
@@ -324,11 +512,7 @@ async def get_portfolio(
     
     # If no selections, auto-recommend
     if not selections:
-        portfolio_options = db.query(PortfolioOption).all()
-        recommended = get_auto_recommended_portfolios(
-            current_user.risk_profile.value,
-            portfolio_options
-        )
+        recommended = catalog.recommend(db, current_user.risk_profile.value)
         for option in recommended:
             new_selection = PortfolioSelection(
                 user_id=current_user.id,
@@ -347,13 +531,13 @@ async def get_portfolio(
 
 @app.get("/investments", response_model=List[InvestmentResponse])
 async def get_investments(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    investments = db.query(Investment).filter(
-        Investment.user_id == current_user.id
-    ).order_by(Investment.created_at.desc()).all()
-    return investments
+    # Consolidated lots stand in for archived ones; the lots themselves are paged from the archive
+    return list_history(db, Investment, InvestmentResponse, current_user.id, limit, cursor, not_consolidated())
 
 @app.post("/invest-roundups")
 async def invest_roundups(
@@ -377,26 +561,12 @@ async def invest_roundups(
         current_user.wallet_balance -= amount
     else:
         # Check available roundups
-        roundups = db.query(Transaction.roundup_amount).filter(
-            Transaction.user_id == current_user.id
-        ).all()
-        total_roundups = sum([r[0] for r in roundups]) if roundups else 0.0
-        
-        # Check existing investments from roundups
-        investments = db.query(Investment).filter(
-            Investment.user_id == current_user.id
-        ).all()
-        invested_from_roundups = sum([
-            inv.amount for inv in investments 
-            if inv.payment_id and (inv.payment_id.startswith('ROUNDUP_') or inv.payment_id.startswith('PAY'))
-        ])
+        available = available_roundups(db, current_user.id)
         
-        available_roundups = total_roundups - invested_from_roundups
-        
-        if amount > available_roundups:
+        if amount > available:
             raise HTTPException(
                 status_code=400, 
-                detail=f"Insufficient roundups. Available: ₹{available_roundups:.2f}"
+                detail=f"Insufficient roundups. Available: ₹{available:.2f}"
             )
     
     # Get user's portfolio selections
@@ -406,11 +576,7 @@ async def invest_roundups(
     
     if not selections:
         # Auto-select based on risk profile
-        portfolio_options = db.query(PortfolioOption).all()
-        recommended = get_auto_recommended_portfolios(
-            current_user.risk_profile.value,
-            portfolio_options
-        )
+        recommended = catalog.recommend(db, current_user.risk_profile.value)
         for option in recommended:
             new_selection = PortfolioSelection(
                 user_id=current_user.id,
@@ -428,15 +594,19 @@ async def invest_roundups(
     import uuid
     prefix = "WALLET" if source == "wallet" else "ROUNDUP"
     payment_id = f"{prefix}_{uuid.uuid4().hex[:10].upper()}"
-    amount_per_selection = round(amount / len(selections), 2)
-    
-    for selection in selections:
-        units = round(amount_per_selection / selection.portfolio_option.current_price, 6)
+    prices = price_snapshot()
+    
+    # Split by target weight, topping up underweight holdings first
+    for selection, amount_for_selection in allocate_to_selections(db, current_user.id, selections, amount, prices):
+        if amount_for_selection <= 0:
+            continue
+        option = selection.portfolio_option
+        units = round(amount_for_selection / prices.get(option.id, option.current_price), 6)
         
         investment = Investment(
             user_id=current_user.id,
             portfolio_option_id=selection.portfolio_option_id,
-            amount=amount_per_selection,
+            amount=amount_for_selection,
             units=units,
             is_auto_recommended=selection.is_auto_recommended,
             payment_id=payment_id
@@ -453,6 +623,7 @@ async def invest_roundups(
     }
 
 @app.get("/investments/detailed", response_model=List[InvestmentDetailResponse])
+@coalesced(List[InvestmentDetailResponse])
 async def get_investments_detailed(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -475,10 +646,11 @@ async def get_investments_detailed(
         grouped[inv.portfolio_option_id]['total_amount'] += inv.amount
         grouped[inv.portfolio_option_id]['total_units'] += inv.units
     
-    # Calculate P&L for each
+    # Calculate P&L for each (all holdings valued against one price snapshot)
+    prices = price_snapshot()
     result = []
     for option_id, data in grouped.items():
-        current_price = data['portfolio_option'].current_price
+        current_price = prices.get(option_id, data['portfolio_option'].current_price)
         current_value = data['total_units'] * current_price
         profit_loss = current_value - data['total_amount']
         profit_loss_pct = (profit_loss / data['total_amount'] * 100) if data['total_amount'] > 0 else 0
@@ -500,6 +672,55 @@ async def get_investments_detailed(
     
     return result
 
+@app.get("/portfolio/rebalance", response_model=RebalancePlan)
+async def preview_rebalance(
+    tolerance: float = REBALANCE_TOLERANCE,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Dry run: drift against target weights and the orders a rebalance would place"""
+    prices = price_array(db)
+    plan = plan_rebalance(db, prices, [current_user.id], tolerance).get(current_user.id)
+    if not plan:
+        return {"total_value": 0.0, "holdings": [], "orders": []}
+    return plan_response(plan, prices)
+
+@app.get("/portfolio/history", response_model=PortfolioHistory)
+async def get_portfolio_history(
+    range: str = "1m",
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Daily portfolio value and cost from end-of-day snapshots (1m, 1y or all)"""
+    if range not in HISTORY_RANGES:
+        raise HTTPException(status_code=400, detail=f"range must be one of: {', '.join(HISTORY_RANGES)}")
+    return {"range": range, "points": history(db, current_user.id, range)}
+
+@app.get("/portfolio/risk", response_model=PortfolioRiskResponse)
+async def get_portfolio_risk(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Volatility, max drawdown and 1-day VaR of current holdings over the price history"""
+    return portfolio_risk(db, current_user)
+
+@app.post("/backtest", response_model=BacktestResponse)
+async def backtest_strategies(
+    request: BacktestRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Replay the user's round-ups (or a synthetic daily amount) into candidate allocations"""
+    if request.daily_amount is not None and request.daily_amount <= 0:
+        raise HTTPException(status_code=400, detail="daily_amount must be positive")
+    try:
+        return run_backtest(
+            db, current_user.id, [s.model_dump() for s in request.strategies],
+            request.start, request.end, request.daily_amount
+        )
+    except BacktestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.delete("/portfolio-selection/{option_id}")
 async def remove_portfolio_selection(
     option_id: int,
@@ -539,7 +760,7 @@ async def exit_investment(
     # Calculate total units and current value
     total_units = sum(inv.units for inv in investments)
     total_invested = sum(inv.amount for inv in investments)
-    current_price = investments[0].portfolio_option.current_price
+    current_price = price_snapshot().get(option_id, investments[0].portfolio_option.current_price)
     current_value = total_units * current_price
     profit_loss = current_value - total_invested
     
@@ -549,6 +770,8 @@ async def exit_investment(
     # Delete all investments for this option
     for inv in investments:
         db.delete(inv)
+    # Lots are gone without a new id: tell the snapshot job to recompute this user
+    db.add(HoldingReset(user_id=current_user.id, portfolio_option_id=option_id))
     
     db.commit()
     
@@ -563,26 +786,16 @@ async def exit_investment(
 
 # Dashboard Endpoint
 @app.get("/dashboard", response_model=DashboardStats)
+@coalesced(DashboardStats)
 async def get_dashboard(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    # Total transactions
-    total_transactions = db.query(Transaction).filter(
-        Transaction.user_id == current_user.id
-    ).count()
-    
-    # Total round-ups
-    roundups = db.query(Transaction.roundup_amount).filter(
-        Transaction.user_id == current_user.id
-    ).all()
-    total_roundups = sum([r[0] for r in roundups]) if roundups else 0.0
+    # Total transactions and round-ups
+    total_transactions, total_roundups = transaction_totals(db, current_user.id)
     
     # Total invested
-    investments = db.query(Investment.amount).filter(
-        Investment.user_id == current_user.id
-    ).all()
-    total_invested = sum([i[0] for i in investments]) if investments else 0.0
+    total_invested = sum(invested_by_source(db, current_user.id))
     
     # Portfolio allocation
     portfolio_data = db.query(Investment).filter(
@@ -627,15 +840,14 @@ async def get_milestones(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    milestones = db.query(Milestone).all()
-    user_milestones = db.query(UserMilestone).filter(
+    user_milestones = db.query(UserMilestone.milestone_id, UserMilestone.achieved_at).filter(
         UserMilestone.user_id == current_user.id
     ).all()
     
-    user_milestone_ids = {um.milestone_id: um.achieved_at for um in user_milestones}
+    user_milestone_ids = dict(user_milestones)
     
     result = []
-    for milestone in milestones:
+    for milestone in milestone_catalog.get(db):
         achieved = milestone.id in user_milestone_ids
         result.append({
             "id": milestone.id,
@@ -732,15 +944,18 @@ async def verify_payment(
         raise HTTPException(status_code=400, detail="No portfolio selected")
     
     # Distribute investment across selected portfolios
-    amount_per_selection = amount / len(selections)
+    prices = price_snapshot()
     
-    for selection in selections:
-        units = amount_per_selection / selection.portfolio_option.current_price
+    for selection, amount_for_selection in allocate_to_selections(db, current_user.id, selections, amount, prices):
+        if amount_for_selection <= 0:
+            continue
+        option = selection.portfolio_option
+        units = amount_for_selection / prices.get(option.id, option.current_price)
         
         investment = Investment(
             user_id=current_user.id,
             portfolio_option_id=selection.portfolio_option_id,
-            amount=amount_per_selection,
+            amount=amount_for_selection,
             units=units,
             is_auto_recommended=selection.is_auto_recommended,
             payment_id=payment_data.razorpay_payment_id
@@ -779,42 +994,29 @@ async def create_transfer(
     
     # Check roundups for investment amount (if any)
     if roundup_amount > 0:
-        roundups = db.query(Transaction.roundup_amount).filter(
-            Transaction.user_id == current_user.id
-        ).all()
-        total_roundups = sum([r[0] for r in roundups]) if roundups else 0.0
-        
-        # Check existing investments from roundups
-        investments = db.query(Investment).filter(
-            Investment.user_id == current_user.id
-        ).all()
-        invested_from_roundups = sum([
-            inv.amount for inv in investments 
-            if inv.payment_id and (inv.payment_id.startswith('ROUNDUP_') or inv.payment_id.startswith('PAY'))
-        ])
+        available = available_roundups(db, current_user.id)
         
-        available_roundups = total_roundups - invested_from_roundups
-        
-        if roundup_amount > available_roundups:
+        if roundup_amount > available:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Insufficient roundups for investment. Available: ₹{available_roundups:.2f}, Need: ₹{roundup_amount:.2f}"
+                detail=f"Insufficient roundups for investment. Available: ₹{available:.2f}, Need: ₹{roundup_amount:.2f}"
             )
     
-    # Deduct ONLY transfer amount from wallet (roundup comes from accumulated roundups)
-    current_user.wallet_balance -= transfer_amount
-    
     # Create transfer record
     import uuid
     transaction_id = f"TXN{uuid.uuid4().hex[:10].upper()}"
     
+    # Deduct ONLY transfer amount from wallet (roundup comes from accumulated roundups).
+    # The debit commits with the transfer in its shard and reaches the wallet through the outbox.
+    db.add(WalletOutbox(user_id=current_user.id, transaction_id=transaction_id, kind="debit", amount=-transfer_amount))
+    
     new_transfer = MoneyTransfer(
         user_id=current_user.id,
         recipient_upi=transfer_data.recipient_upi,
         recipient_mobile=transfer_data.recipient_mobile,
         recipient_name=transfer_data.recipient_name,
         amount=transfer_amount,  # Use rounded transfer amount
-        status=TransferStatus.SUCCESS,  # In production, this would be async
+        status=TransferStatus.PENDING,  # Settled by the transfer_settlement job
         transaction_id=transaction_id,
         description=transfer_data.description
     )
@@ -830,11 +1032,7 @@ async def create_transfer(
         
         if not selections:
             # Auto-select based on risk profile if no selections
-            portfolio_options = db.query(PortfolioOption).all()
-            recommended = get_auto_recommended_portfolios(
-                current_user.risk_profile.value,
-                portfolio_options
-            )
+            recommended = catalog.recommend(db, current_user.risk_profile.value)
             for option in recommended:
                 new_selection = PortfolioSelection(
                     user_id=current_user.id,
@@ -850,15 +1048,18 @@ async def create_transfer(
         
         if selections:
             # Distribute investment across selected portfolios
-            amount_per_selection = round(roundup_amount / len(selections), 2)
+            prices = price_snapshot()
             
-            for selection in selections:
-                units = round(amount_per_selection / selection.portfolio_option.current_price, 6)
+            for selection, amount_for_selection in allocate_to_selections(db, current_user.id, selections, roundup_amount, prices):
+                if amount_for_selection <= 0:
+                    continue
+                option = selection.portfolio_option
+                units = round(amount_for_selection / prices.get(option.id, option.current_price), 6)
                 
                 investment = Investment(
                     user_id=current_user.id,
                     portfolio_option_id=selection.portfolio_option_id,
-                    amount=amount_per_selection,
+                    amount=amount_for_selection,
                     units=units,
                     is_auto_recommended=selection.is_auto_recommended,
                     payment_id=f"ROUNDUP_{transaction_id}"
@@ -866,19 +1067,224 @@ async def create_transfer(
                 db.add(investment)
     
     db.commit()
+    apply_wallet_outbox(db, [transaction_id])
     db.refresh(new_transfer)
     
     return new_transfer
 
 @app.get("/transfers", response_model=List[MoneyTransferResponse])
 async def get_transfers(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    transfers = db.query(MoneyTransfer).filter(
+    return list_history(db, MoneyTransfer, MoneyTransferResponse, current_user.id, limit, cursor)
+
+TRANSFER_EVENTS_TIMEOUT = int(os.getenv("TRANSFER_EVENTS_TIMEOUT", "60"))
+
+@app.get("/transfers/{transfer_id}", response_model=MoneyTransferResponse)
+async def get_transfer(
+    transfer_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    transfer = db.query(MoneyTransfer).filter(
+        MoneyTransfer.id == transfer_id,
+        MoneyTransfer.user_id == current_user.id
+    ).first()
+    if not transfer:
+        raise HTTPException(status_code=404, detail="Transfer not found")
+    return transfer
+
+@app.get("/transfers/{transfer_id}/events")
+async def transfer_events(
+    transfer_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Server-sent events: the transfer's status until it settles (or the stream times out)"""
+    if not db.query(MoneyTransfer.id).filter(
+        MoneyTransfer.id == transfer_id,
         MoneyTransfer.user_id == current_user.id
-    ).order_by(MoneyTransfer.created_at.desc()).all()
-    return transfers
+    ).first():
+        raise HTTPException(status_code=404, detail="Transfer not found")
+    shard_id = shard_for_user(current_user.id)
+
+    def read_status():
+        # Own session: the request's session is closed once streaming starts
+        poll_db = shard_session(shard_id)
+        try:
+            transfer = poll_db.get(MoneyTransfer, transfer_id)
+            return MoneyTransferResponse.model_validate(transfer).model_dump(mode="json")
+        finally:
+            poll_db.close()
+
+    async def stream():
+        last = None
+        deadline = asyncio.get_running_loop().time() + TRANSFER_EVENTS_TIMEOUT
+        while True:
+            payload = await asyncio.to_thread(read_status)
+            if payload != last:
+                yield f"event: status\ndata: {json.dumps(payload)}\n\n"
+                last = payload
+            if payload["status"] != TransferStatus.PENDING.value or asyncio.get_running_loop().time() > deadline:
+                return
+            await asyncio.sleep(SETTLEMENT_INTERVAL / 2)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Recurring Investment Plan Endpoints
+@app.post("/plans", response_model=InvestmentPlanResponse)
+async def create_plan(
+    plan_data: InvestmentPlanCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Invest a fixed amount from the wallet every day, week or month"""
+    if plan_data.amount < SIP_MIN_AMOUNT:
+        raise HTTPException(status_code=400, detail=f"Minimum plan amount is ₹{SIP_MIN_AMOUNT:.2f}")
+    
+    active = db.query(func.count(InvestmentPlan.id)).filter(
+        InvestmentPlan.user_id == current_user.id,
+        InvestmentPlan.active.is_(True)
+    ).scalar()
+    if active >= SIP_MAX_PLANS_PER_USER:
+        raise HTTPException(status_code=400, detail=f"You can have at most {SIP_MAX_PLANS_PER_USER} active plans")
+    
+    now = datetime.utcnow()
+    start_at = plan_data.start_at or now
+    if start_at.tzinfo is not None:
+        # Plans run on naive UTC
+        start_at = start_at.astimezone(timezone.utc).replace(tzinfo=None)
+    plan = InvestmentPlan(
+        user_id=current_user.id,
+        amount=round(plan_data.amount, 2),
+        frequency=plan_data.frequency,
+        next_run_at=max(start_at, now)
+    )
+    db.add(plan)
+    db.commit()
+    db.refresh(plan)
+    return plan
+
+@app.get("/plans", response_model=List[InvestmentPlanResponse])
+async def get_plans(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return db.query(InvestmentPlan).filter(
+        InvestmentPlan.user_id == current_user.id
+    ).order_by(InvestmentPlan.active.desc(), InvestmentPlan.created_at.desc()).all()
+
+@app.delete("/plans/{plan_id}")
+async def cancel_plan(
+    plan_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    plan = db.query(InvestmentPlan).filter(
+        InvestmentPlan.id == plan_id,
+        InvestmentPlan.user_id == current_user.id
+    ).first()
+    if not plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    
+    plan.active = False
+    db.commit()
+    return {"status": "success", "message": "Plan cancelled"}
+
+@app.get("/plans/{plan_id}/executions", response_model=List[PlanExecutionResponse])
+async def get_plan_executions(
+    plan_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Executions live in the directory database, keyed by the plan's shard
+    return db.query(PlanExecution).filter(
+        PlanExecution.shard_id == shard_for_user(current_user.id),
+        PlanExecution.plan_id == plan_id,
+        PlanExecution.user_id == current_user.id
+    ).order_by(PlanExecution.id.desc()).all()
+
+# Price Alert Endpoints
+@app.post("/alerts", response_model=PriceAlertResponse)
+async def create_alert(
+    alert_data: PriceAlertCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Notify when an option's price crosses a threshold (once, or every time with repeat)"""
+    index = catalog.get(db)
+    position = index.position.get(alert_data.portfolio_option_id)
+    if position is None:
+        raise HTTPException(status_code=404, detail="Portfolio option not found")
+    if alert_data.threshold <= 0:
+        raise HTTPException(status_code=400, detail="Threshold must be greater than 0")
+    
+    option = index.options[position]
+    price = price_snapshot().get(option.id, option.current_price)
+    # Alerts fire on a crossing, so the price must start on the other side
+    if alert_data.direction == AlertDirection.BELOW and price <= alert_data.threshold:
+        raise HTTPException(status_code=400, detail=f"{option.symbol} is already at or below ₹{alert_data.threshold:.2f}")
+    if alert_data.direction == AlertDirection.ABOVE and price >= alert_data.threshold:
+        raise HTTPException(status_code=400, detail=f"{option.symbol} is already at or above ₹{alert_data.threshold:.2f}")
+    
+    active = db.query(func.count(PriceAlert.id)).filter(
+        PriceAlert.user_id == current_user.id,
+        PriceAlert.active.is_(True)
+    ).scalar()
+    if active >= ALERTS_MAX_PER_USER:
+        raise HTTPException(status_code=400, detail=f"You can have at most {ALERTS_MAX_PER_USER} active alerts")
+    
+    alert = PriceAlert(
+        user_id=current_user.id,
+        portfolio_option_id=option.id,
+        direction=alert_data.direction,
+        threshold=alert_data.threshold,
+        repeat=alert_data.repeat
+    )
+    db.add(alert)
+    db.commit()
+    db.refresh(alert)
+    return alert
+
+@app.get("/alerts", response_model=List[PriceAlertResponse])
+async def get_alerts(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return db.query(PriceAlert).filter(
+        PriceAlert.user_id == current_user.id
+    ).order_by(PriceAlert.active.desc(), PriceAlert.created_at.desc()).all()
+
+@app.delete("/alerts/{alert_id}")
+async def cancel_alert(
+    alert_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    alert = db.query(PriceAlert).filter(
+        PriceAlert.id == alert_id,
+        PriceAlert.user_id == current_user.id
+    ).first()
+    if not alert:
+        raise HTTPException(status_code=404, detail="Alert not found")
+    
+    # The alert engine drops it the next time it would fire
+    alert.active = False
+    db.commit()
+    return {"status": "success", "message": "Alert cancelled"}
+
+@app.get("/alerts/notifications", response_model=List[AlertNotificationResponse])
+async def get_alert_notifications(
+    limit: int = 50,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return db.query(AlertNotification).filter(
+        AlertNotification.user_id == current_user.id
+    ).order_by(AlertNotification.id.desc()).limit(min(max(limit, 1), 500)).all()
 
 # Wallet Deposit Endpoints
 @app.post("/wallet/create-order", response_model=OrderResponse)
@@ -973,15 +1379,13 @@ async def verify_wallet_payment(
     return deposit
 
 @app.get("/wallet", response_model=WalletBalanceResponse)
+@coalesced(WalletBalanceResponse)
 async def get_wallet_balance(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     # Get roundup savings
-    roundups = db.query(Transaction.roundup_amount).filter(
-        Transaction.user_id == current_user.id
-    ).all()
-    total_roundups = sum([r[0] for r in roundups]) if roundups else 0.0
+    _, total_roundups = transaction_totals(db, current_user.id)
     
     # Get recent deposits
     recent_deposits = db.query(WalletDeposit).filter(
@@ -1000,37 +1404,44 @@ async def get_deposits(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    deposits = db.query(WalletDeposit).filter(
+    deposits = db.query(*columns(WalletDeposit, WalletDepositResponse)).filter(
         WalletDeposit.user_id == current_user.id
     ).order_by(WalletDeposit.created_at.desc()).all()
-    return deposits
+    return RowsResponse(deposits, WalletDepositResponse)
+
+def _export_response(stream, prefix: str, format: str, start: datetime, end: datetime, compress: bool) -> StreamingResponse:
+    media_type = "application/gzip" if compress else export.FORMATS[format][0]
+    name = export.filename(prefix, format, start, end, compress)
+    return StreamingResponse(stream, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+@app.get("/export")
+async def export_history(
+    format: str = "csv",
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    compress: bool = Query(False, alias="gzip"),
+    current_user: User = Depends(get_current_user)
+):
+    """Stream the user's full statement (archived rows included) as csv, ndjson or parquet; from/to are inclusive YYYY-MM-DD"""
+    try:
+        start, end = export.parse_range(from_date, to_date)
+        stream = export.user_export(current_user.id, format, start, end, compress)
+    except export.ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _export_response(stream, f"statement-{current_user.id}", format, start, end, compress)
 
 @app.get("/investment-sources", response_model=InvestmentSourceResponse)
+@coalesced(InvestmentSourceResponse)
 async def get_investment_sources(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get breakdown of investments from roundups vs wallet"""
-    # Get all investments
-    investments = db.query(Investment).filter(
-        Investment.user_id == current_user.id
-    ).all()
-    
     # Categorize investments by payment ID
-    from_roundups = 0.0
-    from_wallet = 0.0
-    
-    for inv in investments:
-        if inv.payment_id and (inv.payment_id.startswith('ROUNDUP_') or inv.payment_id.startswith('PAY')):
-            from_roundups += inv.amount
-        else:
-            from_wallet += inv.amount
+    from_roundups, from_wallet = invested_by_source(db, current_user.id)
     
     # Calculate total roundups generated
-    roundups = db.query(Transaction.roundup_amount).filter(
-        Transaction.user_id == current_user.id
-    ).all()
-    total_roundups = sum([r[0] for r in roundups]) if roundups else 0.0
+    _, total_roundups = transaction_totals(db, current_user.id)
     
     # Roundup pool available for investment
     roundup_pool_available = total_roundups - from_roundups
@@ -1042,9 +1453,41 @@ async def get_investment_sources(
         "roundup_pool_available": round(max(0, roundup_pool_available), 2)
     }
 
+@app.get("/bootstrap", response_model=BootstrapResponse)
+@coalesced(BootstrapResponse)
+async def get_bootstrap(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Dashboard, wallet, portfolio, holdings, milestones and investment sources in one response (for page loads)"""
+    return await asyncio.to_thread(compose_bootstrap, db, current_user)
+
+@app.get("/sync", response_model=SyncResponse)
+async def sync_changes(
+    since: Optional[int] = None,
+    limit: int = SYNC_LIMIT,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Changes to the user's history after cursor `since`
+
+    Returns the current rows inserted or updated and the ids deleted since,
+    per table. Without `since`, only the current cursor is returned: take it
+    before a full download, then sync from it. Repeat while `has_more`.
+    """
+    if since is None:
+        return {"cursor": sync_head(db, current_user.id), "has_more": False}
+    if since < 0:
+        raise HTTPException(status_code=400, detail="since must not be negative")
+    return delta(db, current_user.id, since, max(1, min(limit, SYNC_LIMIT)))
+
 @app.post("/update-prices")
-async def manual_price_update(db: Session = Depends(get_db)):
-    """Manually trigger price update for testing (Admin only in production)"""
+async def manual_price_update(
+    admin: User = Depends(get_admin_user),
+    db: Session = Depends(get_db)
+):
+    """Manually trigger price update for testing (admin only)"""
     try:
         portfolio_options = db.query(PortfolioOption).all()
         updates = []
@@ -1064,6 +1507,7 @@ async def manual_price_update(db: Session = Depends(get_db)):
             })
         
         db.commit()
+        publish_prices(db)
         
         return {
             "status": "success",
@@ -1074,6 +1518,109 @@ async def manual_price_update(db: Session = Depends(get_db)):
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/admin/report")
+async def admin_report(admin: User = Depends(get_admin_user)):
+    """Platform-wide totals, aggregated across all user shards in parallel"""
+    def shard_totals(db: Session):
+        transactions = db.query(
+            func.count(Transaction.id), func.coalesce(func.sum(Transaction.roundup_amount), 0.0)
+        ).one()
+        invested = db.query(func.coalesce(func.sum(Investment.amount), 0.0)).scalar()
+        transfers = db.query(
+            func.count(MoneyTransfer.id), func.coalesce(func.sum(MoneyTransfer.amount), 0.0)
+        ).one()
+        return {
+            "transactions": transactions[0],
+            "roundups": transactions[1],
+            "invested": invested,
+            "transfers": transfers[0],
+            "transferred": transfers[1],
+        }
+
+    shards = await asyncio.to_thread(for_each_shard, shard_totals)
+    totals = {key: sum(s[key] for s in shards) for key in shards[0]}
+    
+    return {
+        "shard_count": SHARD_COUNT,
+        "total_transactions": totals["transactions"],
+        "total_roundups": round(totals["roundups"], 2),
+        "total_invested": round(totals["invested"], 2),
+        "total_transfers": totals["transfers"],
+        "total_transferred": round(totals["transferred"], 2),
+        "shards": shards
+    }
+
+@app.get("/admin/export")
+async def export_all_users(
+    format: str = "csv",
+    from_date: Optional[str] = Query(None, alias="from"),
+    to_date: Optional[str] = Query(None, alias="to"),
+    compress: bool = Query(False, alias="gzip"),
+    admin: User = Depends(get_admin_user)
+):
+    """Stream every user's statement rows, read from all shards in parallel (rows grouped by shard and type)"""
+    try:
+        start, end = export.parse_range(from_date, to_date)
+        stream = export.all_users_export(format, start, end, compress)
+    except export.ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _export_response(stream, "statements", format, start, end, compress)
+
+@app.get("/admin/risk/flagged", response_model=List[RiskScoreResponse])
+async def flagged_risk_scores(limit: int = 100, admin: User = Depends(get_admin_user)):
+    """Users whose holdings exceed their risk profile at the last nightly scoring, most volatile first"""
+    limit = max(1, min(limit, 1000))
+    flagged = [score for shard in for_each_shard(lambda db: db.query(RiskScore).filter(
+        RiskScore.exceeds_profile.is_(True)
+    ).order_by(RiskScore.volatility.desc()).limit(limit).all()) for score in shard]
+    return sorted(flagged, key=lambda score: score.volatility, reverse=True)[:limit]
+
+@app.get("/admin/scheduler")
+async def scheduler_status(admin: User = Depends(get_admin_user)):
+    """Leader state and per-job run statistics for this worker"""
+    return scheduler.status()
+
+def _profile_response(samples, name: str, format: str) -> Response:
+    if format not in profiler.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(profiler.FORMATS)}")
+    if format == "speedscope":
+        return Response(
+            json.dumps(profiler.speedscope(samples, name)), media_type="application/json",
+            headers={"Content-Disposition": f'attachment; filename="{name}.speedscope.json"'}
+        )
+    return Response(profiler.collapsed(samples), media_type="text/plain")
+
+@app.get("/admin/profile")
+async def profile_worker(seconds: float = 10, format: str = "collapsed", admin: User = Depends(get_admin_user)):
+    """Sample everything this worker runs for `seconds` (collapsed stacks or speedscope file)"""
+    if seconds <= 0:
+        raise HTTPException(status_code=400, detail="seconds must be positive")
+    profile = await profiler.sample_worker(seconds)
+    return _profile_response(profile.samples, f"worker-{profile.id}", format)
+
+@app.get("/admin/profiles")
+async def list_profiles(route: Optional[str] = None, admin: User = Depends(get_admin_user)):
+    """Buffered request profiles of this worker, newest first"""
+    return [p.summary() for p in reversed(profiler.profiles) if route is None or p.route == route]
+
+@app.get("/admin/profiles/stacks")
+async def merged_profile_stacks(route: Optional[str] = None, format: str = "collapsed", admin: User = Depends(get_admin_user)):
+    """Buffered request profiles merged (optionally for one route template, e.g. /dashboard)"""
+    return _profile_response(profiler.merged(route), "requests", format)
+
+@app.get("/admin/profiles/{profile_id}/stacks")
+async def profile_stacks(profile_id: int, format: str = "collapsed", admin: User = Depends(get_admin_user)):
+    """Stacks of one buffered request profile (see the X-Profile-Id response header)"""
+    profile = profiler.find(profile_id)
+    return _profile_response(profile.samples, f"request-{profile.id}", format)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    """Prometheus scrape endpoint for this worker (Bearer METRICS_TOKEN when set)"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics_registry.render() + coalesce.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
     return {"message": "Micro-Investment API", "status": "running"}
@@ -0,0 +1,203 @@
+"""
+Per-route request metrics and DB instrumentation
+
+MetricsMiddleware (plain ASGI) records, per method and route template:
+
+- a latency histogram, status counts and requests in flight
+- SQL statements and DB time, from cursor events on every engine
+  (directory and shards), as a per-request histogram and totals
+
+Statements slower than METRICS_SLOW_QUERY_MS are logged with their route
+and counted; statements run outside a request (scheduled jobs) are
+attributed to "(background)". Every response carries the DB time spent up
+to its headers in a Server-Timing header:
+
+    Server-Timing: db;dur=3.2;desc="4 queries", app;dur=11.8
+
+GET /metrics renders the registry in the Prometheus text format. Each
+worker process keeps and serves its own counters.
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from functools import lru_cache
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+from database import engine, shard_engines
+
+METRICS_SLOW_QUERY_MS = float(os.getenv("METRICS_SLOW_QUERY_MS", "200"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_BUCKETS = [float(b) for b in os.getenv("METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(",")]
+
+BACKGROUND = "(background)"
+UNMATCHED = "(unmatched)"
+
+class _RequestStats:
+    __slots__ = ("route", "statements", "db_seconds")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.statements = 0
+        self.db_seconds = 0.0
+
+# Stats of the request in flight; a mutable object, so sync endpoints on the
+# thread pool (which run in a copy of the context) add to the same one
+_current = contextvars.ContextVar("metrics_request", default=None)
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def labels(**pairs) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs.items()) + "}"
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)  # (method, route, status)
+        self.in_flight = defaultdict(int)  # (method, route)
+        self.latency = defaultdict(_Histogram)  # (method, route)
+        self.db_time = defaultdict(_Histogram)  # (method, route)
+        self.statements = defaultdict(int)  # route
+        self.statement_seconds = defaultdict(float)  # route
+        self.slow_queries = defaultdict(int)  # route
+
+    def started(self, method: str, route: str):
+        with self._lock:
+            self.in_flight[(method, route)] += 1
+
+    def finished(self, method: str, route: str, status: int, seconds: float, stats: _RequestStats):
+        with self._lock:
+            self.in_flight[(method, route)] -= 1
+            self.requests[(method, route, status)] += 1
+            self.latency[(method, route)].observe(seconds)
+            self.db_time[(method, route)].observe(stats.db_seconds)
+
+    def statement(self, route: str, seconds: float, slow: bool):
+        with self._lock:
+            self.statements[route] += 1
+            self.statement_seconds[route] += seconds
+            if slow:
+                self.slow_queries[route] += 1
+
+    def _histogram(self, lines: list, name: str, histograms: dict):
+        for (method, route), h in sorted(histograms.items()):
+            cumulative = 0
+            for bound, n in zip(METRICS_BUCKETS + [float("inf")], h.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{labels(method=method, route=route, le=le)} {cumulative}")
+            lines.append(f"{name}_sum{labels(method=method, route=route)} {h.sum:.6f}")
+            lines.append(f"{name}_count{labels(method=method, route=route)} {h.count}")
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP http_requests_total Requests by method, route and status",
+                "# TYPE http_requests_total counter",
+            ]
+            lines += [f"http_requests_total{labels(method=m, route=r, status=s)} {n}" for (m, r, s), n in sorted(self.requests.items())]
+            lines += ["# HELP http_requests_in_flight Requests being served", "# TYPE http_requests_in_flight gauge"]
+            lines += [f"http_requests_in_flight{labels(method=m, route=r)} {n}" for (m, r), n in sorted(self.in_flight.items())]
+            lines += ["# HELP http_request_duration_seconds Request latency", "# TYPE http_request_duration_seconds histogram"]
+            self._histogram(lines, "http_request_duration_seconds", self.latency)
+            lines += ["# HELP http_request_db_seconds DB time per request", "# TYPE http_request_db_seconds histogram"]
+            self._histogram(lines, "http_request_db_seconds", self.db_time)
+            lines += ["# HELP db_statements_total SQL statements executed", "# TYPE db_statements_total counter"]
+            lines += [f"db_statements_total{labels(route=r)} {n}" for r, n in sorted(self.statements.items())]
+            lines += ["# HELP db_statement_seconds_total Time spent executing SQL", "# TYPE db_statement_seconds_total counter"]
+            lines += [f"db_statement_seconds_total{labels(route=r)} {s:.6f}" for r, s in sorted(self.statement_seconds.items())]
+            lines += [f"# HELP db_slow_queries_total Statements over {METRICS_SLOW_QUERY_MS:g} ms", "# TYPE db_slow_queries_total counter"]
+            lines += [f"db_slow_queries_total{labels(route=r)} {n}" for r, n in sorted(self.slow_queries.items())]
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# DB instrumentation
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - getattr(context, "_metrics_start", time.perf_counter())
+    stats = _current.get()
+    route = stats.route if stats is not None else BACKGROUND
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += seconds
+    slow = seconds * 1000 >= METRICS_SLOW_QUERY_MS
+    registry.statement(route, seconds, slow)
+    if slow:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🐢 Slow query ({seconds * 1000:.0f} ms) on {route}: {' '.join(statement.split())[:500]}")
+
+def instrument_engines():
+    """Attach the cursor hooks to the directory and shard engines (idempotent)"""
+    for bound in {id(e): e for e in [engine, *shard_engines]}.values():
+        if not event.contains(bound, "before_cursor_execute", _before_cursor_execute):
+            event.listen(bound, "before_cursor_execute", _before_cursor_execute)
+            event.listen(bound, "after_cursor_execute", _after_cursor_execute)
+
+# Middleware
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        # Resolved up front (so in-flight gauges and slow-query logs have it); paths repeat
+        self._route = lru_cache(maxsize=8192)(self._match)
+
+    @staticmethod
+    def _match(app, method: str, path: str) -> str:
+        scope = {"type": "http", "method": method, "path": path, "root_path": ""}
+        partial = None
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+            if match == Match.PARTIAL and partial is None:
+                partial = route.path
+        return partial or UNMATCHED
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = self._route(scope["app"], method, scope["path"])
+        stats = _RequestStats(route)
+        token = _current.set(stats)
+        status = 500
+        start = time.perf_counter()
+        registry.started(method, route)
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.statements} queries", app;dur={(time.perf_counter() - start) * 1000:.1f}'
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", timing.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            registry.finished(method, route, status, time.perf_counter() - start, stats)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Enum
+from sqlalchemy import Column, Integer, String, Float, DateTime, Date, ForeignKey, Boolean, Enum, UniqueConstraint, Index, LargeBinary
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import enum
@@ -19,6 +19,15 @@ class TransferStatus(str, enum.Enum):
     SUCCESS = "success"
     FAILED = "failed"
 
+class AlertDirection(str, enum.Enum):
+    ABOVE = "above"
+    BELOW = "below"
+
+class PlanFrequency(str, enum.Enum):
+    DAILY = "daily"
+    WEEKLY = "weekly"
+    MONTHLY = "monthly"
+
 class DepositMethod(str, enum.Enum):
     UPI = "upi"
     CARD = "card"
@@ -33,6 +42,8 @@ class User(Base):
     hashed_password = Column(String, nullable=False)
     risk_profile = Column(Enum(RiskProfile), default=RiskProfile.MEDIUM)
     wallet_balance = Column(Float, default=0.0)
+    # Bumped after each of the user's writes; keys reusable read results (coalesce.py)
+    cache_generation = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     transactions = relationship("Transaction", back_populates="user")
@@ -59,11 +70,13 @@ class PortfolioOption(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
-    symbol = Column(String, nullable=False)
+    symbol = Column(String, nullable=False, unique=True, index=True)
     asset_type = Column(Enum(AssetType), nullable=False)
     risk_level = Column(Enum(RiskProfile), nullable=False)
     description = Column(String)
     current_price = Column(Float, default=0.0)
+    # Set by the catalog loader when anything but the price changes (catalog.py)
+    metadata_updated_at = Column(DateTime)
 
 class PortfolioSelection(Base):
     __tablename__ = "portfolio_selections"
@@ -72,6 +85,7 @@ class PortfolioSelection(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     portfolio_option_id = Column(Integer, ForeignKey("portfolio_options.id"))
     is_auto_recommended = Column(Boolean, default=False)
+    target_weight = Column(Float, nullable=True)  # None = equal weight
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="portfolio_selections")
@@ -79,6 +93,9 @@ class PortfolioSelection(Base):
 
 class Investment(Base):
     __tablename__ = "investments"
+    # AUTOINCREMENT on SQLite: exits delete the newest lots, and a reused id
+    # would hide the next lot from the snapshot watermark (see snapshots.py)
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -125,9 +142,35 @@ class MoneyTransfer(Base):
     transaction_id = Column(String)
     description = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)  # Picked up by a settlement worker
+    settled_at = Column(DateTime, nullable=True)
+    failure_reason = Column(String, nullable=True)
     
     user = relationship("User", back_populates="transfers")
 
+class WalletOutbox(Base):
+    """Wallet change owed for a transfer, written with the transfer's own status change (see settlement.py)"""
+    __tablename__ = "wallet_outbox"
+    __table_args__ = (UniqueConstraint("transaction_id", "kind"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    transaction_id = Column(String, nullable=False)  # MoneyTransfer.transaction_id
+    kind = Column(String, nullable=False)  # debit, refund
+    amount = Column(Float, nullable=False)  # Signed change to wallet_balance
+    created_at = Column(DateTime, default=datetime.utcnow)
+    applied_at = Column(DateTime, nullable=True)
+
+class WalletLedger(Base):
+    """Outbox entries already applied to wallet_balance; the key makes applying them idempotent"""
+    __tablename__ = "wallet_ledger"
+    
+    transaction_id = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    amount = Column(Float, nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
 class WalletDeposit(Base):
     __tablename__ = "wallet_deposits"
     
@@ -142,3 +185,191 @@ class WalletDeposit(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="deposits")
+
+class UserArchiveTotals(Base):
+    __tablename__ = "user_archive_totals"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    transaction_count = Column(Integer, default=0)
+    roundup_total = Column(Float, default=0.0)
+    archived_through = Column(DateTime)
+
+class SchedulerLease(Base):
+    __tablename__ = "scheduler_leases"
+    
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class SweepRun(Base):
+    __tablename__ = "sweep_runs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String, default="running")  # running, completed
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    users_invested = Column(Integer, default=0)
+    amount_invested = Column(Float, default=0.0)
+
+class SweepCheckpoint(Base):
+    __tablename__ = "sweep_checkpoints"
+    
+    run_id = Column(Integer, ForeignKey("sweep_runs.id"), primary_key=True)
+    shard_id = Column(Integer, primary_key=True)
+    last_user_id = Column(Integer, default=0)
+
+class PriceAlert(Base):
+    __tablename__ = "price_alerts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    portfolio_option_id = Column(Integer, ForeignKey("portfolio_options.id"))
+    direction = Column(Enum(AlertDirection), nullable=False)
+    threshold = Column(Float, nullable=False)
+    repeat = Column(Boolean, default=False)  # Re-arms after firing instead of switching off
+    active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_triggered_at = Column(DateTime, nullable=True)
+    
+    portfolio_option = relationship("PortfolioOption")
+
+class AlertNotification(Base):
+    __tablename__ = "alert_notifications"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    alert_id = Column(Integer, ForeignKey("price_alerts.id"))
+    portfolio_option_id = Column(Integer, ForeignKey("portfolio_options.id"))
+    direction = Column(Enum(AlertDirection), nullable=False)
+    threshold = Column(Float, nullable=False)
+    price = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class InvestmentPlan(Base):
+    __tablename__ = "investment_plans"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    amount = Column(Float, nullable=False)
+    frequency = Column(Enum(PlanFrequency), nullable=False)
+    active = Column(Boolean, default=True)
+    next_run_at = Column(DateTime, nullable=False, index=True)
+    last_run_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class PlanExecution(Base):
+    """One row per plan period, kept next to the wallets it debits (directory database)"""
+    __tablename__ = "plan_executions"
+    __table_args__ = (UniqueConstraint("shard_id", "plan_id", "period"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    shard_id = Column(Integer, nullable=False)
+    plan_id = Column(Integer, nullable=False)  # investment_plans.id within the shard
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    period = Column(String, nullable=False)  # e.g. 2026-10-19, 2026-W42, 2026-10
+    amount = Column(Float, nullable=False)
+    status = Column(String, nullable=False)  # funded, invested, insufficient_funds
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class HoldingReset(Base):
+    """Marks a holding whose lots were deleted (exit), for incremental snapshots"""
+    __tablename__ = "holding_resets"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    portfolio_option_id = Column(Integer, ForeignKey("portfolio_options.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class PortfolioSnapshot(Base):
+    __tablename__ = "portfolio_snapshots"
+    __table_args__ = (UniqueConstraint("user_id", "day"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    day = Column(Date, nullable=False, index=True)
+    total_value = Column(Float, nullable=False)
+    total_cost = Column(Float, nullable=False)
+    holdings = Column(LargeBinary, nullable=False)  # Packed (option_id, units, cost, value) records
+
+class SnapshotDay(Base):
+    """One row per snapshotted day in a shard, with the watermarks it was built from"""
+    __tablename__ = "snapshot_days"
+    
+    day = Column(Date, primary_key=True)
+    investment_watermark = Column(Integer, nullable=False)  # Highest investments.id included
+    reset_watermark = Column(Integer, nullable=False)  # Highest holding_resets.id included
+    users = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class PriceHistory(Base):
+    """Daily close per instrument, recorded by the end-of-day job or loaded from CSV"""
+    __tablename__ = "price_history"
+    
+    portfolio_option_id = Column(Integer, ForeignKey("portfolio_options.id"), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    close = Column(Float, nullable=False)
+
+class RiskScore(Base):
+    """Nightly risk measures of a user's holdings (see risk.py)"""
+    __tablename__ = "risk_scores"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, nullable=False, index=True)
+    total_value = Column(Float, nullable=False)
+    volatility = Column(Float, nullable=False)  # Annualized
+    max_drawdown = Column(Float, nullable=False)
+    var_historical = Column(Float, nullable=False)  # 1-day, in currency
+    var_parametric = Column(Float, nullable=False)
+    risk_level = Column(Enum(RiskProfile), nullable=False)
+    exceeds_profile = Column(Boolean, default=False, index=True)
+
+class RiskScoreDay(Base):
+    """One row per close a shard was scored for (also when it had no holders)"""
+    __tablename__ = "risk_score_days"
+    
+    day = Column(Date, primary_key=True)
+    users = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class SpendingRollup(Base):
+    """Per (user, month, category) transaction totals, maintained with every insert/delete"""
+    __tablename__ = "spending_rollups"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(String, primary_key=True)  # YYYY-MM
+    category = Column(String, primary_key=True)
+    transaction_count = Column(Integer, default=0)
+    amount_total = Column(Float, default=0.0)
+    roundup_total = Column(Float, default=0.0)
+
+class SpendingBackfill(Base):
+    """Progress of the shard's latest rollup backfill (one row, id 1; see analytics.py)"""
+    __tablename__ = "spending_backfills"
+    
+    id = Column(Integer, primary_key=True)
+    watermark = Column(Integer, nullable=False)  # Highest transactions.id the stream covers
+    streamed_through = Column(Integer, nullable=False)  # Highest id counted so far
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class StatsSketch(Base):
+    """Merged quantile sketch of one per-user metric across all shards (see stats.py)"""
+    __tablename__ = "stats_sketches"
+    
+    metric = Column(String, primary_key=True)
+    sketch = Column(String, nullable=False)  # KLLSketch JSON
+    users = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ChangeLog(Base):
+    """Per-user feed of inserts, updates and deletes for delta sync (see changes.py); id is the sync cursor"""
+    __tablename__ = "change_log"
+    # AUTOINCREMENT on SQLite: cursors must never be reused
+    __table_args__ = (Index("ix_change_log_user_seq", "user_id", "id"), {"sqlite_autoincrement": True})
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    entity = Column(String, nullable=False)  # Table name, e.g. transactions
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)  # insert, update, delete
+    created_at = Column(DateTime, default=datetime.utcnow)
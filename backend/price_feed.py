@@ -0,0 +1,197 @@
+"""
+Shared-memory price vector
+
+The scheduler leader publishes `PortfolioOption.current_price` into a
+`multiprocessing.shared_memory` block after each price update. Every uvicorn
+worker maps the same block, so valuations read one consistent set of prices
+without a DB round-trip.
+
+Layout: [seq: uint64][count: uint64][price: float64 * capacity], where the
+price of option `id` lives at slot `id` (NaN = not published). Writers follow
+the seqlock protocol: `seq` is odd while an update is in progress, and a
+reader retries if `seq` changed under it. Writers in different processes
+(startup seeding, the scheduler, POST /update-prices) take turns through an
+exclusive lock on a file next to the block.
+
+The block is named after PRICE_SHM_NAME and the database, so apps on the
+same host with different databases don't share prices. It outlives the
+workers, and every worker republishes the DB prices when it starts, so a
+block left over from an earlier run never serves its old prices.
+"""
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+from sqlalchemy import insert
+
+from database import DATABASE_URL
+from models import PortfolioOption, PriceHistory
+
+try:
+    import fcntl
+except ImportError:  # Not POSIX: single-process deployments only
+    fcntl = None
+
+PRICE_SHM_NAME = os.getenv("PRICE_SHM_NAME", "micro_investment_prices")
+PRICE_SHM_CAPACITY = int(os.getenv("PRICE_SHM_CAPACITY", "65536"))
+
+_HEADER_BYTES = 16
+_READ_RETRIES = 100
+
+class PriceSnapshot:
+    """Prices of one published version; `get` falls back to the caller's default"""
+
+    def __init__(self, version: int = 0, values: np.ndarray = None):
+        self.version = version
+        self.values = values
+
+    def get(self, option_id: int, default: float = None) -> float:
+        if self.values is None or not 0 <= option_id < len(self.values):
+            return default
+        price = self.values[option_id]
+        return default if np.isnan(price) else float(price)
+
+def block_name(prefix: str = PRICE_SHM_NAME, database_url: str = DATABASE_URL) -> str:
+    return f"{prefix}_{hashlib.blake2b(database_url.encode(), digest_size=4).hexdigest()}"
+
+class SharedPriceVector:
+    def __init__(self, name: str = None, capacity: int = PRICE_SHM_CAPACITY):
+        self.name = name or block_name()
+        self.capacity = capacity
+        self.shm = None
+        self.created = False
+
+    def open(self) -> bool:
+        """Create the block, or attach to the one another worker created"""
+        if self.shm is not None:
+            return True
+        size = _HEADER_BYTES + 8 * self.capacity
+        try:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+                self.created = True
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=self.name)
+        except OSError as e:
+            print(f"Shared price vector unavailable, reading prices from DB: {e}")
+            return False
+        # The block outlives individual workers; don't let the resource tracker
+        # unlink it when this process exits.
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self._header = np.ndarray((2,), dtype=np.uint64, buffer=self.shm.buf, offset=0)
+        self._prices = np.ndarray(
+            ((self.shm.size - _HEADER_BYTES) // 8,), dtype=np.float64, buffer=self.shm.buf, offset=_HEADER_BYTES
+        )[:self.capacity]
+        if self.created:
+            self._prices[:] = np.nan
+            self._header[:] = 0
+        return True
+
+    def close(self):
+        if self.shm is not None:
+            del self._header, self._prices
+            self.shm.close()
+            self.shm = None
+
+    @property
+    def version(self) -> int:
+        return int(self._header[0]) if self.shm is not None else 0
+
+    @contextmanager
+    def _writer(self):
+        """One writer at a time across processes: interleaved writers would break the seqlock"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(tempfile.gettempdir(), f"{self.name}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def publish(self, option_ids, prices, reset: bool = False):
+        """Write prices for the given option ids (with `reset`, every other slot becomes unpublished)"""
+        if self.shm is None:
+            return
+        ids = np.asarray(option_ids, dtype=np.int64)
+        values = np.asarray(prices, dtype=np.float64)
+        in_range = (ids >= 0) & (ids < self.capacity)
+        ids, values = ids[in_range], values[in_range]
+
+        with self._writer():
+            seq = int(self._header[0])
+            self._header[0] = seq + 1
+            if reset:
+                self._prices[:] = np.nan
+                self._header[1] = 0
+            self._prices[ids] = values
+            if len(ids):
+                self._header[1] = max(int(self._header[1]), int(ids.max()) + 1)
+            self._header[0] = seq + 2
+
+    def snapshot(self) -> PriceSnapshot:
+        if self.shm is None:
+            return PriceSnapshot()
+        for _ in range(_READ_RETRIES):
+            before = int(self._header[0])
+            if before & 1:
+                continue
+            values = self._prices[:int(self._header[1])].copy()
+            if int(self._header[0]) == before:
+                return PriceSnapshot(before, values) if before else PriceSnapshot()
+        return PriceSnapshot()
+
+price_vector = SharedPriceVector()
+
+def publish_prices(db, reset: bool = False):
+    """Publish the committed DB prices to all workers (`reset`: also drop prices of ids not in the DB)"""
+    rows = db.query(PortfolioOption.id, PortfolioOption.current_price).all()
+    if rows or reset:
+        ids, prices = zip(*rows) if rows else ((), ())
+        price_vector.publish(ids, prices, reset=reset)
+
+def price_snapshot() -> PriceSnapshot:
+    """
+    Current published prices
+
+    Use `snapshot.get(option.id, option.current_price)`: options that were
+    never published (or a worker without shared memory) keep the DB price.
+    """
+    return price_vector.snapshot()
+
+def price_array(db) -> np.ndarray:
+    """
+    One price snapshot for batch jobs, as an array indexed by option id
+
+    Starts from the DB prices and overlays the published shared-memory
+    prices; unknown ids are NaN.
+    """
+    rows = db.query(PortfolioOption.id, PortfolioOption.current_price).all()
+    size = max((option_id for option_id, _ in rows), default=-1) + 1
+    prices = np.full(size, np.nan)
+    for option_id, price in rows:
+        prices[option_id] = price
+
+    published = price_snapshot().values
+    if published is not None:
+        n = min(size, len(published))
+        mask = ~np.isnan(published[:n])
+        prices[:n][mask] = published[:n][mask]
+    return prices
+
+def record_closes(db, day, prices: np.ndarray = None) -> int:
+    """Store `day`'s close for every priced option, once; returns rows written"""
+    if db.query(PriceHistory.day).filter(PriceHistory.day == day).first():
+        return 0
+    prices = price_array(db) if prices is None else prices
+    option_ids = np.flatnonzero(~np.isnan(prices))
+    rows = [{"portfolio_option_id": int(i), "day": day, "close": float(prices[i])} for i in option_ids]
+    if rows:
+        db.execute(insert(PriceHistory.__table__), rows)
+        db.commit()
+    return len(rows)
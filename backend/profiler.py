@@ -0,0 +1,252 @@
+"""
+On-demand sampling profiler
+
+A sampler thread wakes every PROFILER_INTERVAL_MS while any profile is
+active, reads every thread's Python stack (sys._current_frames) and counts
+each busy stack once per active profile. Idle threads (event loop waiting
+in select, pool workers waiting for work) are skipped. Nothing runs while
+no profile is active.
+
+Profiles are taken three ways:
+
+- per request: an admin sends `X-Profile: 1`; the response carries
+  `X-Profile-Id`
+- per worker: GET /admin/profile?seconds=N samples whatever this worker
+  does for N seconds
+- always on: with PROFILER_SAMPLE_EVERY=N, one request in N (at random) is
+  profiled
+
+Request profiles go to a rolling buffer of the last PROFILER_BUFFER, where
+they can be read one by one or merged per route. Stacks are exported
+collapsed (`thread;module:function;... count`, the input of flamegraph.pl
+and speedscope) or as a speedscope JSON file.
+
+Samples cover every busy thread in the worker, so requests running
+concurrently with a profiled one show up in its profile as well. A short
+request gets a handful of samples; merging a route's buffered profiles
+gives the fuller picture.
+"""
+import asyncio
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from functools import lru_cache
+
+from fastapi import HTTPException
+
+from auth import decode_token, ADMIN_EMAILS
+
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+PROFILER_SAMPLE_EVERY = int(os.getenv("PROFILER_SAMPLE_EVERY", "0"))
+PROFILER_BUFFER = int(os.getenv("PROFILER_BUFFER", "200"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+FORMATS = ("collapsed", "speedscope")
+
+# Leaf frames of a thread that is waiting, not working
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("runners.py", "run"),
+    ("base_events.py", "run_forever"),
+    ("thread.py", "_worker"),
+}
+
+_ids = itertools.count(1)
+
+class Profile:
+    def __init__(self, kind: str, method: str = None, path: str = None):
+        self.id = next(_ids)
+        self.kind = kind  # request, sampled, window
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.started_at = datetime.utcnow()
+        self.seconds = None
+        self.ticks = 0
+        self.samples = Counter()
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "method": self.method,
+            "route": self.route or self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.seconds * 1000, 2) if self.seconds is not None else None,
+            "ticks": self.ticks,
+            "samples": sum(self.samples.values()),
+        }
+
+@lru_cache(maxsize=4096)
+def _module(filename: str) -> str:
+    for marker in ("site-packages/", "dist-packages/"):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+def _stack(frame, thread_name: str):
+    """Collapsed stack of a busy thread, root first, or None if it's idle"""
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+        return None
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{_module(code.co_filename)}:{code.co_qualname}")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+class Sampler:
+    """Shared sampling thread; runs only while profiles are active"""
+
+    def __init__(self):
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def discard(self, profile: Profile):
+        with self._lock:
+            self._active.discard(profile)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = [
+                _stack(frame, names.get(ident, str(ident)))
+                for ident, frame in sys._current_frames().items() if ident != me
+            ]
+            stacks = [s for s in stacks if s is not None]
+            with self._lock:
+                for profile in active:
+                    profile.ticks += 1
+                    profile.samples.update(stacks)
+            time.sleep(PROFILER_INTERVAL_MS / 1000)
+
+sampler = Sampler()
+profiles = deque(maxlen=PROFILER_BUFFER)
+
+async def sample_worker(seconds: float) -> Profile:
+    """Profile everything this worker does for `seconds`"""
+    profile = Profile("window")
+    sampler.add(profile)
+    start = time.perf_counter()
+    try:
+        await asyncio.sleep(min(seconds, PROFILER_MAX_SECONDS))
+    finally:
+        sampler.discard(profile)
+        profile.seconds = time.perf_counter() - start
+    return profile
+
+def find(profile_id: int) -> Profile:
+    for profile in profiles:
+        if profile.id == profile_id:
+            return profile
+    raise HTTPException(status_code=404, detail="Profile not found (it may have left the buffer)")
+
+def merged(route: str = None) -> Counter:
+    samples = Counter()
+    for profile in list(profiles):
+        if route is None or profile.route == route:
+            samples.update(profile.samples)
+    return samples
+
+# Exports
+
+def collapsed(samples: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in samples.most_common())
+
+def speedscope(samples: Counter, name: str) -> dict:
+    frames, index = [], {}
+    stacks, weights = [], []
+    for stack, n in samples.most_common():
+        path = []
+        for frame in stack.split(";"):
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({"name": frame})
+            path.append(index[frame])
+        stacks.append(path)
+        weights.append(n)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled", "name": name, "unit": "none",
+            "startValue": 0, "endValue": sum(weights), "samples": stacks, "weights": weights,
+        }],
+        "name": name,
+        "exporter": "micro-investment profiler",
+    }
+
+# Middleware
+
+def _requested_by_admin(scope) -> bool:
+    headers = dict(scope["headers"])
+    if headers.get(b"x-profile", b"") in (b"", b"0"):
+        return False
+    scheme, _, token = headers.get(b"authorization", b"").decode().partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        return decode_token(token).email in ADMIN_EMAILS
+    except HTTPException:
+        return False
+
+class ProfilerMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if _requested_by_admin(scope):
+            kind = "request"
+        elif PROFILER_SAMPLE_EVERY and random.random() * PROFILER_SAMPLE_EVERY < 1:
+            kind = "sampled"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(kind, scope["method"], scope["path"])
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                if kind == "request":
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", str(profile.id).encode())]}
+            await send(message)
+
+        sampler.add(profile)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.discard(profile)
+            profile.seconds = time.perf_counter() - start
+            route = scope.get("route")
+            profile.route = getattr(route, "path", None)
+            profiles.append(profile)
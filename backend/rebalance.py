@@ -0,0 +1,278 @@
+"""
+Target-weight allocation and rebalancing
+
+Each PortfolioSelection may carry a `target_weight` (None = equal weight).
+All math works on arrays whose last axis is the asset, so the same functions
+serve one user (1-D) or a whole shard padded into a (users x assets) matrix.
+
+- allocate_new_money: splits new money so underweight assets are topped up first
+- rebalance_trades: buy/sell trades that bring a user back to target once
+  any asset drifts more than `tolerance`, with buys funded by sells
+
+Rebalance trades are recorded as investment lots with a REBALANCE_ payment
+id: sells are negative lots carrying their share of the average cost basis,
+and buys carry the basis the sells removed (split by trade value), so a
+rebalance leaves the amount invested unchanged.
+
+    python rebalance.py                # dry run for every user
+    python rebalance.py --apply
+"""
+import argparse
+import json
+import os
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+from database import SessionLocal, for_each_shard
+from models import Investment
+from aggregates import holdings_by_user, targets_by_user
+from price_feed import price_array
+from changes import insert_logged
+
+REBALANCE_TOLERANCE = float(os.getenv("REBALANCE_TOLERANCE", "0.05"))
+REBALANCE_MIN_ORDER = float(os.getenv("REBALANCE_MIN_ORDER", "1.0"))
+
+def normalize_weights(weights) -> np.ndarray:
+    """Weights along the last axis summing to 1; NaN (unset) weights share the remainder equally"""
+    weights = np.asarray(weights, dtype=np.float64)
+    unset = np.isnan(weights)
+    if unset.any():
+        explicit = np.where(unset, 0.0, weights).sum(axis=-1, keepdims=True)
+        share = np.clip(1.0 - explicit, 0.0, None) / np.maximum(unset.sum(axis=-1, keepdims=True), 1)
+        # All weights unset -> equal weights
+        share = np.where(explicit > 0, share, 1.0 / np.maximum(unset.sum(axis=-1, keepdims=True), 1))
+        weights = np.where(unset, share, weights)
+    total = weights.sum(axis=-1, keepdims=True)
+    return np.divide(weights, total, out=np.zeros_like(weights), where=total > 0)
+
+def allocate_new_money(amount, targets, values) -> np.ndarray:
+    """
+    Split `amount` so each asset moves toward target, underweight assets first
+
+    Args:
+        amount: Scalar, or one amount per row
+        targets: Normalized target weights
+        values: Current market value per asset
+
+    Returns:
+        Amount per asset (sums to `amount`)
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    amount = np.asarray(amount, dtype=np.float64)[..., None]
+
+    desired = targets * (values.sum(axis=-1, keepdims=True) + amount)
+    # Deficits always add up to at least `amount`, so new money never goes
+    # to an asset that is already over its target.
+    deficit = np.clip(desired - values, 0.0, None)
+    total_deficit = deficit.sum(axis=-1, keepdims=True)
+    return np.where(
+        total_deficit > 0,
+        deficit * amount / np.where(total_deficit > 0, total_deficit, 1.0),
+        targets * amount
+    )
+
+def rebalance_trades(targets, values, tolerance: float = REBALANCE_TOLERANCE, min_order: float = REBALANCE_MIN_ORDER) -> np.ndarray:
+    """
+    Value to buy (+) or sell (-) per asset
+
+    A row rebalances once any asset's weight drifted more than `tolerance`
+    from target, and then every asset trades back to target (a single drifted
+    asset still needs the others as counterparties). Buys and sells are
+    scaled to match so no new money is needed.
+
+    >>> rebalance_trades([1/3, 1/3, 1/3], [400.0, 300.0, 300.0], tolerance=0.05).round(2).tolist()
+    [-66.67, 33.33, 33.33]
+    >>> rebalance_trades([1/3, 1/3, 1/3], [340.0, 330.0, 330.0], tolerance=0.05).tolist()
+    [0.0, 0.0, 0.0]
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    totals = values.sum(axis=-1, keepdims=True)
+    weights = np.divide(values, totals, out=np.zeros_like(values), where=totals > 0)
+
+    drifted = (np.abs(weights - targets) > tolerance).any(axis=-1, keepdims=True)
+    trades = np.where(drifted, targets * totals - values, 0.0)
+
+    buys = np.clip(trades, 0.0, None).sum(axis=-1, keepdims=True)
+    sells = np.clip(-trades, 0.0, None).sum(axis=-1, keepdims=True)
+    matched = np.minimum(buys, sells)
+    buy_scale = np.divide(matched, buys, out=np.zeros_like(buys), where=buys > 0)
+    sell_scale = np.divide(matched, sells, out=np.zeros_like(sells), where=sells > 0)
+    trades = np.where(trades > 0, trades * buy_scale, trades * sell_scale)
+    trades[np.abs(trades) < min_order] = 0.0
+    return trades
+
+def allocate_to_selections(db, user_id: int, selections: list, amount: float, prices) -> list:
+    """
+    Split new money across a user's selections by target weight, underweight first
+
+    Args:
+        selections: The user's PortfolioSelection rows
+        prices: PriceSnapshot used to value current holdings
+
+    Returns:
+        [(selection, amount), ...] rounded to paise, summing to `amount`
+    """
+    holdings = holdings_by_user(db, [user_id]).get(user_id, {})
+    option_ids = [s.portfolio_option_id for s in selections]
+    targets = normalize_weights([np.nan if s.target_weight is None else s.target_weight for s in selections])
+    values = [
+        holdings.get(o, (0.0, 0.0))[0] * prices.get(o, s.portfolio_option.current_price)
+        for o, s in zip(option_ids, selections)
+    ]
+    amounts = [round(float(a), 2) for a in allocate_new_money(amount, targets, values)]
+    if amounts:
+        # The whole amount is invested: rounding remainder goes to the largest slice
+        largest = int(np.argmax(amounts))
+        amounts[largest] = round(amounts[largest] + round(amount, 2) - sum(amounts), 2)
+    return list(zip(selections, amounts))
+
+def _price(prices, option_id: int) -> float:
+    return prices[option_id] if option_id < len(prices) else np.nan
+
+def _pad(users: list, per_user: dict, fill: float) -> np.ndarray:
+    width = max((len(per_user[u]) for u in users), default=0)
+    matrix = np.full((len(users), width), fill)
+    for i, u in enumerate(users):
+        matrix[i, :len(per_user[u])] = per_user[u]
+    return matrix
+
+def plan_rebalance(db, prices, user_ids=None, tolerance: float = REBALANCE_TOLERANCE) -> dict:
+    """
+    Rebalance plans for the given users (or every user in the shard)
+
+    Assets held but no longer selected have a target weight of 0.
+
+    Returns:
+        {user_id: {"options", "units", "costs", "values", "targets", "trades"}}
+    """
+    holdings = holdings_by_user(db, user_ids)
+    targets = targets_by_user(db, user_ids)
+    users = sorted(set(holdings) & set(targets))
+
+    options, units, costs, values, weights = {}, {}, {}, {}, {}
+    for u in users:
+        ids = sorted(set(holdings[u]) | set(targets[u]))
+        options[u] = ids
+        units[u] = [holdings[u].get(o, (0.0, 0.0))[0] for o in ids]
+        costs[u] = [holdings[u].get(o, (0.0, 0.0))[1] for o in ids]
+        values[u] = [units[u][i] * np.nan_to_num(_price(prices, o)) for i, o in enumerate(ids)]
+        # Held but unselected -> 0; selected -> explicit weight or NaN (equal share)
+        weights[u] = [targets[u].get(o, 0.0) for o in ids]
+
+    value_matrix = _pad(users, values, 0.0)
+    target_matrix = normalize_weights(_pad(users, weights, 0.0))
+    trade_matrix = rebalance_trades(target_matrix, value_matrix, tolerance) if users else value_matrix
+    # Never trade an option without a price
+    for i, u in enumerate(users):
+        for j, o in enumerate(options[u]):
+            if not _price(prices, o) > 0:
+                trade_matrix[i, j] = 0.0
+
+    return {
+        u: {
+            "options": options[u],
+            "units": units[u],
+            "costs": costs[u],
+            "values": values[u],
+            "targets": target_matrix[i, :len(options[u])].tolist(),
+            "trades": trade_matrix[i, :len(options[u])].tolist(),
+        }
+        for i, u in enumerate(users)
+    }
+
+def plan_response(plan: dict, prices) -> dict:
+    """RebalancePlan payload for one user's plan"""
+    total = sum(plan["values"])
+    holdings, orders = [], []
+    for i, option_id in enumerate(plan["options"]):
+        weight = plan["values"][i] / total if total > 0 else 0.0
+        holdings.append({
+            "portfolio_option_id": option_id,
+            "units": round(plan["units"][i], 6),
+            "current_value": round(plan["values"][i], 2),
+            "current_weight": round(weight, 4),
+            "target_weight": round(plan["targets"][i], 4),
+            "drift": round(weight - plan["targets"][i], 4),
+        })
+        trade = plan["trades"][i]
+        if trade:
+            orders.append({
+                "portfolio_option_id": option_id,
+                "side": "buy" if trade > 0 else "sell",
+                "amount": round(abs(trade), 2),
+                "units": round(abs(trade) / prices[option_id], 6),
+            })
+    return {"total_value": round(total, 2), "holdings": holdings, "orders": orders}
+
+def order_rows(user_id: int, plan: dict, prices, created_at: datetime) -> list:
+    """
+    Investment lots executing a plan
+
+    Sells remove their share of the average cost; buys take on that cost in
+    proportion to their trade value, so the lots' amounts net to zero.
+    """
+    sells, buys = [], []
+    for i, option_id in enumerate(plan["options"]):
+        trade = plan["trades"][i]
+        if trade < 0:
+            units = max(float(trade / prices[option_id]), -plan["units"][i])
+            sells.append((option_id, round(plan["costs"][i] * units / plan["units"][i], 2), units))
+        elif trade > 0:
+            buys.append((option_id, trade, float(trade / prices[option_id])))
+    # Buys are funded by sells only
+    if not sells or not buys:
+        return []
+
+    basis = -sum(amount for _, amount, _ in sells)
+    traded = sum(trade for _, trade, _ in buys)
+    buy_amounts = [round(basis * trade / traded, 2) for _, trade, _ in buys]
+    largest = int(np.argmax(buy_amounts))
+    buy_amounts[largest] = round(buy_amounts[largest] + basis - sum(buy_amounts), 2)
+    buys = [(option_id, amount, units) for (option_id, _, units), amount in zip(buys, buy_amounts)]
+
+    payment_id = f"REBALANCE_{uuid.uuid4().hex[:10].upper()}"
+    return [
+        {
+            "user_id": user_id,
+            "portfolio_option_id": option_id,
+            "amount": amount,
+            "units": round(units, 6),
+            "is_auto_recommended": False,
+            "payment_id": payment_id,
+            "created_at": created_at,
+        }
+        for option_id, amount, units in sells + buys
+    ]
+
+def rebalance_shard(db, prices, apply: bool = False, tolerance: float = REBALANCE_TOLERANCE) -> dict:
+    plans = plan_rebalance(db, prices, tolerance=tolerance)
+    now = datetime.utcnow()
+    rows = [row for user_id, plan in plans.items() for row in order_rows(user_id, plan, prices, now)]
+    if apply and rows:
+        insert_logged(db, Investment, rows)
+        db.commit()
+    return {
+        "users": len(plans),
+        "users_rebalanced": len({row["user_id"] for row in rows}),
+        "orders": len(rows),
+        "turnover": round(sum(abs(row["amount"]) for row in rows), 2),
+    }
+
+def run_rebalance(apply: bool = False, tolerance: float = REBALANCE_TOLERANCE) -> list:
+    db = SessionLocal()
+    try:
+        prices = price_array(db)
+    finally:
+        db.close()
+    return for_each_shard(lambda sdb: rebalance_shard(sdb, prices, apply, tolerance))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apply", action="store_true", help="record the orders (default: dry run)")
+    parser.add_argument("--tolerance", type=float, default=REBALANCE_TOLERANCE)
+    args = parser.parse_args()
+    print(json.dumps(run_rebalance(args.apply, args.tolerance), indent=2))
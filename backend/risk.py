@@ -0,0 +1,255 @@
+"""
+Portfolio risk analytics
+
+A RiskModel holds the daily simple returns of every held instrument over
+the last RISK_LOOKBACK_DAYS closes in `price_history`, along with their
+mean and covariance. The nightly job builds it over every held
+instrument; a worker that sees a new close rebuilds it over the
+instruments its previous model covered, and extends it when a holding
+references an instrument it doesn't cover.
+
+For a user, or a (users x options) weight matrix, every measure is a
+product against the model:
+
+- volatility: sqrt(w' S w), annualized
+- parametric VaR: z * daily volatility - mean return
+- historical VaR and max drawdown: from the portfolio return path R w
+
+All measures are for today's holdings over the lookback window. VaR is
+1-day at RISK_CONFIDENCE, in currency. Value in instruments without
+history counts as riskless cash and is reported as uncovered.
+
+Nightly, every user is scored shard by shard. Users whose volatility puts
+them above their `risk_profile` are flagged in `risk_scores`, and the
+close is recorded in `risk_score_days` so each shard is scored once per
+close.
+
+    python risk.py
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from statistics import NormalDist
+
+import numpy as np
+from sqlalchemy import func, insert, delete
+
+from database import SessionLocal, for_each_shard
+from models import User, Investment, PriceHistory, RiskScore, RiskScoreDay, RiskProfile
+from price_feed import price_array
+from backtest import forward_fill
+from snapshots import holding_records
+
+RISK_LOOKBACK_DAYS = int(os.getenv("RISK_LOOKBACK_DAYS", "252"))
+RISK_CONFIDENCE = float(os.getenv("RISK_CONFIDENCE", "0.95"))
+# Annualized volatility ceilings of the low and medium profiles
+RISK_VOLATILITY_LOW = float(os.getenv("RISK_VOLATILITY_LOW", "0.12"))
+RISK_VOLATILITY_MEDIUM = float(os.getenv("RISK_VOLATILITY_MEDIUM", "0.25"))
+RISK_HOUR_UTC = int(os.getenv("RISK_HOUR_UTC", "19"))
+RISK_CHUNK_USERS = 5000
+
+TRADING_DAYS = 252
+PROFILE_ORDER = [RiskProfile.LOW, RiskProfile.MEDIUM, RiskProfile.HIGH]
+
+def risk_level(volatility: np.ndarray) -> np.ndarray:
+    """Index into PROFILE_ORDER for annualized volatilities"""
+    return np.searchsorted([RISK_VOLATILITY_LOW, RISK_VOLATILITY_MEDIUM], volatility, side="left")
+
+class RiskModel:
+    def __init__(self, day, option_ids: list, returns: np.ndarray, requested=()):
+        self.day = day
+        # Instruments asked for, including those without history (so they don't force rebuilds)
+        self.requested = set(requested) | set(option_ids)
+        self.option_ids = option_ids
+        self.columns = {option_id: i for i, option_id in enumerate(option_ids)}
+        self.returns = returns  # (days, options)
+        self.mean = returns.mean(axis=0) if len(returns) else np.zeros(len(option_ids))
+        self.covariance = np.cov(returns, rowvar=False).reshape(len(option_ids), len(option_ids)) if len(returns) > 1 \
+            else np.zeros((len(option_ids), len(option_ids)))
+
+    @classmethod
+    def build(cls, db, option_ids: list) -> "RiskModel":
+        day = db.query(func.max(PriceHistory.day)).scalar()
+        days = [d for (d,) in db.query(PriceHistory.day).distinct().filter(PriceHistory.day <= day).order_by(
+            PriceHistory.day.desc()
+        ).limit(RISK_LOOKBACK_DAYS + 1)] if day else []
+        days.reverse()
+        if len(days) < 2 or not option_ids:
+            return cls(day, [], np.zeros((0, 0)), option_ids)
+
+        rows = db.query(PriceHistory.day, PriceHistory.portfolio_option_id, PriceHistory.close).filter(
+            PriceHistory.day >= days[0], PriceHistory.portfolio_option_id.in_(option_ids)
+        ).all()
+        covered = sorted({option_id for _, option_id, _ in rows})
+        day_index = {d: i for i, d in enumerate(days)}
+        column = {option_id: i for i, option_id in enumerate(covered)}
+        closes = np.full((len(days), len(covered)), np.nan)
+        for d, option_id, close in rows:
+            closes[day_index[d], column[option_id]] = close
+        closes = forward_fill(closes)
+        # Days before an instrument's first close contribute no return
+        returns = np.nan_to_num(closes[1:] / closes[:-1] - 1)
+        return cls(day, covered, returns, option_ids)
+
+    def weights(self, option_ids: np.ndarray, values: np.ndarray, rows: np.ndarray, n_rows: int) -> np.ndarray:
+        """(n_rows, options) value weights from (row, option, value) triples; rows are normalized by their total value"""
+        cols = np.array([self.columns.get(int(o), -1) for o in option_ids], dtype=np.int64)
+        totals = np.bincount(rows, weights=values, minlength=n_rows)
+        matrix = np.zeros((n_rows, len(self.option_ids)))
+        known = cols >= 0
+        np.add.at(matrix, (rows[known], cols[known]), values[known])
+        return matrix / np.where(totals > 0, totals, 1.0)[:, None]
+
+    def score(self, weights: np.ndarray) -> dict:
+        """Risk measures for each row of a (users, options) weight matrix, as fractions of value"""
+        if not len(self.option_ids) or not len(self.returns):
+            zeros = np.zeros(len(weights))
+            return {"volatility": zeros, "max_drawdown": zeros, "var_historical": zeros, "var_parametric": zeros}
+        daily_vol = np.sqrt(np.maximum(((weights @ self.covariance) * weights).sum(axis=1), 0))
+        paths = weights @ self.returns.T
+        nav = np.cumprod(1 + paths, axis=1)
+        nav = np.concatenate([np.ones((len(weights), 1)), nav], axis=1)
+        z = NormalDist().inv_cdf(RISK_CONFIDENCE)
+        return {
+            "volatility": daily_vol * np.sqrt(TRADING_DAYS),
+            "max_drawdown": (1 - nav / np.maximum.accumulate(nav, axis=1)).max(axis=1),
+            "var_historical": np.maximum(-np.percentile(paths, (1 - RISK_CONFIDENCE) * 100, axis=1), 0),
+            "var_parametric": np.maximum(z * daily_vol - weights @ self.mean, 0),
+        }
+
+class _ModelHolder:
+    """The current RiskModel, rebuilt on a new close or when a holding is outside its instruments"""
+
+    def __init__(self):
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get(self, db, option_ids=()) -> RiskModel:
+        """Model of the latest close covering `option_ids` and everything the previous model covered"""
+        day = db.query(func.max(PriceHistory.day)).scalar()
+        with self._lock:
+            model = self._model
+            known = model.requested if model is not None else set()
+            if model is None or model.day != day or set(option_ids) - known:
+                self._model = RiskModel.build(db, sorted(known | set(option_ids)))
+            return self._model
+
+def held_options() -> set:
+    """Every instrument held in any shard (one DISTINCT per shard; batch jobs only)"""
+    return {o for shard in for_each_shard(
+        lambda db: [o for (o,) in db.query(Investment.portfolio_option_id).distinct()]
+    ) for o in shard}
+
+models = _ModelHolder()
+
+def _measures(model: RiskModel, users: np.ndarray, records: np.ndarray, prices: np.ndarray) -> tuple:
+    """(user ids, total values, covered values, scores) for users sorted by id with their holdings"""
+    option_ids = records["option_id"].astype(np.int64)
+    price = np.full(len(records), np.nan)
+    in_range = option_ids < len(prices)
+    price[in_range] = prices[option_ids[in_range]]
+    values = np.where(np.isnan(price), records["cost"], records["units"] * np.nan_to_num(price))
+
+    starts = np.flatnonzero(np.concatenate(([True], users[1:] != users[:-1]))) if len(users) else np.zeros(0, dtype=np.int64)
+    rows = np.cumsum(np.concatenate(([False], users[1:] != users[:-1]))) if len(users) else np.zeros(0, dtype=np.int64)
+    weights = model.weights(option_ids, values, rows, len(starts))
+    totals = np.bincount(rows, weights=values, minlength=len(starts))
+    # Chunked: the return paths are (users x days)
+    parts = [model.score(weights[i:i + RISK_CHUNK_USERS]) for i in range(0, len(weights), RISK_CHUNK_USERS)] or [model.score(weights)]
+    scores = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    return users[starts], totals, weights.sum(axis=1) * totals, scores
+
+def portfolio_risk(db, user: User) -> dict:
+    users, records = holding_records(db, [user.id])
+    model = models.get(db, set(records["option_id"].tolist()))
+    _, totals, covered, scores = _measures(model, users, records, price_array(db))
+    value = float(totals[0]) if len(totals) else 0.0
+    pick = lambda key: float(scores[key][0]) if len(totals) else 0.0
+    level = PROFILE_ORDER[int(risk_level(pick("volatility")))]
+    return {
+        "as_of": model.day,
+        "lookback_days": len(model.returns),
+        "total_value": round(value, 2),
+        "covered_value": round(float(covered[0]) if len(totals) else 0.0, 2),
+        "volatility_percentage": round(pick("volatility") * 100, 2),
+        "max_drawdown_percentage": round(pick("max_drawdown") * 100, 2),
+        "var_historical": round(pick("var_historical") * value, 2),
+        "var_parametric": round(pick("var_parametric") * value, 2),
+        "confidence": RISK_CONFIDENCE,
+        "risk_level": level,
+        "risk_profile": user.risk_profile,
+        "exceeds_profile": PROFILE_ORDER.index(level) > PROFILE_ORDER.index(user.risk_profile),
+    }
+
+def score_shard(db, model: RiskModel, prices: np.ndarray, day) -> dict:
+    start = time.perf_counter()
+    users, records = holding_records(db)
+    user_ids, totals, _, scores = _measures(model, users, records, prices)
+    levels = risk_level(scores["volatility"])
+
+    profiles = {}
+    directory = SessionLocal()
+    try:
+        for i in range(0, len(user_ids), RISK_CHUNK_USERS):
+            chunk = [int(u) for u in user_ids[i:i + RISK_CHUNK_USERS]]
+            profiles.update(directory.query(User.id, User.risk_profile).filter(User.id.in_(chunk)))
+    finally:
+        directory.close()
+
+    rows = []
+    for i, user_id in enumerate(user_ids.tolist()):
+        profile = profiles.get(user_id, RiskProfile.MEDIUM)
+        rows.append({
+            "user_id": user_id,
+            "day": day,
+            "total_value": round(float(totals[i]), 2),
+            "volatility": float(scores["volatility"][i]),
+            "max_drawdown": float(scores["max_drawdown"][i]),
+            "var_historical": round(float(scores["var_historical"][i] * totals[i]), 2),
+            "var_parametric": round(float(scores["var_parametric"][i] * totals[i]), 2),
+            "risk_level": PROFILE_ORDER[levels[i]],
+            "exceeds_profile": bool(levels[i] > PROFILE_ORDER.index(profile)),
+        })
+    # Today's scores replace the previous night's in one transaction
+    table = RiskScore.__table__
+    db.execute(delete(table))
+    for i in range(0, len(rows), RISK_CHUNK_USERS):
+        db.execute(insert(table), rows[i:i + RISK_CHUNK_USERS])
+    db.merge(RiskScoreDay(day=day, users=len(rows)))
+    db.commit()
+    return {
+        "shard": db.info.get("shard_id", 0),
+        "users": len(rows),
+        "flagged": sum(1 for r in rows if r["exceeds_profile"]),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+def run_risk_scores() -> list:
+    """Score every user against the current model"""
+    db = SessionLocal()
+    try:
+        model = models.get(db, held_options())
+        prices = price_array(db)
+    finally:
+        db.close()
+    day = model.day or datetime.utcnow().date()
+    return for_each_shard(lambda sdb: score_shard(sdb, model, prices, day))
+
+def nightly_risk_scores():
+    """Scheduler entry point: score once per close, after RISK_HOUR_UTC"""
+    if datetime.utcnow().hour < RISK_HOUR_UTC:
+        return
+    db = SessionLocal()
+    try:
+        close = db.query(func.max(PriceHistory.day)).scalar()
+    finally:
+        db.close()
+    scored = for_each_shard(lambda sdb: sdb.query(func.max(RiskScoreDay.day)).scalar())
+    if close is not None and any(day is None or day < close for day in scored):
+        for result in run_risk_scores():
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚖️ Risk scores: {result}")
+
+if __name__ == "__main__":
+    print(json.dumps(run_risk_scores(), indent=2))
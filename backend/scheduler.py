@@ -0,0 +1,233 @@
+"""
+Periodic job scheduler shared by all uvicorn workers
+
+Every worker runs a Scheduler, but jobs registered with `cluster=True` only
+execute on the current leader. Leadership is a lease row in
+`scheduler_leases` that the leader keeps renewing; if it stops renewing
+(crash, shutdown) another worker takes over once the lease expires.
+
+A worker only acts as leader while the lease it last wrote has at least
+SCHEDULER_LEASE_MARGIN seconds left on its own clock, so a stalled event
+loop or renewal can't leave two workers running cluster jobs. Long cluster
+jobs also call `still_leader()` between batches and stop early once the
+lease they started under is no longer held.
+Jobs run on a worker thread, on a fixed-rate schedule with random jitter,
+and never overlap themselves: ticks missed while a run is still in progress
+are skipped.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal
+from models import SchedulerLease
+
+LEASE_NAME = "scheduler"
+LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "15"))
+LEASE_MARGIN = float(os.getenv("SCHEDULER_LEASE_MARGIN", "3"))
+
+# The scheduler whose lease the running cluster job started under
+_cluster_job_lease = contextvars.ContextVar("cluster_job_lease", default=None)
+
+def still_leader() -> bool:
+    """
+    Whether a cluster job may keep going; long jobs check this between batches
+
+    Always true outside cluster jobs (scripts, benchmarks, admin endpoints).
+    """
+    owner = _cluster_job_lease.get()
+    return owner is None or owner.holds_lease()
+
+class Job:
+    def __init__(self, name: str, func, interval: float, jitter: float = 0.0, cluster: bool = True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.cluster = cluster
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started_at = None
+        self.last_duration = None
+        self.last_error = None
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "jitter": self.jitter,
+            "cluster": self.cluster,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_started_at": self.last_started_at,
+            "last_duration": round(self.last_duration, 4) if self.last_duration is not None else None,
+            "last_error": self.last_error,
+        }
+
+class Scheduler:
+    def __init__(self, lease_seconds: int = LEASE_SECONDS, lease_margin: float = LEASE_MARGIN):
+        self.jobs = {}
+        self.lease_seconds = lease_seconds
+        self.lease_margin = lease_margin
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.is_leader = False
+        self._lease_deadline = 0.0  # time.monotonic() at which the lease we last wrote expires
+        self._tasks = []
+
+    def register(self, name: str, func, interval: float, jitter: float = 0.0, cluster: bool = True) -> Job:
+        """
+        Register a periodic job
+
+        Args:
+            name: Unique job name
+            func: Synchronous callable, run on a worker thread
+            interval: Seconds between runs
+            jitter: Up to this many seconds are added to each wait
+            cluster: Run on the leader only (exactly once across workers)
+        """
+        job = Job(name, func, interval, jitter, cluster)
+        self.jobs[name] = job
+        return job
+
+    def job(self, interval: float, jitter: float = 0.0, cluster: bool = True, name: str = None):
+        """Decorator form of `register`"""
+        def decorator(func):
+            self.register(name or func.__name__, func, interval, jitter, cluster)
+            return func
+        return decorator
+
+    # Leader election
+
+    def holds_lease(self) -> bool:
+        """Leader, with more than `lease_margin` seconds left on the lease it wrote"""
+        return self.is_leader and time.monotonic() < self._lease_deadline - self.lease_margin
+
+    def _try_acquire_lease(self) -> bool:
+        # Measured before the write: the lease may expire for others from then on
+        started = time.monotonic()
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.lease_seconds)
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                update(SchedulerLease)
+                .where(
+                    SchedulerLease.name == LEASE_NAME,
+                    or_(SchedulerLease.holder == self.worker_id, SchedulerLease.expires_at < now)
+                )
+                .values(holder=self.worker_id, expires_at=expires_at)
+            )
+            if result.rowcount == 0:
+                db.add(SchedulerLease(name=LEASE_NAME, holder=self.worker_id, expires_at=expires_at))
+                try:
+                    db.commit()
+                except IntegrityError:
+                    # Someone else holds a live lease
+                    db.rollback()
+                    return False
+            else:
+                db.commit()
+            self._lease_deadline = started + self.lease_seconds
+            return True
+        except Exception as e:
+            print(f"Scheduler lease error: {e}")
+            db.rollback()
+            return False
+        finally:
+            db.close()
+
+    def _release_lease(self):
+        db = SessionLocal()
+        try:
+            db.query(SchedulerLease).filter(
+                SchedulerLease.name == LEASE_NAME,
+                SchedulerLease.holder == self.worker_id
+            ).delete()
+            db.commit()
+        finally:
+            db.close()
+
+    async def _lease_loop(self):
+        while True:
+            is_leader = await asyncio.to_thread(self._try_acquire_lease)
+            if is_leader != self.is_leader:
+                state = "acquired" if is_leader else "lost"
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] Scheduler leadership {state} ({self.worker_id})")
+            self.is_leader = is_leader
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    # Execution
+
+    async def run_job(self, job: Job) -> bool:
+        """Run a job once now, unless it is already running; returns whether it ran"""
+        if job.running:
+            job.skipped += 1
+            return False
+        job.running = True
+        job.last_started_at = datetime.utcnow()
+        start = time.perf_counter()
+        # Copied into the worker thread's context by to_thread (see still_leader)
+        token = _cluster_job_lease.set(self if job.cluster else None)
+        try:
+            await asyncio.to_thread(job.func)
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            print(f"Job {job.name} failed: {e}")
+        finally:
+            _cluster_job_lease.reset(token)
+            job.last_duration = time.perf_counter() - start
+            job.runs += 1
+            job.running = False
+        return True
+
+    async def _job_loop(self, job: Job):
+        next_run = time.monotonic() + job.interval
+        while True:
+            await asyncio.sleep(max(0.0, next_run - time.monotonic()) + random.uniform(0, job.jitter))
+            if not job.cluster or self.holds_lease():
+                await self.run_job(job)
+            # Fixed rate; ticks that elapsed during a long run are skipped, not queued
+            now = time.monotonic()
+            next_run += job.interval
+            if next_run < now:
+                missed = int((now - next_run) // job.interval) + 1
+                job.skipped += missed
+                next_run += missed * job.interval
+
+    async def start(self):
+        self._tasks.append(asyncio.create_task(self._lease_loop()))
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._job_loop(job)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.is_leader:
+            await asyncio.to_thread(self._release_lease)
+            self.is_leader = False
+
+    def status(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "is_leader": self.is_leader,
+            "holds_lease": self.holds_lease(),
+            "jobs": [job.status() for job in self.jobs.values()],
+        }
+
+scheduler = Scheduler()
@@ -1,7 +1,7 @@
 from pydantic import BaseModel, EmailStr
-from datetime import datetime
-from typing import Optional, List
-from models import RiskProfile, AssetType, TransferStatus, DepositMethod
+from datetime import datetime, date
+from typing import Optional, List, Dict
+from models import RiskProfile, AssetType, TransferStatus, DepositMethod, AlertDirection, PlanFrequency
 
 # User Schemas
 class UserBase(BaseModel):
@@ -59,11 +59,13 @@ class PortfolioOptionResponse(BaseModel):
 
 class PortfolioSelectionCreate(BaseModel):
     portfolio_option_ids: List[int]
+    target_weights: Optional[List[float]] = None  # Same order as portfolio_option_ids; normalized
 
 class PortfolioSelectionResponse(BaseModel):
     id: int
     portfolio_option: PortfolioOptionResponse
     is_auto_recommended: bool
+    target_weight: Optional[float] = None
     created_at: datetime
     
     class Config:
@@ -149,6 +151,8 @@ class MoneyTransferResponse(BaseModel):
     transaction_id: Optional[str]
     description: Optional[str]
     created_at: datetime
+    settled_at: Optional[datetime] = None
+    failure_reason: Optional[str] = None
     
     class Config:
         from_attributes = True
@@ -181,8 +185,195 @@ class WalletBalanceResponse(BaseModel):
     total_available: float
     recent_deposits: List[WalletDepositResponse]
 
+# Rebalancing Schemas
+class RebalanceHolding(BaseModel):
+    portfolio_option_id: int
+    units: float
+    current_value: float
+    current_weight: float
+    target_weight: float
+    drift: float
+
+class RebalanceOrder(BaseModel):
+    portfolio_option_id: int
+    side: str  # "buy" or "sell"
+    amount: float
+    units: float
+
+class RebalancePlan(BaseModel):
+    total_value: float
+    holdings: List[RebalanceHolding]
+    orders: List[RebalanceOrder]
+
+# Price Alert Schemas
+class PriceAlertCreate(BaseModel):
+    portfolio_option_id: int
+    direction: AlertDirection
+    threshold: float
+    repeat: bool = False  # Fire on every crossing instead of once
+
+class PriceAlertResponse(BaseModel):
+    id: int
+    portfolio_option_id: int
+    direction: AlertDirection
+    threshold: float
+    repeat: bool
+    active: bool
+    created_at: datetime
+    last_triggered_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
+class AlertNotificationResponse(BaseModel):
+    id: int
+    alert_id: int
+    portfolio_option_id: int
+    direction: AlertDirection
+    threshold: float
+    price: float
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+# Recurring Investment Plan Schemas
+class InvestmentPlanCreate(BaseModel):
+    amount: float
+    frequency: PlanFrequency
+    start_at: Optional[datetime] = None  # Defaults to the next scheduler run
+
+class InvestmentPlanResponse(BaseModel):
+    id: int
+    amount: float
+    frequency: PlanFrequency
+    active: bool
+    next_run_at: datetime
+    last_run_at: Optional[datetime] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class PlanExecutionResponse(BaseModel):
+    id: int
+    period: str
+    amount: float
+    status: str
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class PortfolioHistoryPoint(BaseModel):
+    day: date
+    value: float
+    cost: float
+    profit_loss: float
+
+class PortfolioHistory(BaseModel):
+    range: str
+    points: List[PortfolioHistoryPoint]
+
+class BacktestStrategy(BaseModel):
+    name: Optional[str] = None
+    weights: Dict[int, float]  # portfolio option id -> weight, normalized to sum to 1
+
+class BacktestRequest(BaseModel):
+    strategies: List[BacktestStrategy]
+    start: Optional[date] = None
+    end: Optional[date] = None
+    daily_amount: Optional[float] = None  # Synthetic stream instead of the user's round-ups
+
+class BacktestPoint(BaseModel):
+    day: date
+    invested: float
+    value: float
+
+class BacktestResult(BaseModel):
+    name: str
+    weights: Dict[int, float]
+    start: date
+    end: date
+    invested: float
+    final_value: float
+    profit_loss: float
+    return_percentage: float
+    max_drawdown_percentage: float
+    points: List[BacktestPoint]
+
+class BacktestResponse(BaseModel):
+    results: List[BacktestResult]
+    cached: int  # Strategies answered from the cache
+
+class PortfolioRiskResponse(BaseModel):
+    as_of: Optional[date] = None  # Last close in the model
+    lookback_days: int
+    total_value: float
+    covered_value: float  # Value in instruments with price history
+    volatility_percentage: float  # Annualized
+    max_drawdown_percentage: float
+    var_historical: float  # 1-day value at risk at `confidence`
+    var_parametric: float
+    confidence: float
+    risk_level: RiskProfile
+    risk_profile: RiskProfile
+    exceeds_profile: bool
+
+class RiskScoreResponse(BaseModel):
+    user_id: int
+    day: date
+    total_value: float
+    volatility: float
+    max_drawdown: float
+    var_historical: float
+    var_parametric: float
+    risk_level: RiskProfile
+    exceeds_profile: bool
+    
+    class Config:
+        from_attributes = True
+
+class SpendingRow(BaseModel):
+    month: Optional[str] = None  # YYYY-MM
+    category: Optional[str] = None
+    transaction_count: int
+    amount: float
+    roundups: float
+
+class SpendingAnalytics(BaseModel):
+    group: str  # month, category or month_category
+    rows: List[SpendingRow]
+    transaction_count: int
+    amount: float
+    roundups: float
+
+class PercentileResponse(BaseModel):
+    metric: str  # roundups, invested or streak
+    value: float
+    percentile: Optional[float] = None  # % of users below `value`; None until the first rebuild
+    users: int
+    updated_at: Optional[datetime] = None
+
 class InvestmentSourceResponse(BaseModel):
     from_roundups: float  # Investments made from transaction roundups
     from_wallet: float    # Investments made from wallet deposits
     total_invested: float
     roundup_pool_available: float  # Remaining roundups not yet invested
+
+class BootstrapResponse(BaseModel):
+    dashboard: DashboardStats
+    wallet: WalletBalanceResponse
+    portfolio: List[PortfolioSelectionResponse]
+    investments_detailed: List[InvestmentDetailResponse]
+    milestones: List[MilestoneResponse]
+    investment_sources: InvestmentSourceResponse
+
+class SyncEntityChanges(BaseModel):
+    upserts: List[dict]  # Current rows inserted or updated after the cursor
+    deletes: List[int]  # Tombstones: ids deleted after the cursor
+
+class SyncResponse(BaseModel):
+    cursor: int  # Pass as `since` on the next call
+    has_more: bool
+    changes: Dict[str, SyncEntityChanges] = {}  # Per table, e.g. transactions
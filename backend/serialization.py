@@ -0,0 +1,155 @@
+"""
+Fast JSON for large list responses
+
+List endpoints select just the columns of their response schema and encode
+the row tuples straight to JSON, skipping ORM hydration and per-row
+Pydantic validation. For these flat schemas the output is the same as the
+response_model path: ISO datetimes, enum values, nulls for missing optional
+fields. Archived rows (dicts) go through the same encoder.
+
+Encoding uses orjson when it is installed and the stdlib encoder otherwise.
+
+    python serialization.py bench --rows 100000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, date
+from enum import Enum
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # Optional: same output, slower
+    orjson = None
+
+def schema_fields(schema) -> tuple:
+    return tuple(schema.model_fields)
+
+def columns(model, schema) -> list:
+    """Model columns backing a flat response schema, in field order"""
+    return [getattr(model, field) for field in schema_fields(schema)]
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def encode_rows(rows, fields: tuple) -> bytes:
+    """JSON array of objects from row tuples (in `fields` order) and/or dicts"""
+    return dumps([
+        {field: row.get(field) for field in fields} if isinstance(row, dict) else dict(zip(fields, row))
+        for row in rows
+    ])
+
+class RowsResponse(Response):
+    media_type = "application/json"
+
+    def __init__(self, rows, schema, headers: dict = None):
+        super().__init__(encode_rows(rows, schema_fields(schema)), headers=headers)
+
+# Benchmark
+
+def _measure(fn) -> tuple:
+    """(result, seconds, peak bytes); timed without tracemalloc, then traced"""
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+def bench(rows: int) -> dict:
+    import random
+    from datetime import timedelta
+    from typing import List
+    from pydantic import TypeAdapter
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import Session
+    from database import Base
+    from models import Transaction
+    from schemas import TransactionResponse
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine, tables=[Transaction.__table__])
+    random.seed(42)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(Transaction.__table__), [
+            {
+                "user_id": 1, "amount": round(random.uniform(10, 2000), 2), "roundup_amount": round(random.random(), 2),
+                "description": random.choice(["Swiggy order", "Uber ride", "Amazon.in", None]),
+                "created_at": now - timedelta(seconds=i * 37),
+            }
+            for i in range(rows)
+        ])
+    adapter = TypeAdapter(List[TransactionResponse])
+    fields = schema_fields(TransactionResponse)
+
+    def query_orm():
+        with Session(engine) as db:
+            return db.query(Transaction).filter(Transaction.user_id == 1).order_by(Transaction.created_at.desc()).all()
+
+    def query_columns():
+        with Session(engine) as db:
+            return db.query(*columns(Transaction, TransactionResponse)).filter(
+                Transaction.user_id == 1
+            ).order_by(Transaction.created_at.desc()).all()
+
+    def response_model_path(orm_rows):
+        # What FastAPI does with response_model: validate, dump in JSON mode, json.dumps
+        content = adapter.dump_python(adapter.validate_python(orm_rows), mode="json")
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+    orm_rows, orm_query_s, orm_query_peak = _measure(query_orm)
+    baseline, baseline_s, baseline_peak = _measure(lambda: response_model_path(orm_rows))
+    column_rows, column_query_s, column_query_peak = _measure(query_columns)
+    fast, fast_s, fast_peak = _measure(lambda: encode_rows(column_rows, fields))
+
+    global orjson
+    installed, orjson = orjson, None
+    try:
+        stdlib, stdlib_s, stdlib_peak = _measure(lambda: encode_rows(column_rows, fields))
+    finally:
+        orjson = installed
+
+    result = {
+        "rows": rows,
+        "orjson": orjson is not None,
+        "identical_output": json.loads(baseline) == json.loads(fast) == json.loads(stdlib),
+        "response_bytes": len(fast),
+        "response_model": {
+            "query_ms": round(orm_query_s * 1000, 1), "serialize_ms": round(baseline_s * 1000, 1),
+            "query_peak_mb": round(orm_query_peak / 1e6, 1), "serialize_peak_mb": round(baseline_peak / 1e6, 1),
+        },
+        "columns_stdlib": {
+            "query_ms": round(column_query_s * 1000, 1), "serialize_ms": round(stdlib_s * 1000, 1),
+            "query_peak_mb": round(column_query_peak / 1e6, 1), "serialize_peak_mb": round(stdlib_peak / 1e6, 1),
+        },
+    }
+    if orjson is not None:
+        result["columns_orjson"] = {
+            "query_ms": round(column_query_s * 1000, 1), "serialize_ms": round(fast_s * 1000, 1),
+            "query_peak_mb": round(column_query_peak / 1e6, 1), "serialize_peak_mb": round(fast_peak / 1e6, 1),
+        }
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_args = commands.add_parser("bench", help="response_model path vs column rows, stdlib and orjson")
+    bench_args.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+    print(json.dumps(bench(args.rows), indent=2))
@@ -0,0 +1,281 @@
+"""
+Asynchronous settlement of money transfers
+
+POST /transfer records the transfer as PENDING; this module settles it
+later. A scheduler job drains every shard's queue with a pool of worker
+threads: each worker claims a batch of PENDING transfers, sends it to the
+payout adapter in one call and records the outcome with set-based updates.
+
+Wallets live in the directory database and transfers in their shard, so the
+wallet side goes through an outbox: the debit (written with the PENDING row)
+and the refund of a FAILED transfer (written with its status) are
+`wallet_outbox` rows in the shard, applied to wallet_balance right after the
+commit and keyed by transaction id in `wallet_ledger` so each applies once.
+Entries a crash left unapplied are picked up by the next settlement run.
+
+A claim is just `claimed_at`; claims older than SETTLEMENT_CLAIM_TIMEOUT
+(a worker died mid-batch) are picked up again, so adapters must treat
+`transaction_id` as an idempotency key.
+
+Adapters are chosen with PAYOUT_ADAPTER: "local" (simulated latency and
+failures) or a "module:ClassName" import path.
+"""
+import contextvars
+import importlib
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, bindparam, or_
+from sqlalchemy.exc import IntegrityError
+
+from database import SHARD_COUNT, shard_session
+from models import MoneyTransfer, TransferStatus, User, WalletOutbox, WalletLedger
+from changes import log_changes
+from scheduler import still_leader
+
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", "200"))
+SETTLEMENT_WORKERS = int(os.getenv("SETTLEMENT_WORKERS", "4"))
+SETTLEMENT_INTERVAL = float(os.getenv("SETTLEMENT_INTERVAL", "2"))
+SETTLEMENT_CLAIM_TIMEOUT = int(os.getenv("SETTLEMENT_CLAIM_TIMEOUT", "300"))
+PAYOUT_ADAPTER = os.getenv("PAYOUT_ADAPTER", "local")
+
+class PayoutAdapter:
+    """Sends a batch of transfers to the payout rail"""
+
+    def payout(self, transfers: list) -> dict:
+        """
+        Args:
+            transfers: [{"id", "transaction_id", "amount", "recipient_upi",
+                         "recipient_mobile", "recipient_name"}, ...]
+                `transaction_id` is the idempotency key: a transfer sent
+                again (its batch was re-claimed) must get its first outcome
+                back without being paid twice.
+
+        Returns:
+            {transfer_id: None on success, or a failure reason}
+        """
+        raise NotImplementedError
+
+class LocalPayoutAdapter(PayoutAdapter):
+    """Stand-in rail: one simulated network round-trip per batch, random failures"""
+
+    def __init__(self, latency_ms: float = None, failure_rate: float = None):
+        self.latency_ms = latency_ms if latency_ms is not None else float(os.getenv("LOCAL_PAYOUT_LATENCY_MS", "150"))
+        self.failure_rate = failure_rate if failure_rate is not None else float(os.getenv("LOCAL_PAYOUT_FAILURE_RATE", "0.02"))
+        self._outcomes = {}  # transaction_id -> outcome of its first payout
+        self._lock = threading.Lock()
+
+    def payout(self, transfers: list) -> dict:
+        time.sleep(self.latency_ms / 1000 * random.uniform(0.5, 1.5))
+        results = {}
+        with self._lock:
+            for t in transfers:
+                if t["transaction_id"] not in self._outcomes:
+                    self._outcomes[t["transaction_id"]] = (
+                        "Beneficiary bank declined the transfer" if random.random() < self.failure_rate else None
+                    )
+                results[t["id"]] = self._outcomes[t["transaction_id"]]
+        return results
+
+def load_adapter(name: str = PAYOUT_ADAPTER) -> PayoutAdapter:
+    if name == "local":
+        return LocalPayoutAdapter()
+    module_name, class_name = name.split(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+# Columns read at claim time: the payout payload plus the owner for refunds
+_CLAIMED = (
+    MoneyTransfer.id, MoneyTransfer.user_id, MoneyTransfer.transaction_id, MoneyTransfer.amount,
+    MoneyTransfer.recipient_upi, MoneyTransfer.recipient_mobile, MoneyTransfer.recipient_name,
+)
+
+def _claim(db, now: datetime, limit: int) -> list:
+    """Claim up to `limit` claimable transfers; returns the rows actually claimed"""
+    stale = now - timedelta(seconds=SETTLEMENT_CLAIM_TIMEOUT)
+    claimable = (
+        MoneyTransfer.status == TransferStatus.PENDING,
+        or_(MoneyTransfer.claimed_at.is_(None), MoneyTransfer.claimed_at < stale),
+    )
+    ids = db.execute(
+        select(MoneyTransfer.id).where(*claimable).order_by(MoneyTransfer.id).limit(limit)
+    ).scalars().all()
+    if not ids:
+        return []
+    # Re-checked in the UPDATE: rows settled or claimed by someone else since the read are not ours
+    transfers = db.execute(
+        update(MoneyTransfer)
+        .where(MoneyTransfer.id.in_(ids), *claimable)
+        .values(claimed_at=now)
+        .returning(*_CLAIMED)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+    return sorted(transfers, key=lambda t: t.id)
+
+def apply_wallet_outbox(db, transaction_ids: list = None) -> int:
+    """
+    Apply the session's shard's unapplied wallet entries (or just those of
+    `transaction_ids`) to wallet_balance; returns how many were applied now
+
+    The ledger row and the balance change commit together in the directory,
+    so an entry applied before a crash or by a concurrent caller is skipped
+    rather than applied twice. Entries found in the ledger get `applied_at`;
+    fresh ones keep it unset until the next pass (the settlement run) sees
+    them there, which saves a second commit on the request path.
+    """
+    query = select(
+        WalletOutbox.id, WalletOutbox.user_id, WalletOutbox.transaction_id, WalletOutbox.kind, WalletOutbox.amount
+    ).where(WalletOutbox.applied_at.is_(None))
+    if transaction_ids is not None:
+        query = query.where(WalletOutbox.transaction_id.in_(transaction_ids))
+    entries = db.execute(query).all()
+    if not entries:
+        return 0
+    done = set(db.execute(
+        select(WalletLedger.transaction_id, WalletLedger.kind)
+        .where(WalletLedger.transaction_id.in_({e.transaction_id for e in entries}))
+    ).all())
+    new = [e for e in entries if (e.transaction_id, e.kind) not in done]
+    now = datetime.utcnow()
+    if new:
+        users_table = User.__table__
+        changes = defaultdict(float)
+        for e in new:
+            changes[e.user_id] += e.amount
+        try:
+            db.execute(insert(WalletLedger), [
+                {"transaction_id": e.transaction_id, "kind": e.kind, "user_id": e.user_id, "amount": e.amount, "applied_at": now}
+                for e in new
+            ])
+            # Core executemany: one statement per batch rather than per row
+            db.execute(
+                update(users_table)
+                .where(users_table.c.id == bindparam("wallet_user_id"))
+                .values(wallet_balance=users_table.c.wallet_balance + bindparam("change")),
+                [{"wallet_user_id": user_id, "change": amount} for user_id, amount in changes.items()]
+            )
+            db.commit()
+        except IntegrityError:
+            # Another caller applied some of these first; the next pass sorts them out
+            db.rollback()
+            return 0
+    applied = [e.id for e in entries if (e.transaction_id, e.kind) in done]
+    if applied:
+        db.execute(
+            update(WalletOutbox)
+            .where(WalletOutbox.id.in_(applied))
+            .values(applied_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    return len(new)
+
+def _finalize(db, transfers: list, results: dict, now: datetime):
+    succeeded = [t.id for t in transfers if results.get(t.id, "No response from payout rail") is None]
+    failed = [t.id for t in transfers if t.id not in set(succeeded)]
+
+    # Only rows still PENDING move; a batch finalized twice (re-claimed after
+    # the timeout) changes and refunds each transfer once
+    settled, refunded = [], []
+    if succeeded:
+        settled = db.execute(
+            update(MoneyTransfer)
+            .where(MoneyTransfer.id.in_(succeeded), MoneyTransfer.status == TransferStatus.PENDING)
+            .values(status=TransferStatus.SUCCESS, settled_at=now)
+            .returning(MoneyTransfer.user_id, MoneyTransfer.id)
+            .execution_options(synchronize_session=False)
+        ).all()
+    if failed:
+        refunded = db.execute(
+            update(MoneyTransfer)
+            .where(MoneyTransfer.id.in_(failed), MoneyTransfer.status == TransferStatus.PENDING)
+            .values(status=TransferStatus.FAILED, settled_at=now)
+            .returning(MoneyTransfer.user_id, MoneyTransfer.id, MoneyTransfer.transaction_id, MoneyTransfer.amount)
+            .execution_options(synchronize_session=False)
+        ).all()
+    if refunded:
+        # ORM bulk update by primary key: one executemany per batch
+        db.execute(update(MoneyTransfer), [
+            {"id": t.id, "failure_reason": results.get(t.id) or "No response from payout rail"} for t in refunded
+        ])
+        db.execute(insert(WalletOutbox), [
+            {"user_id": t.user_id, "transaction_id": t.transaction_id, "kind": "refund", "amount": t.amount, "created_at": now}
+            for t in refunded
+        ])
+    log_changes(db, "money_transfers", "update", [(t.user_id, t.id) for t in settled + refunded])
+    # Status and refund intent commit together in the shard; the refund then
+    # reaches the wallet (in the directory database) through the outbox
+    db.commit()
+    if refunded:
+        apply_wallet_outbox(db, [t.transaction_id for t in refunded])
+    return len(settled), len(refunded)
+
+def settle_shard(shard_id: int, adapter: PayoutAdapter, workers: int = SETTLEMENT_WORKERS,
+                 batch_size: int = SETTLEMENT_BATCH_SIZE) -> dict:
+    """Drain one shard's queue; workers claim batches one at a time and pay out concurrently"""
+    claim_lock = threading.Lock()
+    stats = {"shard": shard_id, "batches": 0, "succeeded": 0, "failed": 0}
+    stats_lock = threading.Lock()
+
+    def worker():
+        db = shard_session(shard_id)
+        try:
+            while True:
+                # Stop claiming once this worker no longer holds the scheduler lease
+                if not still_leader():
+                    return
+                with claim_lock:
+                    transfers = _claim(db, datetime.utcnow(), batch_size)
+                if not transfers:
+                    return
+                payload = [{
+                    "id": t.id,
+                    "transaction_id": t.transaction_id,
+                    "amount": t.amount,
+                    "recipient_upi": t.recipient_upi,
+                    "recipient_mobile": t.recipient_mobile,
+                    "recipient_name": t.recipient_name,
+                } for t in transfers]
+                try:
+                    results = adapter.payout(payload)
+                except Exception as e:
+                    # Leave the batch claimed; it is retried after the claim times out
+                    print(f"Payout batch failed on shard {shard_id}: {e}")
+                    return
+                succeeded, failed = _finalize(db, transfers, results, datetime.utcnow())
+                with stats_lock:
+                    stats["batches"] += 1
+                    stats["succeeded"] += succeeded
+                    stats["failed"] += failed
+        finally:
+            db.close()
+
+    # Wallet changes left behind by a crash between a commit and its apply
+    db = shard_session(shard_id)
+    try:
+        apply_wallet_outbox(db)
+    finally:
+        db.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(contextvars.copy_context().run, worker) for _ in range(workers)]:
+            future.result()
+    return stats
+
+_adapter = None
+
+def run_settlement() -> list:
+    """Scheduler entry point: settle every shard's pending transfers"""
+    global _adapter
+    if _adapter is None:
+        _adapter = load_adapter()
+    with ThreadPoolExecutor(max_workers=SHARD_COUNT) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, settle_shard, shard_id, _adapter) for shard_id in range(SHARD_COUNT)
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,136 @@
+"""
+Benchmark for asynchronous transfer settlement
+
+Queues transfers through POST /transfer (in-process ASGI, so latency is the
+API cost alone) against a throwaway database, then drains the queue with
+the settlement workers and the local payout adapter. Reports request
+latency percentiles, settlement throughput, and checks that every failed
+transfer was refunded.
+
+    python settlement_benchmark.py --transfers 10000 --concurrency 8
+
+Keep --concurrency below the connection pool size: the endpoints check out
+connections on the event loop, so a drained pool stalls every request.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+# The app reads its database settings at import time
+_directory = tempfile.mkdtemp(prefix="settlement_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory, 'directory.db')}"
+os.environ.setdefault("SHARD_DATABASE_URL", f"sqlite:///{os.path.join(_directory, 'shard_{shard}.db')}")
+
+import httpx
+import numpy as np
+from sqlalchemy import func, insert
+
+from auth import create_access_token, get_password_hash
+from database import SessionLocal, for_each_shard
+from models import User, MoneyTransfer, TransferStatus
+import main
+import settlement
+
+STARTING_BALANCE = 1_000_000.0
+
+def _create_users(count: int) -> list:
+    db = SessionLocal()
+    try:
+        hashed = get_password_hash("benchmark")
+        db.execute(insert(User), [
+            {"email": f"bench{i}@example.com", "hashed_password": hashed, "wallet_balance": STARTING_BALANCE}
+            for i in range(count)
+        ])
+        db.commit()
+        return [email for (email,) in db.query(User.email).order_by(User.id)]
+    finally:
+        db.close()
+
+async def _enqueue(transfers: int, concurrency: int, emails: list) -> list:
+    headers = [{"Authorization": f"Bearer {create_access_token({'sub': e})}"} for e in emails]
+    queue = asyncio.Queue()
+    for n in range(transfers):
+        queue.put_nowait(n)
+    latencies = []
+
+    async def client_loop(client):
+        while not queue.empty():
+            n = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.post("/transfer", headers=headers[n % len(headers)], json={
+                "recipient_upi": f"payee{n}@upi", "recipient_name": "Benchmark", "amount": 10.0 + n % 90
+            })
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or response.json()["status"] != TransferStatus.PENDING.value:
+                raise RuntimeError(f"Unexpected response: {response.status_code} {response.text}")
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await asyncio.gather(*[client_loop(client) for _ in range(concurrency)])
+    return latencies
+
+def _ledger_check() -> dict:
+    """Wallet balances must equal the starting balance minus successful and pending transfers"""
+    spent = {}
+    for rows in for_each_shard(lambda db: db.query(
+        MoneyTransfer.user_id, MoneyTransfer.status, func.sum(MoneyTransfer.amount)
+    ).group_by(MoneyTransfer.user_id, MoneyTransfer.status).all()):
+        for user_id, transfer_status, amount in rows:
+            if transfer_status != TransferStatus.FAILED:
+                spent[user_id] = spent.get(user_id, 0.0) + amount
+    db = SessionLocal()
+    try:
+        mismatched = sum(
+            1 for user_id, balance in db.query(User.id, User.wallet_balance)
+            if abs(STARTING_BALANCE - spent.get(user_id, 0.0) - balance) > 0.01
+        )
+    finally:
+        db.close()
+    return {"users_checked": len(spent), "balance_mismatches": mismatched}
+
+def run(transfers: int, concurrency: int, users: int) -> dict:
+    emails = _create_users(users)
+
+    start = time.perf_counter()
+    latencies = np.array(asyncio.run(_enqueue(transfers, concurrency, emails))) * 1000
+    enqueue_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    shards = settlement.run_settlement()
+    settle_seconds = time.perf_counter() - start
+    settled = sum(s["succeeded"] + s["failed"] for s in shards)
+
+    return {
+        "transfers": transfers,
+        "concurrency": concurrency,
+        "request_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 2),
+            "p99": round(float(np.percentile(latencies, 99)), 2),
+            "max": round(float(latencies.max()), 2),
+        },
+        "enqueue_per_second": round(transfers / enqueue_seconds, 1),
+        "settlement": {
+            "workers_per_shard": settlement.SETTLEMENT_WORKERS,
+            "batch_size": settlement.SETTLEMENT_BATCH_SIZE,
+            "settled": settled,
+            "succeeded": sum(s["succeeded"] for s in shards),
+            "failed": sum(s["failed"] for s in shards),
+            "batches": sum(s["batches"] for s in shards),
+            "seconds": round(settle_seconds, 2),
+            "transfers_per_second": round(settled / settle_seconds, 1),
+        },
+        "ledger": _ledger_check(),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transfers", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=500)
+    args = parser.parse_args()
+    json.dump(run(args.transfers, args.concurrency, args.users), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,78 @@
+"""
+Write-throughput benchmark for user sharding
+
+Simulates the API write pattern (one committed INSERT per transaction) from
+several writer processes against 1..N SQLite shard files and reports how
+throughput scales with the shard count.
+
+    python shard_benchmark.py --shards 1 2 4 8 --writers 8 --writes 2000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.pool import NullPool
+
+from database import shard_for_user
+from models import Transaction
+
+def _engine(directory: str, shard: int):
+    return create_engine(
+        f"sqlite:///{os.path.join(directory, f'shard_{shard}.db')}",
+        connect_args={"check_same_thread": False, "timeout": 60},
+        poolclass=NullPool,
+    )
+
+def _writer(args):
+    directory, shard_count, writer_id, writes, users = args
+    engines = [_engine(directory, i) for i in range(shard_count)]
+    table = Transaction.__table__
+    start = time.perf_counter()
+    for n in range(writes):
+        user_id = (writer_id * writes + n) % users + 1
+        shard = shard_for_user(user_id, shard_count)
+        with engines[shard].begin() as conn:
+            conn.execute(insert(table).values(
+                user_id=user_id, amount=123.45, roundup_amount=0.55,
+                description="bench", created_at=datetime.utcnow()
+            ))
+    for e in engines:
+        e.dispose()
+    return time.perf_counter() - start
+
+def run(shard_count: int, writers: int, writes: int, users: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(shard_count):
+            e = _engine(directory, i)
+            Transaction.__table__.create(bind=e)
+            e.dispose()
+
+        start = time.perf_counter()
+        with Pool(writers) as pool:
+            pool.map(_writer, [(directory, shard_count, w, writes, users) for w in range(writers)])
+        elapsed = time.perf_counter() - start
+
+    total = writers * writes
+    return {
+        "shards": shard_count,
+        "writers": writers,
+        "writes": total,
+        "seconds": round(elapsed, 3),
+        "writes_per_second": round(total / elapsed, 1),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=1000, help="writes per writer process")
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    for shard_count in args.shards:
+        print(json.dumps(run(shard_count, args.writers, args.writes, args.users)))
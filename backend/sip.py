@@ -0,0 +1,316 @@
+"""
+Recurring investment plans (SIPs)
+
+A plan invests a fixed amount from the wallet daily, weekly or monthly
+(monthly plans run on day min(start day, 28)). The scheduler runs
+`run_plans()` every SIP_SCHEDULE_MINUTES; each run executes every plan whose
+`next_run_at` has passed, shard by shard in plan-id chunks:
+
+1. fund (directory database, one transaction per chunk): skip plan periods
+   that already have a `plan_executions` row, read the wallets, record one
+   execution per plan period (funded or insufficient_funds) and debit the
+   wallets with one executemany UPDATE
+2. invest (shard, one transaction per chunk): bulk insert the Investment
+   lots of funded executions against one price array and advance
+   `next_run_at`
+3. mark the chunk's executions invested
+
+The unique (shard_id, plan_id, period) execution row makes funding
+exactly-once per period, and the lots' payment ids (SIP_<shard>_<plan>_<period>)
+make step 2 idempotent, so a run that crashes anywhere is completed by the
+next one. Missed periods are caught up one per pass, up to SIP_MAX_CATCHUP.
+A funded plan none of whose targets has a price keeps its execution funded
+and its `next_run_at`; the next run invests that period. A funded period is
+invested even if its plan was cancelled in between (the wallet was already
+debited); only later periods stop.
+
+    python sip.py
+"""
+import calendar
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import insert, update, bindparam, or_
+
+from database import SessionLocal, for_each_shard
+from models import User, Investment, InvestmentPlan, PlanExecution, PlanFrequency
+from price_feed import price_array
+from catalog import catalog
+from rebalance import normalize_weights, allocate_new_money
+from aggregates import holdings_by_user, targets_by_user
+from sweep import selections_by_user
+from changes import insert_logged
+from scheduler import still_leader
+
+SIP_MIN_AMOUNT = float(os.getenv("SIP_MIN_AMOUNT", "10"))
+SIP_MAX_PLANS_PER_USER = int(os.getenv("SIP_MAX_PLANS_PER_USER", "10"))
+SIP_SCHEDULE_MINUTES = float(os.getenv("SIP_SCHEDULE_MINUTES", "15"))
+SIP_CHUNK_PLANS = int(os.getenv("SIP_CHUNK_PLANS", "5000"))
+SIP_MAX_CATCHUP = int(os.getenv("SIP_MAX_CATCHUP", "31"))
+
+FUNDED, INVESTED, INSUFFICIENT_FUNDS = "funded", "invested", "insufficient_funds"
+
+# Shards run in parallel but fund through the one directory database; funding
+# reads wallets before debiting them, so chunks take turns (SQLite would
+# otherwise fail one of two overlapping read-then-write transactions).
+_funding_lock = threading.Lock()
+
+def period_key(frequency: PlanFrequency, run_at: datetime) -> str:
+    if frequency == PlanFrequency.DAILY:
+        return run_at.strftime("%Y-%m-%d")
+    if frequency == PlanFrequency.WEEKLY:
+        year, week, _ = run_at.isocalendar()
+        return f"{year}-W{week:02d}"
+    return run_at.strftime("%Y-%m")
+
+def next_run(frequency: PlanFrequency, run_at: datetime) -> datetime:
+    if frequency == PlanFrequency.DAILY:
+        return run_at + timedelta(days=1)
+    if frequency == PlanFrequency.WEEKLY:
+        return run_at + timedelta(weeks=1)
+    year, month = (run_at.year + 1, 1) if run_at.month == 12 else (run_at.year, run_at.month + 1)
+    return run_at.replace(year=year, month=month, day=min(run_at.day, 28, calendar.monthrange(year, month)[1]))
+
+def payment_id(shard_id: int, plan_id: int, period: str) -> str:
+    # Not ROUNDUP_/PAY: SIP lots count as invested from the wallet
+    return f"SIP_{shard_id}_{plan_id}_{period}"
+
+def _due_plans(db, now: datetime, after_id: int, owed: set) -> list:
+    """Due active plans, plus plans in `owed` (a funded period not invested yet) even if cancelled since"""
+    return db.query(
+        InvestmentPlan.id, InvestmentPlan.user_id, InvestmentPlan.amount,
+        InvestmentPlan.frequency, InvestmentPlan.next_run_at
+    ).filter(
+        or_(InvestmentPlan.active.is_(True), InvestmentPlan.id.in_(owed)),
+        InvestmentPlan.next_run_at <= now,
+        InvestmentPlan.id > after_id
+    ).order_by(InvestmentPlan.id).limit(SIP_CHUNK_PLANS).all()
+
+def _fund(shard_id: int, plans: list, now: datetime) -> dict:
+    """Record executions for the plans' current periods and debit wallets; returns {plan_id: status}"""
+    periods = {p.id: period_key(p.frequency, p.next_run_at) for p in plans}
+    with _funding_lock:
+        directory = SessionLocal()
+        try:
+            statuses = {
+                plan_id: execution_status
+                for plan_id, period, execution_status in directory.query(
+                    PlanExecution.plan_id, PlanExecution.period, PlanExecution.status
+                ).filter(
+                    PlanExecution.shard_id == shard_id,
+                    PlanExecution.plan_id.in_(list(periods)),
+                    PlanExecution.period.in_(set(periods.values()))
+                )
+                if periods.get(plan_id) == period
+            }
+            new = [p for p in plans if p.id not in statuses]
+            if new:
+                balances = dict(directory.query(User.id, User.wallet_balance).filter(
+                    User.id.in_({p.user_id for p in new})
+                ).with_for_update())
+                debits = defaultdict(float)
+                rows = []
+                for p in new:
+                    funded = balances.get(p.user_id, 0.0) - debits[p.user_id] >= p.amount - 1e-9
+                    if funded:
+                        debits[p.user_id] += p.amount
+                    statuses[p.id] = FUNDED if funded else INSUFFICIENT_FUNDS
+                    rows.append({
+                        "shard_id": shard_id, "plan_id": p.id, "user_id": p.user_id, "period": periods[p.id],
+                        "amount": p.amount, "status": statuses[p.id], "created_at": now,
+                    })
+                directory.execute(insert(PlanExecution), rows)
+                if debits:
+                    users = User.__table__
+                    directory.execute(
+                        update(users).where(users.c.id == bindparam("debit_user_id")).values(
+                            wallet_balance=users.c.wallet_balance - bindparam("debit")
+                        ),
+                        [{"debit_user_id": user_id, "debit": amount} for user_id, amount in debits.items()]
+                    )
+                directory.commit()
+            return statuses
+        finally:
+            directory.close()
+
+def _allocate(db, plans: list, prices: np.ndarray, options: list, created_at: datetime, shard_id: int) -> tuple:
+    """
+    Investment lots for funded plans, split by target weight with underweight
+    options first, and the ids of plans none of whose targets has a price
+    """
+    user_ids = list({p.user_id for p in plans})
+    selections_by_user(db, user_ids, options)
+    holdings = holdings_by_user(db, user_ids)
+    targets = targets_by_user(db, user_ids)
+    rows, unpriced = [], set()
+    for p in plans:
+        priced = [(o, w) for o, w in targets[p.user_id].items() if o < len(prices) and prices[o] > 0]
+        if not priced:
+            unpriced.add(p.id)
+            continue
+        option_ids = [o for o, _ in priced]
+        values = [holdings[p.user_id].get(o, (0.0, 0.0))[0] * prices[o] for o in option_ids]
+        amounts = [round(float(a), 2) for a in allocate_new_money(p.amount, normalize_weights([w for _, w in priced]), values)]
+        # The whole debit is invested: rounding remainder goes to the largest lot
+        amounts[int(np.argmax(amounts))] += round(p.amount - sum(amounts), 2)
+        for option_id, amount in zip(option_ids, amounts):
+            amount = round(amount, 2)
+            if amount <= 0:
+                continue
+            rows.append({
+                "user_id": p.user_id,
+                "portfolio_option_id": option_id,
+                "amount": amount,
+                "units": round(amount / prices[option_id], 6),
+                "is_auto_recommended": False,
+                "payment_id": payment_id(shard_id, p.id, period_key(p.frequency, p.next_run_at)),
+                "created_at": created_at,
+            })
+    return rows, unpriced
+
+def _invest(db, shard_id: int, plans: list, statuses: dict, prices: np.ndarray, options: list, now: datetime) -> tuple:
+    """
+    Insert lots for funded executions not invested yet and advance the plans;
+    returns lots written and the ids of funded plans left uninvested
+
+    A funded plan with no priced target keeps its execution FUNDED and its
+    `next_run_at`, so the next run retries the same period with the debit
+    already taken.
+    """
+    funded = [p for p in plans if statuses[p.id] == FUNDED]
+    if funded:
+        done = {pid for (pid,) in db.query(Investment.payment_id).filter(Investment.payment_id.in_(
+            [payment_id(shard_id, p.id, period_key(p.frequency, p.next_run_at)) for p in funded]
+        )).distinct()}
+        funded = [p for p in funded if payment_id(shard_id, p.id, period_key(p.frequency, p.next_run_at)) not in done]
+    rows, unpriced = _allocate(db, funded, prices, options, now, shard_id) if funded else ([], set())
+    for i in range(0, len(rows), 10_000):
+        insert_logged(db, Investment, rows[i:i + 10_000])
+
+    advanced = [p for p in plans if p.id not in unpriced]
+    if advanced:
+        table = InvestmentPlan.__table__
+        db.execute(
+            update(table).where(table.c.id == bindparam("plan_id")).values(
+                next_run_at=bindparam("next_run_at"), last_run_at=now
+            ),
+            [{"plan_id": p.id, "next_run_at": next_run(p.frequency, p.next_run_at)} for p in advanced]
+        )
+    db.commit()
+    return len(rows), unpriced
+
+def _mark_invested(shard_id: int, plans: list, statuses: dict, uninvested: set):
+    funded = [p for p in plans if statuses[p.id] == FUNDED and p.id not in uninvested]
+    if not funded:
+        return
+    directory = SessionLocal()
+    try:
+        table = PlanExecution.__table__
+        directory.execute(
+            update(table).where(
+                table.c.shard_id == shard_id,
+                table.c.plan_id == bindparam("execution_plan_id"),
+                table.c.period == bindparam("execution_period"),
+                table.c.status == FUNDED
+            ).values(status=INVESTED),
+            [{"execution_plan_id": p.id, "execution_period": period_key(p.frequency, p.next_run_at)} for p in funded]
+        )
+        directory.commit()
+    finally:
+        directory.close()
+
+def _recover(db, shard_id: int) -> set:
+    """
+    Mark executions left 'funded' by a crash after their lots were written;
+    returns the ids of plans whose funded period has no lots yet
+    """
+    directory = SessionLocal()
+    try:
+        stuck = directory.query(PlanExecution).filter(
+            PlanExecution.shard_id == shard_id, PlanExecution.status == FUNDED
+        ).all()
+        if not stuck:
+            return set()
+        written = {pid for (pid,) in db.query(Investment.payment_id).filter(
+            Investment.payment_id.in_([payment_id(shard_id, e.plan_id, e.period) for e in stuck])
+        ).distinct()}
+        owed = set()
+        for execution in stuck:
+            if payment_id(shard_id, execution.plan_id, execution.period) in written:
+                execution.status = INVESTED
+            else:
+                owed.add(execution.plan_id)
+        directory.commit()
+        return owed
+    finally:
+        directory.close()
+
+def run_shard(db, shard_id: int, prices: np.ndarray, options: list, now: datetime) -> dict:
+    stats = {
+        "shard": shard_id, "executions": 0, "funded": 0, "insufficient_funds": 0, "investments": 0, "amount": 0.0,
+        "stopped": False,
+    }
+    # The wallet was debited for these: invested even if the plan was cancelled since
+    owed = _recover(db, shard_id)
+    uninvested = set()  # funded plans without a priced target, retried by the next run
+    for _ in range(SIP_MAX_CATCHUP):
+        after_id, executed = 0, 0
+        while True:
+            if not still_leader():
+                # Lease lost mid-run: the new leader picks up the plans still due
+                stats["stopped"] = True
+                break
+            plans = _due_plans(db, now, after_id, owed)
+            if not plans:
+                break
+            after_id = plans[-1].id
+            plans = [p for p in plans if p.id not in uninvested]
+            if not plans:
+                continue
+            statuses = _fund(shard_id, plans, now)
+            investments, unpriced = _invest(db, shard_id, plans, statuses, prices, options, now)
+            stats["investments"] += investments
+            uninvested |= unpriced
+            # Done with their owed period: a cancelled plan is not funded again
+            owed -= {p.id for p in plans} - unpriced
+            _mark_invested(shard_id, plans, statuses, unpriced)
+
+            funded = [p for p in plans if statuses[p.id] in (FUNDED, INVESTED)]
+            stats["executions"] += len(plans)
+            stats["funded"] += len(funded)
+            stats["insufficient_funds"] += sum(1 for p in plans if statuses[p.id] == INSUFFICIENT_FUNDS)
+            stats["amount"] += sum(p.amount for p in funded)
+            executed += len(plans)
+        # Plans more than one period behind are still due: run another pass
+        if not executed or stats["stopped"]:
+            break
+    stats["amount"] = round(stats["amount"], 2)
+    return stats
+
+def run_plans(now: datetime = None) -> dict:
+    """Execute every plan period that is due"""
+    start = time.perf_counter()
+    now = now or datetime.utcnow()
+    db = SessionLocal()
+    try:
+        prices = price_array(db)
+        options = catalog.get(db).options
+    finally:
+        db.close()
+
+    results = for_each_shard(lambda sdb: run_shard(sdb, sdb.info["shard_id"], prices, options, now))
+    totals = {key: sum(r[key] for r in results) for key in ("executions", "funded", "insufficient_funds", "investments")}
+    return {
+        **totals,
+        "amount": round(sum(r["amount"] for r in results), 2),
+        "seconds": round(time.perf_counter() - start, 2),
+        "shards": results,
+    }
+
+if __name__ == "__main__":
+    print(json.dumps(run_plans(), indent=2))
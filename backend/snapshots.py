@@ -0,0 +1,196 @@
+"""
+End-of-day portfolio snapshots
+
+Once a day (after SNAPSHOT_HOUR_UTC) every shard stores one
+`portfolio_snapshots` row per user holding anything: total value and cost,
+plus the per-holding records packed into a blob (HOLDING_DTYPE). The
+prices used become the day's closes in `price_history` (see backtest.py).
+
+Each day is derived from the previous snapshot. Only users whose lots
+changed since then are recomputed from `investments`. Changed means new lot
+ids past the previous day's watermark, or a `holding_resets` marker left by
+an exit (which deletes lots). Everyone else's records are carried over.
+Then every holding is revalued against one price array in a single numpy
+pass. The first snapshot of a shard, or `--full`, recomputes everyone with
+one grouped query.
+
+/portfolio/history reads (day, value, cost) straight from the snapshots and
+downsamples long ranges on the server.
+
+    python snapshots.py [--full] [--day 2026-10-19]
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, date, timedelta
+
+import numpy as np
+from sqlalchemy import select, func, insert, union
+
+from database import SessionLocal, for_each_shard
+from models import Investment, HoldingReset, PortfolioSnapshot, SnapshotDay
+from price_feed import price_array, record_closes
+
+SNAPSHOT_HOUR_UTC = int(os.getenv("SNAPSHOT_HOUR_UTC", "18"))
+SNAPSHOT_INSERT_CHUNK = 10_000
+
+HOLDING_DTYPE = np.dtype([("option_id", "<i4"), ("units", "<f8"), ("cost", "<f8"), ("value", "<f8")])
+
+# range -> (days back, max points returned)
+HISTORY_RANGES = {"1m": (31, 31), "1y": (366, 53), "all": (None, 120)}
+
+def holding_records(db, dirty_users=None) -> tuple:
+    """(users, records) of current holdings, sorted by user then option"""
+    query = select(
+        Investment.user_id, Investment.portfolio_option_id,
+        func.sum(Investment.units), func.sum(Investment.amount)
+    ).group_by(Investment.user_id, Investment.portfolio_option_id).order_by(Investment.user_id, Investment.portfolio_option_id)
+    if dirty_users is not None:
+        query = query.where(Investment.user_id.in_(dirty_users))
+    rows = db.execute(query).all()
+
+    users = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    records = np.zeros(len(rows), dtype=HOLDING_DTYPE)
+    if rows:
+        records["option_id"] = [r[1] for r in rows]
+        records["units"] = [r[2] or 0.0 for r in rows]
+        records["cost"] = [r[3] or 0.0 for r in rows]
+    held = records["units"] > 1e-9
+    return users[held], records[held]
+
+def _previous(db, day: date) -> tuple:
+    """(users, records) stored for `day`, sorted by user"""
+    rows = db.query(PortfolioSnapshot.user_id, PortfolioSnapshot.holdings).filter(
+        PortfolioSnapshot.day == day
+    ).order_by(PortfolioSnapshot.user_id).all()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=HOLDING_DTYPE)
+    records = np.frombuffer(b"".join(blob for _, blob in rows), dtype=HOLDING_DTYPE).copy()
+    counts = [len(blob) // HOLDING_DTYPE.itemsize for _, blob in rows]
+    users = np.repeat(np.array([user_id for user_id, _ in rows], dtype=np.int64), counts)
+    return users, records
+
+def _revalue(records: np.ndarray, prices: np.ndarray):
+    option_ids = records["option_id"].astype(np.int64)
+    known = option_ids < len(prices)
+    price = np.full(len(records), np.nan)
+    price[known] = prices[option_ids[known]]
+    # No price: value at cost rather than dropping the holding
+    records["value"] = np.where(np.isnan(price), records["cost"], records["units"] * price)
+
+def _snapshot_rows(day: date, users: np.ndarray, records: np.ndarray) -> list:
+    if not len(users):
+        return []
+    starts = np.flatnonzero(np.concatenate(([True], users[1:] != users[:-1])))
+    values = np.add.reduceat(records["value"], starts)
+    costs = np.add.reduceat(records["cost"], starts)
+    ends = np.append(starts[1:], len(users))
+    return [
+        {
+            "user_id": int(users[start]),
+            "day": day,
+            "total_value": round(float(values[i]), 2),
+            "total_cost": round(float(costs[i]), 2),
+            "holdings": records[start:end].tobytes(),
+        }
+        for i, (start, end) in enumerate(zip(starts, ends))
+    ]
+
+def snapshot_shard(db, day: date, prices: np.ndarray, full: bool = False) -> dict:
+    start = time.perf_counter()
+    shard_id = db.info.get("shard_id", 0)
+    if db.get(SnapshotDay, day):
+        return {"shard": shard_id, "day": day.isoformat(), "skipped": True}
+
+    # Watermarks first: anything written later is picked up (as dirty) tomorrow.
+    # investments is AUTOINCREMENT (exits delete lots) and resets are never deleted,
+    # so neither id is handed out twice.
+    investment_watermark = db.query(func.coalesce(func.max(Investment.id), 0)).scalar()
+    reset_watermark = db.query(func.coalesce(func.max(HoldingReset.id), 0)).scalar()
+    previous = db.query(SnapshotDay).filter(SnapshotDay.day < day).order_by(SnapshotDay.day.desc()).first()
+
+    if previous is None or full:
+        mode = "full"
+        users, records = holding_records(db)
+        recomputed = len(np.unique(users))
+    else:
+        mode = "incremental"
+        dirty = union(
+            select(Investment.user_id).where(Investment.id > previous.investment_watermark),
+            select(HoldingReset.user_id).where(HoldingReset.id > previous.reset_watermark)
+        ).subquery()
+        dirty_users, dirty_records = holding_records(db, select(dirty.c.user_id))
+        dirty_ids = np.array([u for (u,) in db.execute(select(dirty.c.user_id))], dtype=np.int64)
+        carried_users, carried_records = _previous(db, previous.day)
+        keep = ~np.isin(carried_users, dirty_ids)
+        users = np.concatenate([carried_users[keep], dirty_users])
+        records = np.concatenate([carried_records[keep], dirty_records])
+        order = np.argsort(users, kind="stable")
+        users, records = users[order], records[order]
+        recomputed = len(dirty_ids)
+
+    _revalue(records, prices)
+    rows = _snapshot_rows(day, users, records)
+    # Core insert: the ORM bulk path costs more than the snapshot itself
+    for i in range(0, len(rows), SNAPSHOT_INSERT_CHUNK):
+        db.execute(insert(PortfolioSnapshot.__table__), rows[i:i + SNAPSHOT_INSERT_CHUNK])
+    db.add(SnapshotDay(
+        day=day, investment_watermark=investment_watermark, reset_watermark=reset_watermark, users=len(rows)
+    ))
+    db.commit()
+    return {
+        "shard": shard_id,
+        "day": day.isoformat(),
+        "mode": mode,
+        "users": len(rows),
+        "holdings": len(records),
+        "recomputed_users": recomputed,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+def run_snapshots(day: date = None, full: bool = False) -> list:
+    day = day or datetime.utcnow().date()
+    db = SessionLocal()
+    try:
+        prices = price_array(db)
+        # The same prices become the day's close in the backtest price history
+        record_closes(db, day, prices)
+    finally:
+        db.close()
+    return for_each_shard(lambda sdb: snapshot_shard(sdb, day, prices, full))
+
+def end_of_day_snapshots():
+    """Scheduler entry point: snapshot today once SNAPSHOT_HOUR_UTC has passed"""
+    now = datetime.utcnow()
+    if now.hour >= SNAPSHOT_HOUR_UTC:
+        for result in run_snapshots(now.date()):
+            if not result.get("skipped"):
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 📸 Portfolio snapshot: {result}")
+
+def history(db, user_id: int, range_key: str) -> list:
+    """
+    (day, value, cost) points for a range, evenly downsampled to the range's max points
+
+    The first and last snapshot of the range are always kept.
+    """
+    days_back, max_points = HISTORY_RANGES[range_key]
+    query = db.query(PortfolioSnapshot.day, PortfolioSnapshot.total_value, PortfolioSnapshot.total_cost).filter(
+        PortfolioSnapshot.user_id == user_id
+    )
+    if days_back is not None:
+        query = query.filter(PortfolioSnapshot.day >= datetime.utcnow().date() - timedelta(days=days_back))
+    rows = query.order_by(PortfolioSnapshot.day).all()
+    if len(rows) > max_points:
+        rows = [rows[i] for i in np.unique(np.linspace(0, len(rows) - 1, max_points).round().astype(int))]
+    return [
+        {"day": day, "value": value, "cost": cost, "profit_loss": round(value - cost, 2)}
+        for day, value, cost in rows
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="recompute every user instead of deriving from the previous day")
+    parser.add_argument("--day", type=date.fromisoformat, default=None)
+    args = parser.parse_args()
+    print(json.dumps(run_snapshots(args.day, args.full), indent=2))
@@ -0,0 +1,276 @@
+"""
+Cohort percentiles from mergeable quantile sketches
+
+For each metric (round-ups saved, amount invested, current daily streak) a
+KLL sketch summarizes every user's value in O(k log(n/k)) space. The
+rebuild job has each shard sketch its users' values from one grouped
+query, merges the shard sketches, pads with zeros for users without
+activity, and stores the result in `stats_sketches`.
+
+Every worker loads the stored sketches (rechecking every
+STATS_REFRESH_SECONDS) and compiles them into sorted (item, cumulative
+weight) arrays. "Better than p% of users" is then one bisect over a few
+hundred items, however many users there are (rank error stays around 1%
+at the default k; see bench).
+
+Per-user totals grow in place and a sketch can't remove a user's old
+value, so sketches are rebuilt on a schedule rather than updated per write.
+
+    python stats.py rebuild
+    python stats.py bench [--users 1000000]
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+
+from database import SessionLocal, for_each_shard
+from models import User, Transaction, Investment, UserArchiveTotals, StatsSketch
+
+STATS_SKETCH_K = int(os.getenv("STATS_SKETCH_K", "200"))
+STATS_REBUILD_MINUTES = float(os.getenv("STATS_REBUILD_MINUTES", "15"))
+STATS_REFRESH_SECONDS = float(os.getenv("STATS_REFRESH_SECONDS", "60"))
+STATS_STREAK_WINDOW_DAYS = int(os.getenv("STATS_STREAK_WINDOW_DAYS", "366"))
+
+METRICS = ("roundups", "invested", "streak")
+
+class KLLSketch:
+    """
+    KLL quantile sketch (Karnin, Lang, Liberty 2016)
+
+    Level h holds items of weight 2**h. A level over its capacity is sorted
+    and every other item (random offset) is promoted. Sketches with the
+    same k merge level by level.
+    """
+
+    def __init__(self, k: int = STATS_SKETCH_K, c: float = 2 / 3, seed: int = None):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = random.Random(seed)
+        self._compiled = None
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * self.c ** depth)), 2)
+
+    def _compress(self):
+        while True:
+            over = [h for h, items in enumerate(self.levels) if len(items) > self._capacity(h)]
+            if not over:
+                break
+            h = over[0]
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[h])
+            # An odd item out stays at this level
+            keep, items = (items[-1:], items[:-1]) if len(items) % 2 else (np.empty(0), items)
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], items[self._rng.randint(0, 1)::2]])
+            self.levels[h] = keep
+        self._compiled = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self._compress()
+
+    def merge(self, other: "KLLSketch"):
+        if other.k != self.k:
+            raise ValueError("Sketches with different k can't be merged")
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.n += other.n
+        self._compress()
+
+    def _compile(self) -> tuple:
+        if self._compiled is None:
+            items = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(items), 2.0 ** h) for h, items in enumerate(self.levels)])
+            order = np.argsort(items, kind="stable")
+            self._compiled = (items[order].tolist(), np.cumsum(weights[order]).tolist())
+        return self._compiled
+
+    def rank(self, value: float) -> float:
+        """Estimated fraction of values strictly below `value`"""
+        items, cumulative = self._compile()
+        i = bisect.bisect_left(items, value)
+        return cumulative[i - 1] / cumulative[-1] if i and cumulative else 0.0
+
+    def quantile(self, q: float) -> float:
+        items, cumulative = self._compile()
+        if not items:
+            return 0.0
+        return items[min(bisect.bisect_left(cumulative, q * cumulative[-1]), len(items) - 1)]
+
+    def to_json(self) -> str:
+        return json.dumps({"k": self.k, "c": self.c, "n": self.n, "levels": [items.tolist() for items in self.levels]})
+
+    @classmethod
+    def from_json(cls, data: str) -> "KLLSketch":
+        raw = json.loads(data)
+        sketch = cls(raw["k"], raw["c"])
+        sketch.n = raw["n"]
+        sketch.levels = [np.array(items, dtype=np.float64) for items in raw["levels"]]
+        return sketch
+
+# Per-user values
+
+def _streaks(rows, today) -> dict:
+    """{user_id: consecutive active days ending today or yesterday} from (user_id, day) rows sorted by user, day desc"""
+    if not rows:
+        return {}
+    users = np.array([user_id for user_id, _ in rows], dtype=np.int64)
+    days = np.array([datetime.strptime(str(day), "%Y-%m-%d").toordinal() for _, day in rows], dtype=np.int64)
+    new_user = np.concatenate(([True], users[1:] != users[:-1]))
+    breaks = new_user | np.concatenate(([True], np.diff(days) != -1))
+    runs = np.cumsum(breaks)
+    lengths = np.bincount(runs)
+    firsts = np.flatnonzero(new_user)
+    current = days[firsts] >= today.toordinal() - 1
+    return dict(zip(users[firsts][current].tolist(), lengths[runs[firsts][current]].tolist()))
+
+def user_values(db, user_ids=None) -> dict:
+    """{metric: {user_id: value}} for this session's shard (or the given users)"""
+    def scoped(query, column):
+        return query.filter(column.in_(user_ids)) if user_ids is not None else query
+
+    roundups = dict(scoped(db.query(Transaction.user_id, func.sum(Transaction.roundup_amount)), Transaction.user_id).group_by(Transaction.user_id))
+    for user_id, archived in scoped(db.query(UserArchiveTotals.user_id, UserArchiveTotals.roundup_total), UserArchiveTotals.user_id):
+        roundups[user_id] = roundups.get(user_id, 0.0) + (archived or 0.0)
+    invested = dict(scoped(db.query(Investment.user_id, func.sum(Investment.amount)), Investment.user_id).group_by(Investment.user_id))
+
+    today = datetime.utcnow().date()
+    day = func.date(Transaction.created_at)
+    active = scoped(db.query(Transaction.user_id, day).filter(
+        Transaction.created_at >= datetime.utcnow() - timedelta(days=STATS_STREAK_WINDOW_DAYS)
+    ), Transaction.user_id).distinct().order_by(Transaction.user_id, day.desc()).all()
+    return {"roundups": roundups, "invested": invested, "streak": _streaks(active, today)}
+
+# Rebuild
+
+def _shard_sketches(db) -> dict:
+    values = user_values(db)
+    sketches = {}
+    for metric in METRICS:
+        sketches[metric] = KLLSketch()
+        sketches[metric].update(list(values[metric].values()))
+    return sketches
+
+def rebuild_sketches() -> dict:
+    """Sketch every shard, merge, pad with zeros for inactive users and store"""
+    start = time.perf_counter()
+    merged = {metric: KLLSketch() for metric in METRICS}
+    for shard in for_each_shard(_shard_sketches):
+        for metric in METRICS:
+            merged[metric].merge(shard[metric])
+
+    db = SessionLocal()
+    try:
+        users = db.query(func.count(User.id)).scalar()
+        now = datetime.utcnow()
+        for metric, sketch in merged.items():
+            if users > sketch.n:
+                sketch.update(np.zeros(users - sketch.n))
+            row = db.get(StatsSketch, metric) or StatsSketch(metric=metric)
+            row.sketch = sketch.to_json()
+            row.users = sketch.n
+            row.updated_at = now
+            db.add(row)
+        db.commit()
+    finally:
+        db.close()
+    return {"users": users, "seconds": round(time.perf_counter() - start, 2)}
+
+class _Sketches:
+    """Per-worker copy of the stored sketches"""
+
+    def __init__(self):
+        self._sketches = {}
+        self._updated_at = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, db, metric: str) -> tuple:
+        """(sketch or None, users, updated_at)"""
+        now = time.monotonic()
+        if now - self._checked_at >= STATS_REFRESH_SECONDS:
+            with self._lock:
+                if now - self._checked_at >= STATS_REFRESH_SECONDS:
+                    for name, updated_at in db.query(StatsSketch.metric, StatsSketch.updated_at):
+                        if self._updated_at.get(name) != updated_at:
+                            data = db.query(StatsSketch.sketch).filter(StatsSketch.metric == name).scalar()
+                            self._sketches[name] = KLLSketch.from_json(data)
+                            self._updated_at[name] = updated_at
+                    self._checked_at = now
+        sketch = self._sketches.get(metric)
+        return sketch, (sketch.n if sketch else 0), self._updated_at.get(metric)
+
+sketches = _Sketches()
+
+def percentile(db, user_id: int, metric: str) -> dict:
+    value = float(user_values(db, [user_id])[metric].get(user_id, 0.0))
+    sketch, users, updated_at = sketches.get(db, metric)
+    return {
+        "metric": metric,
+        "value": round(value, 2),
+        "percentile": round(sketch.rank(value) * 100, 1) if sketch else None,
+        "users": users,
+        "updated_at": updated_at,
+    }
+
+def bench(users: int) -> dict:
+    rng = np.random.default_rng(0)
+    values = np.round(rng.lognormal(4, 1.2, users), 2)
+    shards = np.array_split(values, 8)
+    start = time.perf_counter()
+    merged = KLLSketch(seed=0)
+    for part in shards:
+        sketch = KLLSketch(seed=1)
+        sketch.update(part)
+        merged.merge(sketch)
+    build_ms = (time.perf_counter() - start) * 1000
+    restored = KLLSketch.from_json(merged.to_json())
+
+    probes = rng.choice(values, 10_000)
+    ordered = np.sort(values)
+    exact = np.searchsorted(ordered, probes, side="left") / users
+    start = time.perf_counter()
+    estimated = np.array([restored.rank(v) for v in probes])
+    query_us = (time.perf_counter() - start) / len(probes) * 1e6
+    return {
+        "users": users,
+        "k": merged.k,
+        "retained_items": sum(len(items) for items in merged.levels),
+        "sketch_bytes": len(merged.to_json()),
+        "build_and_merge_ms": round(build_ms, 1),
+        "rank_query_us": round(query_us, 2),
+        "max_rank_error": round(float(np.abs(estimated - exact).max()), 4),
+        "mean_rank_error": round(float(np.abs(estimated - exact).mean()), 4),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="rebuild and store the sketches")
+    bench_args = commands.add_parser("bench", help="accuracy and speed against exact ranks")
+    bench_args.add_argument("--users", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        from database import init_db
+        init_db()
+        print(json.dumps(rebuild_sketches(), indent=2))
+    else:
+        print(json.dumps(bench(args.users), indent=2))
@@ -0,0 +1,276 @@
+"""
+Round-up auto-invest sweep
+
+Finds every user whose uninvested round-up pool has reached
+SWEEP_THRESHOLD, or who has anything in the pool and was last swept more
+than SWEEP_INTERVAL_DAYS ago, and invests the pool across their portfolio
+selections against a single price snapshot, by target weight with
+underweight selections topped up first (the same split as SIPs).
+
+Each shard is processed in user-id order, in chunks: candidates come from
+one set-based aggregate query, allocation math runs on a process pool for
+large runs, investments are written with chunked executemany inserts, and a
+per-shard checkpoint is committed with every chunk. An interrupted run is
+resumed by the next `run_sweep()` call.
+
+    python sweep.py
+"""
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, union_all, func, and_, or_
+
+from database import SessionLocal, for_each_shard
+from models import (
+    User, Transaction, Investment, PortfolioOption, PortfolioSelection,
+    UserArchiveTotals, SweepRun, SweepCheckpoint
+)
+from aggregates import roundup_payment_clause, holdings_by_user
+from rebalance import normalize_weights, allocate_new_money
+from price_feed import price_array
+from utils import get_auto_recommended_portfolios
+from changes import insert_logged
+from scheduler import still_leader
+
+SWEEP_THRESHOLD = float(os.getenv("SWEEP_THRESHOLD", "100"))
+SWEEP_MIN_AMOUNT = float(os.getenv("SWEEP_MIN_AMOUNT", "1"))
+SWEEP_INTERVAL_DAYS = int(os.getenv("SWEEP_INTERVAL_DAYS", "7"))
+# How often the scheduler runs the sweep
+SWEEP_SCHEDULE_HOURS = float(os.getenv("SWEEP_SCHEDULE_HOURS", "24"))
+SWEEP_CHUNK_USERS = int(os.getenv("SWEEP_CHUNK_USERS", "5000"))
+SWEEP_INSERT_CHUNK = 10_000
+# Allocation moves to a process pool once a run has this many candidates
+SWEEP_POOL_MIN_USERS = int(os.getenv("SWEEP_POOL_MIN_USERS", "50000"))
+
+SWEEP_PAYMENT_PREFIX = "ROUNDUP_SWEEP"
+
+def sweep_payment_id(run_id: int, user_id: int) -> str:
+    # ROUNDUP_ prefix: swept amounts count as invested from round-ups
+    return f"{SWEEP_PAYMENT_PREFIX}{run_id}_{user_id}"
+
+def _candidates(db, after_user_id: int, now: datetime) -> list:
+    """(user_id, available_pool) for every user due a sweep, in user-id order"""
+    generated = union_all(
+        select(Transaction.user_id.label("user_id"), Transaction.roundup_amount.label("amount")),
+        select(UserArchiveTotals.user_id, UserArchiveTotals.roundup_total)
+    ).subquery()
+    pools = select(
+        generated.c.user_id, func.sum(generated.c.amount).label("generated")
+    ).group_by(generated.c.user_id).subquery()
+    invested = select(
+        Investment.user_id,
+        func.coalesce(func.sum(Investment.amount).filter(roundup_payment_clause()), 0.0).label("invested"),
+        func.max(Investment.created_at).filter(
+            func.substr(Investment.payment_id, 1, len(SWEEP_PAYMENT_PREFIX)) == SWEEP_PAYMENT_PREFIX
+        ).label("last_sweep")
+    ).group_by(Investment.user_id).subquery()
+
+    available = pools.c.generated - func.coalesce(invested.c.invested, 0.0)
+    query = (
+        select(pools.c.user_id, available)
+        .outerjoin(invested, invested.c.user_id == pools.c.user_id)
+        .where(pools.c.user_id > after_user_id)
+        .where(or_(
+            available >= SWEEP_THRESHOLD,
+            and_(
+                available >= SWEEP_MIN_AMOUNT,
+                or_(invested.c.last_sweep.is_(None), invested.c.last_sweep < now - timedelta(days=SWEEP_INTERVAL_DAYS))
+            )
+        ))
+        .order_by(pools.c.user_id)
+    )
+    return db.execute(query).all()
+
+def _paise(amount: float) -> float:
+    """Rounded down to paise (the pool is never overdrawn)"""
+    return math.floor(amount * 100 + 1e-6) / 100
+
+def allocate(batch: list, prices, run_id: int, created_at: datetime) -> list:
+    """
+    Investment rows for a batch of users (pure function; runs in worker processes)
+
+    The pool is split by target weight, underweight selections first, and
+    invested down to the paisa.
+
+    Args:
+        batch: [(user_id, amount, [(option_id, is_auto_recommended, target_weight, units_held), ...]), ...]
+        prices: Price array indexed by option id
+    """
+    rows = []
+    for user_id, amount, selections in batch:
+        priced = [s for s in selections if s[0] < len(prices) and prices[s[0]] > 0]
+        total = _paise(amount)
+        if not priced or total <= 0:
+            continue
+        targets = normalize_weights([np.nan if weight is None else weight for _, _, weight, _ in priced])
+        values = [units * prices[option_id] for option_id, _, _, units in priced]
+        amounts = [_paise(a) for a in allocate_new_money(total, targets, values)]
+        # Rounding remainder goes to the largest lot
+        largest = int(np.argmax(amounts))
+        amounts[largest] = round(amounts[largest] + total - sum(amounts), 2)
+        payment_id = sweep_payment_id(run_id, user_id)
+        for (option_id, is_auto, _, _), lot in zip(priced, amounts):
+            if lot <= 0:
+                continue
+            rows.append({
+                "user_id": user_id,
+                "portfolio_option_id": option_id,
+                "amount": lot,
+                "units": round(lot / prices[option_id], 6),
+                "is_auto_recommended": is_auto,
+                "payment_id": payment_id,
+                "created_at": created_at,
+            })
+    return rows
+
+def selections_by_user(db, user_ids: list, options: list) -> dict:
+    """{user_id: [(option_id, is_auto_recommended, target_weight), ...]}, auto-selecting for users without selections"""
+    selections = {}
+    for user_id, option_id, is_auto, weight in db.query(
+        PortfolioSelection.user_id, PortfolioSelection.portfolio_option_id,
+        PortfolioSelection.is_auto_recommended, PortfolioSelection.target_weight
+    ).filter(PortfolioSelection.user_id.in_(user_ids)):
+        selections.setdefault(user_id, []).append((option_id, bool(is_auto), weight))
+
+    # Same fallback as /invest-roundups: auto-select by risk profile
+    missing = [u for u in user_ids if u not in selections]
+    if missing:
+        new_rows = []
+        for user_id, risk_profile in db.query(User.id, User.risk_profile).filter(User.id.in_(missing)):
+            for option in get_auto_recommended_portfolios(risk_profile.value, options):
+                selections.setdefault(user_id, []).append((option.id, True, None))
+                new_rows.append({"user_id": user_id, "portfolio_option_id": option.id, "is_auto_recommended": True})
+        if new_rows:
+            insert_logged(db, PortfolioSelection, new_rows)
+    return selections
+
+class _LazyPool:
+    """Process pool shared by the shard threads, started only for large runs"""
+
+    def __init__(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor()
+            return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+def sweep_shard(db, shard_id: int, run_id: int, prices, options: list, resumed: bool = False, pool: _LazyPool = None) -> dict:
+    now = datetime.utcnow()
+    checkpoint = db.query(SweepCheckpoint).filter(
+        SweepCheckpoint.run_id == run_id, SweepCheckpoint.shard_id == shard_id
+    ).first()
+    if not checkpoint:
+        checkpoint = SweepCheckpoint(run_id=run_id, shard_id=shard_id, last_user_id=0)
+        db.add(checkpoint)
+        db.commit()
+
+    candidates = _candidates(db, checkpoint.last_user_id, now)
+    executor = pool.get() if pool is not None and len(candidates) >= SWEEP_POOL_MIN_USERS else None
+    allocate_batch = partial(allocate, prices=prices, run_id=run_id, created_at=now)
+    stats = {"shard": shard_id, "users": 0, "investments": 0, "amount": 0.0, "stopped": False}
+
+    for start in range(0, len(candidates), SWEEP_CHUNK_USERS):
+        if not still_leader():
+            # Lease lost mid-run: the new leader resumes from the checkpoint
+            stats["stopped"] = True
+            break
+        chunk = candidates[start:start + SWEEP_CHUNK_USERS]
+        user_ids = [user_id for user_id, _ in chunk]
+
+        if resumed:
+            # A crash between the shard and directory commits can leave a
+            # chunk invested but not checkpointed; don't invest it twice.
+            done = {uid for (uid,) in db.query(Investment.user_id).filter(
+                Investment.payment_id.in_([sweep_payment_id(run_id, u) for u in user_ids])
+            ).distinct()}
+            chunk = [(u, a) for u, a in chunk if u not in done]
+            resumed = False
+
+        selections = selections_by_user(db, user_ids, options)
+        holdings = holdings_by_user(db, user_ids)
+        batch = [
+            (u, a, [(o, auto, weight, holdings[u].get(o, (0.0, 0.0))[0]) for o, auto, weight in selections[u]])
+            for u, a in chunk if u in selections
+        ]
+
+        if executor is not None:
+            size = max(1, len(batch) // ((os.cpu_count() or 1) * 4))
+            parts = [batch[i:i + size] for i in range(0, len(batch), size)]
+            rows = [row for part in executor.map(allocate_batch, parts) for row in part]
+        else:
+            rows = allocate_batch(batch)
+
+        for i in range(0, len(rows), SWEEP_INSERT_CHUNK):
+            insert_logged(db, Investment, rows[i:i + SWEEP_INSERT_CHUNK])
+        checkpoint.last_user_id = user_ids[-1]
+        db.commit()
+
+        stats["users"] += len({row["user_id"] for row in rows})
+        stats["investments"] += len(rows)
+        stats["amount"] += sum(row["amount"] for row in rows)
+    return stats
+
+def run_sweep() -> dict:
+    """Start a sweep, or resume the one that was interrupted"""
+    start = time.perf_counter()
+    db = SessionLocal()
+    try:
+        run = db.query(SweepRun).filter(SweepRun.status == "running").order_by(SweepRun.id.desc()).first()
+        resumed = run is not None
+        if not run:
+            run = SweepRun(status="running")
+            db.add(run)
+            db.commit()
+        run_id = run.id
+        prices = price_array(db)
+        options = db.query(PortfolioOption).all()
+        db.expunge_all()
+    finally:
+        db.close()
+
+    pool = _LazyPool()
+    try:
+        results = for_each_shard(
+            lambda sdb: sweep_shard(sdb, sdb.info["shard_id"], run_id, prices, options, resumed, pool)
+        )
+    finally:
+        pool.shutdown()
+
+    # A run stopped by a lost lease stays "running", so the next leader resumes it
+    if not any(r["stopped"] for r in results):
+        db = SessionLocal()
+        try:
+            run = db.get(SweepRun, run_id)
+            run.status = "completed"
+            run.finished_at = datetime.utcnow()
+            run.users_invested = sum(r["users"] for r in results)
+            run.amount_invested = round(sum(r["amount"] for r in results), 2)
+            db.commit()
+        finally:
+            db.close()
+
+    return {
+        "run_id": run_id,
+        "users": sum(r["users"] for r in results),
+        "investments": sum(r["investments"] for r in results),
+        "amount": round(sum(r["amount"] for r in results), 2),
+        "seconds": round(time.perf_counter() - start, 2),
+        "shards": results,
+    }
+
+if __name__ == "__main__":
+    print(json.dumps(run_sweep(), indent=2))
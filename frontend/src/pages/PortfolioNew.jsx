@@ -93,7 +93,7 @@ const PortfolioNew = () => {
       fetchData(); // Refresh data to show new prices
     } catch (error) {
       console.error('Update prices error:', error);
-      setError('Failed to update prices');
+      setError(error.response?.data?.detail || 'Failed to update prices');
       setTimeout(() => setError(''), 3000);
     } finally {
       setUpdatingPrices(false);
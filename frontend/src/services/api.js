@@ -23,6 +23,47 @@ api.interceptors.request.use(
   }
 );
 
+// Page-load reads come from one GET /bootstrap. Components loading at the same
+// time share the request; it is dropped shortly after it settles, and right
+// after any write, so later reads see fresh data.
+const BOOTSTRAP_REUSE_MS = 1000;
+let bootstrapRequest = null;
+
+const loadBootstrap = () => {
+  if (!bootstrapRequest) {
+    const request = api.get('/bootstrap');
+    bootstrapRequest = request;
+    const drop = () => {
+      if (bootstrapRequest === request) {
+        bootstrapRequest = null;
+      }
+    };
+    request.then(() => setTimeout(drop, BOOTSTRAP_REUSE_MS), drop);
+  }
+  return bootstrapRequest;
+};
+
+// Resolves like api.get(path) for the endpoint whose payload is bootstrap[key]
+const fromBootstrap = (key) => () =>
+  loadBootstrap().then((response) => ({ ...response, data: response.data[key] }));
+
+const dropBootstrap = (config) => {
+  if (config && config.method !== 'get') {
+    bootstrapRequest = null;
+  }
+};
+
+api.interceptors.response.use(
+  (response) => {
+    dropBootstrap(response.config);
+    return response;
+  },
+  (error) => {
+    dropBootstrap(error.config);
+    return Promise.reject(error);
+  }
+);
+
 // Auth endpoints
 export const authAPI = {
   signup: (email, password) => api.post('/signup', { email, password }),
@@ -42,17 +83,18 @@ export const portfolioAPI = {
   getOptions: () => api.get('/portfolio-options'),
   select: (portfolio_option_ids) => 
     api.post('/select-portfolio', { portfolio_option_ids }),
-  getCurrent: () => api.get('/portfolio'),
+  getCurrent: fromBootstrap('portfolio'),
   getInvestments: () => api.get('/investments'),
-  getInvestmentsDetailed: () => api.get('/investments/detailed'),
+  getInvestmentsDetailed: fromBootstrap('investments_detailed'),
   removeSelection: (option_id) => api.delete(`/portfolio-selection/${option_id}`),
   exitInvestment: (option_id) => api.post(`/investments/exit/${option_id}`),
 };
 
 // Dashboard endpoints
 export const dashboardAPI = {
-  getStats: () => api.get('/dashboard'),
-  getMilestones: () => api.get('/milestones'),
+  getStats: fromBootstrap('dashboard'),
+  getMilestones: fromBootstrap('milestones'),
+  getBootstrap: loadBootstrap,
 };
 
 // Payment endpoints
@@ -90,13 +132,13 @@ export const walletAPI = {
       razorpay_payment_id,
       razorpay_signature,
     }),
-  getBalance: () => api.get('/wallet'),
+  getBalance: fromBootstrap('wallet'),
   getDeposits: () => api.get('/deposits'),
 };
 
 // Investment tracking
 export const investmentAPI = {
-  getSources: () => api.get('/investment-sources'),
+  getSources: fromBootstrap('investment_sources'),
   investRoundups: (amount, source = 'roundups') => api.post(`/invest-roundups?amount=${amount}&source=${source}`),
   updatePrices: () => api.post('/update-prices'),
 };